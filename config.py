@@ -9,6 +9,24 @@ class Args(object):
     def __init__(self, config_dict):
         self.__dict__.update(config_dict)
 
+    def replace(self, **changes):
+        '''
+            returns: a new Args with changes applied, self is left untouched
+        '''
+        return Args(dict(self.__dict__, **changes))
+
+
+class FrozenArgs(Args):
+    '''
+        Args shared across requests. They can't be changed in place, tasks
+        derive their own copy with replace().
+    '''
+    def __setattr__(self, key, value):
+        raise AttributeError("Can't set {} on shared args, derive a copy with replace()".format(key))
+
+    def __delattr__(self, key):
+        raise AttributeError("Can't delete {} from shared args, derive a copy with replace()".format(key))
+
 
 class Config(object):
     PORT = 5000
@@ -25,9 +43,61 @@ class Config(object):
     DB_UNLABLED_PATH = os.path.join(PICKLE_DIR, "reportDBAPI_test.p")
     DB_NON_BREAST_PATH = os.path.join(PICKLE_DIR, "reportDBAPI_nonbreasts.p")
     EMBEDDING_PATH = os.path.join(PICKLE_DIR, "hash_embeddings.p")
+    EMBEDDING_NPY_PATH = os.path.join(PICKLE_DIR, "hash_embeddings.npy")
+    EMBEDDING_COMPACT_PATH = os.path.join(PICKLE_DIR, "hash_embeddings_compact.npy")
+    EMBEDDING_REMAP_PATH = os.path.join(PICKLE_DIR, "hash_embeddings_remap.npy")
+    REPORT_STORE_DIR = os.path.join(PICKLE_DIR, "report_store")
+    DB_CACHE_MAX_BYTES = 2 * 1024**3
+    MODEL_CACHE_MAX_BYTES = 4 * 1024**3
+    INFERENCE_CACHE_PATH = os.path.join(PICKLE_DIR, "inference_cache.db")
+    INFERENCE_CACHE_MAX_BYTES = 512 * 1024**2
+    PREDICT_STREAM_CHUNK_SIZE = 1000
+    # Run inference batches of similar length, each padded to its longest
+    # report plus a margin that keeps labels the same, rather than
+    # max_length, see oncotext/inference.py
+    LENGTH_BUCKETED_INFERENCE = True
+    # 'fp32', or 'int8' to run dynamically quantized copies of the snapshots
+    # on cpu. Only Linear / recurrent layers are converted, cnn convs stay in
+    # fp32, measure with scripts/evaluate_quantization.py, see
+    # oncotext/utils/quantization.py
+    INFERENCE_ENGINE = 'fp32'
+    # Only run marker / grade models on reports where a cancer was predicted
+    # (ProstateCa for numerical prostate fields), see
+    # postprocess.get_inference_plan
+    CASCADED_INFERENCE = True
+    # Label Meta reports with the models of the organs their organ
+    # classifiers predict, see postprocess.get_routed_organs
+    ORGAN_ROUTING = True
+    PREDICT_TEXT_MAX_REPORTS = 100
+    # Concurrent /predictText requests arriving within MICRO_BATCH_MAX_WAIT_MS
+    # of each other are labeled in one pass, up to MICRO_BATCH_MAX_SIZE reports.
+    # Up to MICRO_BATCH_WORKERS passes (of different users) run at once
+    MICRO_BATCH_MAX_SIZE = 64
+    MICRO_BATCH_MAX_WAIT_MS = 10
+    MICRO_BATCH_WORKERS = 4
+    # Background jobs of /trainAsync and /predictAsync
+    JOB_WORKERS = 2
+    JOB_HISTORY_SIZE = 100
+    # Diagnoses are trained in a pool of TRAIN_WORKERS processes (0 sizes the
+    # pool by cores), each using TRAIN_THREADS_PER_WORKER torch threads (0
+    # splits the cores evenly), see oncotext/worker_pool.py
+    TRAIN_WORKERS = 1
+    TRAIN_THREADS_PER_WORKER = 0
+    # Step budget of /train?mode=incremental, fine-tuning existing snapshots
+    INCREMENTAL_TRAIN_STEPS = 300
+    INCREMENTAL_TRAIN_MAX_EPOCHS = 10
+    # Models label predict batches of at least INFERENCE_SHARD_MIN_REPORTS
+    # reports in contiguous shards, in a pool of INFERENCE_WORKERS processes
+    # (0 sizes the pool by cores), each using INFERENCE_THREADS_PER_WORKER
+    # torch threads (0 splits the cores evenly)
+    INFERENCE_WORKERS = 1
+    INFERENCE_THREADS_PER_WORKER = 0
+    INFERENCE_SHARD_MIN_REPORTS = 10000
 
     if not os.path.exists(PICKLE_DIR):
         os.makedirs(PICKLE_DIR)
+    if not os.path.exists(REPORT_STORE_DIR):
+        os.makedirs(REPORT_STORE_DIR)
     if not os.path.exists(DB_TRAIN_PATH):
         pickle.dump({}, open(DB_TRAIN_PATH, 'wb'))
     if not os.path.exists(DB_BASE_PATH):
@@ -109,4 +179,12 @@ class Config(object):
         'num_tags': 2
     }
 
-    RATIONALE_NET_ARGS = Args(RATIONALE_NET_CONFIG)
+    RATIONALE_NET_ARGS = FrozenArgs(RATIONALE_NET_CONFIG)
+
+
+def get_config_dict():
+    '''
+        Config as a plain dict, the way app.py sees it through flask's
+        app.config.from_object. Useful for scripts and tests.
+    '''
+    return {k: getattr(Config, k) for k in dir(Config) if k.isupper()}
@@ -0,0 +1,138 @@
+'''
+Micro-batching of concurrent inference requests.
+
+Callers submit a few reports at a time, e.g through /predictText. Requests
+for the same key (user, organ) that arrive within max_wait_ms of the first
+one are coalesced, up to max_batch_size reports, and labeled by a single
+run_batch call, i.e one forward pass per diagnosis model instead of one per
+request. Results are split back to each caller in order.
+
+A single dispatcher thread, started on the first submit, collects the
+batches and hands them to a small pool of max_workers threads, so batches of
+different keys run concurrently: a slow batch (e.g a cold model load) of
+one user does not hold back the requests of others.
+'''
+
+import time
+import queue
+import threading
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+import pdb
+
+
+class _Request(object):
+
+    def __init__(self, key, items):
+        self.key = key
+        self.items = items
+        self.future = Future()
+        self.submitted_at = time.time()
+
+
+class MicroBatcher(object):
+
+    def __init__(self, run_batch, max_batch_size, max_wait_ms, logger, max_workers=4):
+        '''
+            params:
+            - run_batch: function run_batch(key, items) returning one result
+              per item
+            - max_batch_size: max number of items per run_batch call. A
+              single larger request still runs on its own.
+            - max_wait_ms: max time the first request of a batch waits for
+              others to join it
+            - max_workers: max number of batches running at once
+        '''
+        self.run_batch = run_batch
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000.
+        self.logger = logger
+        self.executor = ThreadPoolExecutor(max(1, max_workers), thread_name_prefix='micro-batch')
+        self.queue = queue.Queue()
+        # Requests pulled from the queue while batching another key
+        self.deferred = deque()
+        self.lock = threading.Lock()
+        self.thread = None
+        self.stats = {'requests': 0, 'items': 0, 'batches': 0,
+                      'max_batch_size': 0, 'wait_ms': 0.}
+
+    def submit(self, key, items):
+        '''
+            Block until items are labeled.
+
+            returns:
+            - results: list of results, aligned with items
+        '''
+        self._start()
+        request = _Request(key, list(items))
+        self.queue.put(request)
+        return request.future.result()
+
+    def _start(self):
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._dispatch_loop, name='micro-batcher', daemon=True)
+                self.thread.start()
+
+    def _next_request(self, timeout=None):
+        if len(self.deferred) > 0:
+            return self.deferred.popleft()
+        return self.queue.get(timeout=timeout)
+
+    def _collect_batch(self):
+        first = self._next_request()
+        batch = [first]
+        size = len(first.items)
+        deadline = first.submitted_at + self.max_wait
+        skipped = []
+        while size < self.max_batch_size:
+            timeout = deadline - time.time()
+            if timeout <= 0:
+                break
+            try:
+                request = self._next_request(timeout)
+            except queue.Empty:
+                break
+            if request.key != first.key or size + len(request.items) > self.max_batch_size:
+                skipped.append(request)
+                continue
+            batch.append(request)
+            size += len(request.items)
+        self.deferred.extendleft(reversed(skipped))
+        return batch
+
+    def _dispatch_loop(self):
+        while True:
+            batch = self._collect_batch()
+            self.executor.submit(self._run, batch)
+
+    def _run(self, batch):
+        key = batch[0].key
+        items = [item for request in batch for item in request.items]
+        started_at = time.time()
+        with self.lock:
+            self.stats['requests'] += len(batch)
+            self.stats['items'] += len(items)
+            self.stats['batches'] += 1
+            self.stats['max_batch_size'] = max(self.stats['max_batch_size'], len(items))
+            self.stats['wait_ms'] += sum(started_at - r.submitted_at for r in batch) * 1000
+        try:
+            results = self.run_batch(key, items)
+        except Exception as e:
+            self.logger.warn("batching - batch of {} items for {} failed. Exception {}".format(len(items), key, e))
+            for request in batch:
+                request.future.set_exception(e)
+            return
+
+        start = 0
+        for request in batch:
+            request.future.set_result(results[start:start + len(request.items)])
+            start += len(request.items)
+
+    def get_stats(self):
+        with self.lock:
+            stats = dict(self.stats)
+        stats['queue_depth'] = self.queue.qsize() + len(self.deferred)
+        stats['mean_batch_size'] = stats['items'] / stats['batches'] if stats['batches'] else 0
+        stats['mean_wait_ms'] = stats.pop('wait_ms') / stats['requests'] if stats['requests'] else 0
+        return stats
@@ -0,0 +1,100 @@
+import copy
+import torch
+import torch.utils.data as data
+import numpy as np
+from oncotext.utils.tokenizer import get_tokenizer
+import pdb
+
+
+class FeaturizedReports(object):
+    '''
+        Token ids of a list of reports, hashed once and shared by every
+        diagnosis model that labels them.
+
+        x: LongTensor of shape (num_reports, 1, max_length), the same layout
+        the pathology datasets give each sample. token_ids, if given, are
+        the bucket ids stored at ingest and are used instead of hashing.
+    '''
+
+    def __init__(self, args, reports, text_key, token_ids=None):
+        self.args = args
+        self.reports = reports
+        self.text_key = text_key
+        self.max_length = args.max_length
+        texts = [r[text_key] for r in reports]
+        x, self.lengths = get_tokenizer(args).featurize(texts, token_ids)
+        self.x = torch.from_numpy(x.astype(np.int64)).view(len(reports), 1, self.max_length)
+
+    @classmethod
+    def from_token_tensor(cls, args, reports, text_key, x, lengths):
+        '''
+            returns:
+            - featurized: FeaturizedReports over reports with token ids x
+              and lengths already computed, e.g a shard sent to a worker
+              process
+        '''
+        featurized = cls.__new__(cls)
+        featurized.args = args
+        featurized.reports = reports
+        featurized.text_key = text_key
+        featurized.max_length = args.max_length
+        featurized.lengths = lengths
+        featurized.x = x
+        return featurized
+
+    def __len__(self):
+        return len(self.reports)
+
+    def subset(self, indices):
+        '''
+            returns:
+            - featurized: FeaturizedReports over the reports at indices,
+              sharing token ids with self instead of hashing again
+        '''
+        subset = FeaturizedReports.__new__(FeaturizedReports)
+        subset.args = self.args
+        subset.reports = [self.reports[i] for i in indices]
+        subset.text_key = self.text_key
+        subset.max_length = self.max_length
+        index = torch.LongTensor(indices)
+        subset.lengths = self.lengths[np.asarray(indices, dtype=np.int64)]
+        subset.x = self.x.index_select(0, index)
+        return subset
+
+    def truncate(self, max_length):
+        '''
+            returns:
+            - featurized: view of self with token ids cut to max_length,
+              e.g the longest report of a length bucket
+        '''
+        truncated = copy.copy(self)
+        truncated.max_length = max_length
+        truncated.lengths = np.minimum(self.lengths, max_length)
+        truncated.x = self.x[:, :, :max_length]
+        return truncated
+
+
+class PathologyTestDataset(data.Dataset):
+    '''
+        Unlabeled view over FeaturizedReports for one diagnosis model. Serves
+        the same samples as the pathology datasets built with name 'test',
+        without copying reports or re-hashing text.
+    '''
+
+    def __init__(self, featurized, use_as_tagger):
+        self.featurized = featurized
+        self.dataset = featurized.reports
+        self.text_key = featurized.text_key
+        self.use_as_tagger = use_as_tagger
+        self.tag_y = torch.zeros(featurized.max_length).long()
+        self.class_balance = {'NA': len(featurized)}
+
+    def __len__(self):
+        return len(self.featurized)
+
+    def __getitem__(self, index):
+        sample = { 'x': self.featurized.x[index],
+                   'i': index,
+                   'y': self.tag_y if self.use_as_tagger else 0,
+                   'text': self.dataset[index][self.text_key]}
+        return sample
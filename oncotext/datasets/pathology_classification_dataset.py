@@ -9,7 +9,8 @@ from rationale_net.datasets.abstract_dataset import AbstractDataset
 import rationale_net.utils.embedding as utils
 import random
 import copy
-from sklearn.utils import murmurhash3_32
+import numpy as np
+from oncotext.utils.tokenizer import get_tokenizer
 from collections import Counter
 
 SMALL_TRAIN_SIZE = 800
@@ -18,7 +19,7 @@ random.seed(0)
 
 class PathologyClassificationDataset(data.Dataset):
 
-    def __init__(self, args, reports, label_map, text_key, name):
+    def __init__(self, args, reports, label_map, text_key, name, token_ids=None):
         self.name = name
         self.args = args
         diagnosis = args.aspect
@@ -26,15 +27,17 @@ class PathologyClassificationDataset(data.Dataset):
         self.text_key = text_key
         self.samples = copy.deepcopy( self.dataset)
         self.class_balance = {}
+        self.tokenizer = get_tokenizer(args)
+        x, _ = self.tokenizer.featurize([sample[text_key] for sample in self.samples], token_ids)
+        x = torch.from_numpy(x.astype(np.int64))
         for i, sample in tqdm.tqdm(enumerate(self.samples)):
-            sample['x'] = self.processLine(sample[text_key])
+            sample['x'] = x[i:i+1]
             if name == 'test':
                  sample['y'] = 0
                  val = 'NA'
             else:
                 sample['y'] = label_map[diagnosis].index(sample[diagnosis])
                 val = sample[diagnosis]
-                args.num_class = len(label_map[diagnosis])
             sample['val'] = val
             sample['i'] = i
             if not val in self.class_balance:
@@ -50,21 +53,10 @@ class PathologyClassificationDataset(data.Dataset):
         label_weights = { label: weight_per_label/count for label, count in label_counts.items()}
         self.weights = [ label_weights[d[dist_key]] for d in self.samples]
 
-    def hash(self, token):
-        """Unsigned 32 bit murmurhash for feature hashing."""
-        return murmurhash3_32(token, positive=True) % self.args.vocab_size
-
     ## Convert one line from beer dataset to {Text, Tensor, Labels}
     def processLine(self, raw_text):
-        text = raw_text.split()[:self.args.max_length]
-        text_indx =  [self.hash(token) for token in text]
-        if len(text_indx) < self.args.max_length:
-            nil_indx = 0
-            text_indx.extend( [nil_indx for _ in range(self.args.max_length - len(text_indx))])
-
-        x =  torch.LongTensor([text_indx])
-
-        return x
+        x, _ = self.tokenizer.tokenize_batch([raw_text])
+        return torch.from_numpy(x.astype(np.int64))
 
     def __len__(self):
         return len(self.samples)
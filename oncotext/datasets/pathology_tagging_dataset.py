@@ -9,15 +9,38 @@ from rationale_net.datasets.abstract_dataset import AbstractDataset
 import rationale_net.utils.embedding as utils
 import random
 import copy
-from sklearn.utils import murmurhash3_32
+import numpy as np
+from oncotext.utils.tokenizer import get_tokenizer
 
 SMALL_TRAIN_SIZE = 800
 random.seed(0)
 
 
+def get_tag_indices(text, label, max_length):
+    '''
+        params:
+        - text: tokens of the report text, at most max_length of them
+
+        returns:
+        - label_indx: [1 if token matches label, else 0, for each of the
+          max_length tokens]
+        - match: '0' if label not in text, '1' if it is
+    '''
+    label_indx = [0 for _ in range(max_length)]
+    ## array of values in the label (for when the label spans multiple tokens)
+    val = label.split()
+    match = '0'
+    ## for each token in text, if the following tokens match the label, set each corresponding index in y to 1
+    for i in range(len(text)):
+        if text[i:i+len(val)] == val:
+            match = '1'
+            label_indx[i:i+len(val)] = [1 for _ in range(len(val))]
+    return label_indx, match
+
+
 class PathologyTaggingDataset(data.Dataset):
 
-    def __init__(self, args, reports, label_map, text_key, name):
+    def __init__(self, args, reports, label_map, text_key, name, token_ids=None):
         self.name = name
         self.args = args
         self.diagnosis = args.aspect
@@ -28,49 +51,33 @@ class PathologyTaggingDataset(data.Dataset):
         ## class_balance['1']: how many reports had 1 or more exact matches for the label, or parts of the label, in the report text (y tensor has 1(s)) 
         self.class_balance = {'0': 0, '1': 0}
 
+        self.tokenizer = get_tokenizer(args)
+        x, _ = self.tokenizer.featurize([sample[text_key] for sample in self.samples], token_ids)
+        x = torch.from_numpy(x.astype(np.int64))
         for i, sample in tqdm.tqdm(enumerate(self.samples)):
-            sample['x'], sample['y'], sample['val'], sample['match'] = self.processLine(sample)
+            sample['x'], sample['y'], sample['val'], sample['match'] = self.processLine(sample, x[i:i+1])
             sample['i'] = i
             self.class_balance[sample['match']] += 1
             
         print ("Class balance", self.class_balance)
-        args.num_class = args.num_tags
 
                         
-    def hash(self, token):
-        """Unsigned 32 bit murmurhash for feature hashing."""
-        return murmurhash3_32(token, positive=True) % self.args.vocab_size
-
-    
     ## Convert each sample to {x, y, label, match}, where
-    ## x: tensor of text tokens
+    ## x: tensor of text tokens, hashed for the whole dataset at once
     ## y: tensor of [1 if token matches label, else 0, for each token in x]
     ## label: original value of label
     ## match: '0' if label not in text, '1' if it is
-    def processLine(self, sample):
+    def processLine(self, sample, x):
         text = sample[self.text_key].split()[:self.args.max_length]
-        text_indx = [self.hash(token) for token in text]
-        if len(text_indx) < self.args.max_length:
-            nil_indx = 0
-            text_indx.extend([nil_indx for _ in range(self.args.max_length - len(text_indx))])
-
-        x = torch.LongTensor([text_indx])
 
-        label_indx = [0 for _ in range(len(text_indx))]
+        label_indx = [0 for _ in range(self.args.max_length)]
 
         if self.name == "test":
             label = 'NA'
             match = '0'
         else:
             label = sample[self.diagnosis]
-            ## array of values in the label (for when the label spans multiple tokens)
-            val = label.split()
-            match = '0'
-            ## for each token in text, if the following tokens match the label, set each corresponding index in y to 1
-            for i in range(len(text)):
-                if text[i:i+len(val)] == val:
-                    match = '1'
-                    label_indx[i:i+len(val)] = [1 for _ in range(len(val))]
+            label_indx, match = get_tag_indices(text, label, self.args.max_length)
                     
         y = torch.LongTensor(label_indx)
         
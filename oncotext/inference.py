@@ -0,0 +1,121 @@
+'''
+Length bucketed inference.
+
+Reports are hashed into max_length (720) token ids, but most segments are
+much shorter. Instead of running every batch at max_length, reports are
+sorted by their number of tokens and cut into batches of similar length,
+each trimmed to its longest report plus get_pad_margin(args) padding
+tokens. Predictions are put back in the original report order.
+
+The margin keeps labels the same as with a single pass padded to
+max_length. The cnn max pools over every position, pad positions included,
+and the models were trained padded to max_length. Past a receptive field
+from the last token (and from the end of the input) every window of a
+report is made of padding only and gives the same activations, however far
+the padding goes. With at least two receptive fields of padding after the
+longest report of a batch, every report of the batch sees the same set of
+window values as in the padded pass, so its max pooled features are the
+same. Tagging models label every position, so they still run padded to
+max_length, as do non cnn (e.g rnn) encoders whose state depends on how
+much padding they read.
+
+get_shuffled_length_batches is the training counterpart, used by the
+multi-task model (oncotext/multitask.py), whose encoder masks padding. The
+per diagnosis models are trained by text_nn, which builds its own data
+loader with no hook for a batch sampler or collate function, so they still
+train padded to max_length.
+'''
+
+import numpy as np
+import rationale_net.learn.train as train_utils
+import oncotext.datasets.featurized_dataset as featurized_dataset
+import pdb
+
+
+def get_min_length(args):
+    '''
+        Shortest input the model accepts, the widest conv filter.
+    '''
+    return max(list(getattr(args, 'filters', [])) + [1])
+
+
+def get_pad_margin(args):
+    '''
+        Padding tokens to keep after the longest report of a batch, two
+        receptive fields of the cnn encoder.
+    '''
+    return 2 * max(getattr(args, 'num_layers', 1), 1) * get_min_length(args)
+
+
+def can_bucket(args):
+    '''
+        Whether the model of args labels reports the same when run on
+        batches trimmed to get_pad_margin, see module docstring.
+    '''
+    return getattr(args, 'model_form', None) == 'cnn' and not args.use_as_tagger
+
+
+def get_length_batches(lengths, batch_size, min_length, margin=0, max_length=None):
+    '''
+        returns:
+        - batches: list of (indices, length), indices of reports of similar
+          length, at most batch_size of them, and the length to trim them
+          to, their longest report plus margin, at least min_length and at
+          most max_length
+    '''
+    order = np.argsort(lengths, kind='stable')
+    batches = []
+    for start in range(0, len(order), batch_size):
+        indices = order[start:start + batch_size]
+        length = max(int(lengths[indices].max()) + margin, min_length)
+        if max_length is not None:
+            length = min(length, max_length)
+        batches.append((indices, length))
+    return batches
+
+
+def get_shuffled_length_batches(lengths, batch_size, min_length, rng=np.random):
+    '''
+        Training batches of similar length: reports are sorted by length
+        with random ties, cut into batches, and batches are returned in
+        random order.
+
+        returns:
+        - batches: list of (indices, length), see get_length_batches
+    '''
+    noise = rng.uniform(size=len(lengths))
+    order = np.lexsort((noise, lengths))
+    batches = []
+    for start in range(0, len(order), batch_size):
+        indices = order[start:start + batch_size]
+        batches.append((indices, max(int(lengths[indices].max()), min_length)))
+    return [batches[k] for k in rng.permutation(len(batches))]
+
+
+def test_model(featurized, model, gen, args):
+    '''
+        Same as train_utils.test_model on a PathologyTestDataset over all of
+        featurized, running each length batch at its own length.
+
+        returns:
+        - preds: array of shape (len(featurized),) with the predicted class
+          per report, or (len(featurized), max_length) with the predicted
+          tag per token if args.use_as_tagger
+    '''
+    max_length = featurized.max_length
+    if not can_bucket(args):
+        test_data = featurized_dataset.PathologyTestDataset(featurized, args.use_as_tagger)
+        preds = np.asarray(train_utils.test_model(test_data, model, gen, args)['preds'])
+        if args.use_as_tagger:
+            return np.reshape(preds, (len(featurized), max_length))
+        return np.reshape(preds, (len(featurized),))
+
+    preds = np.zeros(len(featurized), dtype=np.int64)
+    min_length = min(get_min_length(args), max_length)
+    for indices, length in get_length_batches(featurized.lengths, args.batch_size, min_length,
+                                              get_pad_margin(args), max_length):
+        batch = featurized.subset(indices).truncate(length)
+        test_data = featurized_dataset.PathologyTestDataset(batch, args.use_as_tagger)
+        batch_preds = np.asarray(train_utils.test_model(test_data, model, gen, args)['preds'])
+        preds[indices] = np.reshape(batch_preds, (len(indices),))
+    return preds
@@ -0,0 +1,135 @@
+'''
+Background jobs for long running requests like /train and /predict.
+
+Jobs run in a bounded thread pool of JOB_WORKERS threads, in the server
+process. Work functions get a progress callback, progress(diagnosis, status),
+which rationale_net_wrapper calls around every diagnosis model, so clients
+polling /jobs/<id> can see how far along a job is. Jobs are created with
+every diagnosis they can report on, so the total does not change while they
+run. Only the last JOB_HISTORY_SIZE finished jobs are kept.
+'''
+
+import uuid
+import time
+import datetime
+import threading
+import traceback
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import pdb
+
+QUEUED = 'queued'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+
+
+def _timestamp(t):
+    return datetime.datetime.fromtimestamp(t).isoformat() if t is not None else None
+
+
+class Job(object):
+
+    def __init__(self, kind, name, organ, diagnoses):
+        self.id = str(uuid.uuid4())
+        self.kind = kind
+        self.name = name
+        self.organ = organ
+        self.status = QUEUED
+        self.submitted_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self.diagnoses = OrderedDict((d, {'status': QUEUED, 'seconds': None}) for d in diagnoses)
+        self._diagnosis_started_at = {}
+        # progress runs in the job thread, to_dict in request threads
+        self._lock = threading.Lock()
+        self.result = None
+        self.error = None
+
+    def progress(self, diagnosis, status):
+        '''
+            Progress callback handed to the work function.
+        '''
+        now = time.time()
+        with self._lock:
+            entry = self.diagnoses.setdefault(diagnosis, {'status': QUEUED, 'seconds': None})
+            entry['status'] = status
+            if status == RUNNING:
+                self._diagnosis_started_at[diagnosis] = now
+            elif diagnosis in self._diagnosis_started_at:
+                entry['seconds'] = now - self._diagnosis_started_at[diagnosis]
+
+    def to_dict(self):
+        with self._lock:
+            diagnoses = OrderedDict((d, dict(entry)) for d, entry in self.diagnoses.items())
+        done = sum(1 for entry in diagnoses.values() if entry['status'] in [DONE, FAILED])
+        end = self.finished_at or time.time()
+        return {'id': self.id,
+                'kind': self.kind,
+                'name': self.name,
+                'organ': self.organ,
+                'status': self.status,
+                'progress': {'done': done,
+                             'total': len(diagnoses),
+                             'diagnoses': diagnoses},
+                'timings': {'submitted_at': _timestamp(self.submitted_at),
+                            'started_at': _timestamp(self.started_at),
+                            'finished_at': _timestamp(self.finished_at),
+                            'queued_seconds': (self.started_at or end) - self.submitted_at,
+                            'running_seconds': end - self.started_at if self.started_at else None},
+                'result': self.result,
+                'error': self.error}
+
+
+class JobManager(object):
+
+    def __init__(self, max_workers, history_size, logger):
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+        self.history_size = history_size
+        self.logger = logger
+        self.jobs = OrderedDict()
+        self.lock = threading.Lock()
+
+    def submit(self, kind, name, organ, diagnoses, fn):
+        '''
+            Queue fn(progress) to run in the pool.
+
+            returns:
+            - job: Job, its result is the return value of fn
+        '''
+        job = Job(kind, name, organ, diagnoses)
+        with self.lock:
+            self.jobs[job.id] = job
+            self._prune()
+        self.executor.submit(self._run, job, fn)
+        self.logger.info("jobs - queued {} job {} for {} {}".format(kind, job.id, name, organ))
+        return job
+
+    def _run(self, job, fn):
+        job.started_at = time.time()
+        job.status = RUNNING
+        try:
+            job.result = fn(job.progress)
+            job.status = DONE
+        except Exception as e:
+            self.logger.error("jobs - {} job {} failed. Exception {}\n{}".format(
+                              job.kind, job.id, e, traceback.format_exc()))
+            job.error = str(e)
+            job.status = FAILED
+        job.finished_at = time.time()
+        self.logger.info("jobs - {} job {} {} in {:.1f}s".format(
+                         job.kind, job.id, job.status, job.finished_at - job.started_at))
+
+    def _prune(self):
+        finished = [job_id for job_id, job in self.jobs.items() if job.status in [DONE, FAILED]]
+        for job_id in finished[:max(len(finished) - self.history_size, 0)]:
+            del self.jobs[job_id]
+
+    def get(self, job_id):
+        '''
+            returns:
+            - job: dict view of the job, None if unknown
+        '''
+        with self.lock:
+            job = self.jobs.get(job_id)
+        return job.to_dict() if job is not None else None
@@ -0,0 +1,316 @@
+'''
+Multi-task model: one encoder shared by every diagnosis of an organ.
+
+The per diagnosis models each embed and convolve the same tokens. The
+multi-task model runs a single cnn encoder (same filters as
+RATIONALE_NET_CONFIG) over the shared frozen embeddings, and feeds it to a
+head per diagnosis: max pooled features through a hidden layer for
+classification diagnoses, per token features for tagging (NUM) ones.
+Labeling an organ is then one forward pass per batch instead of one per
+diagnosis. Padding is masked in the encoder, so batches are trimmed to
+their longest report, in training (see
+inference.get_shuffled_length_batches) as well as inference.
+
+It is trained on every annotated report of the organ at once, each report
+contributing to the loss of the diagnoses it is annotated for, and saved as
+oncotext_multitask_<organ>.pt next to the per diagnosis snapshots, with
+its diagnoses and dev results in the snapshot meta. No rationales are
+generated. scripts/benchmark_multitask.py compares it against the per
+diagnosis models.
+'''
+
+import os
+import numpy as np
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from sklearn.metrics import accuracy_score, precision_recall_fscore_support
+import oncotext.inference as inference
+import oncotext.utils.embedding as embedding
+import oncotext.utils.snapshot_meta as snapshot_meta
+from oncotext.datasets.pathology_tagging_dataset import get_tag_indices
+import pdb
+
+MODEL_FILE = 'oncotext_multitask_{}.pt'
+# Target of reports not annotated for a diagnosis
+IGNORE = -1
+
+
+class MultiTaskModel(nn.Module):
+
+    def __init__(self, embeddings, args, diagnoses, label_maps):
+        '''
+            params:
+            - embeddings: the process wide embedding matrix, kept frozen
+            - diagnoses: diagnoses to add a head for
+        '''
+        super(MultiTaskModel, self).__init__()
+        self.diagnoses = list(diagnoses)
+        self.use_as_tagger = [label_maps[d][0] == "NUM" for d in self.diagnoses]
+        self.num_classes = [args.num_tags if use_as_tagger else len(label_maps[d])
+                            for d, use_as_tagger in zip(self.diagnoses, self.use_as_tagger)]
+        self.filters = list(args.filters)
+
+        # Sized by share_model_embeddings
+        self.embedding_layer = nn.Embedding(1, embeddings.shape[1])
+        self.embedding_layer.weight.requires_grad = False
+        embedding.share_model_embeddings([self], embeddings)
+
+        self.convs = nn.ModuleList([nn.Conv1d(embeddings.shape[1], args.filter_num, width)
+                                    for width in self.filters])
+        self.dropout = nn.Dropout(args.dropout)
+        num_features = args.filter_num * len(self.filters)
+        heads = []
+        for use_as_tagger, num_class in zip(self.use_as_tagger, self.num_classes):
+            if use_as_tagger:
+                heads.append(nn.Linear(num_features, num_class))
+            else:
+                heads.append(nn.Sequential(nn.Linear(num_features, args.hidden_dim),
+                                           nn.ReLU(),
+                                           nn.Dropout(args.dropout),
+                                           nn.Linear(args.hidden_dim, num_class)))
+        self.heads = nn.ModuleList(heads)
+
+    def forward(self, x, lengths):
+        '''
+            params:
+            - x: LongTensor of token ids, of shape (batch, length)
+            - lengths: LongTensor of the number of tokens of each report.
+              Padding past them is masked out, so the outputs of a report
+              don't depend on how far its batch is padded.
+
+            returns:
+            - logits: list aligned with self.diagnoses, of shape
+              (batch, num_class), or (batch, length, num_tags) for tagging
+              diagnoses
+        '''
+        mask = (torch.arange(x.shape[1], device=x.device)[None, :] < lengths[:, None]).float().unsqueeze(1)
+        # Padding tokens read as the zero padding of the convs
+        emb = self.embedding_layer(x).transpose(1, 2) * mask
+        features = []
+        for width, conv in zip(self.filters, self.convs):
+            # Pad so every token gets a feature, for the tagging heads
+            left = (width - 1) // 2
+            features.append(F.relu(conv(F.pad(emb, (left, width - 1 - left)))))
+        # Features are >= 0 after relu, zeroing padding keeps it out of the max
+        hidden = self.dropout(torch.cat(features, 1)) * mask
+        pooled = hidden.max(2)[0]
+
+        logits = []
+        for use_as_tagger, head in zip(self.use_as_tagger, self.heads):
+            logits.append(head(hidden.transpose(1, 2)) if use_as_tagger else head(pooled))
+        return logits
+
+
+def get_snapshot_path(args, name, organ):
+    return os.path.join(args.model_dir.format(name), MODEL_FILE.format(organ))
+
+
+def get_device(args):
+    return torch.device('cuda' if str(args.cuda).lower() == 'true' and torch.cuda.is_available() else 'cpu')
+
+
+def get_targets(reports, diagnoses, label_maps, text_key, max_length):
+    '''
+        returns:
+        - targets: list aligned with diagnoses of LongTensors, the class of
+          each report, or of shape (len(reports), max_length), the tag of
+          each token. IGNORE where a report is not annotated for the
+          diagnosis (or with a value outside its label map).
+    '''
+    targets = []
+    for diagnosis in diagnoses:
+        label_map = label_maps[diagnosis]
+        if label_map[0] == "NUM":
+            y = torch.full((len(reports), max_length), IGNORE, dtype=torch.long)
+            for i, r in enumerate(reports):
+                if diagnosis in r:
+                    text = r[text_key].split()[:max_length]
+                    y[i] = torch.LongTensor(get_tag_indices(text, str(r[diagnosis]), max_length)[0])
+        else:
+            y = torch.LongTensor([label_map.index(r[diagnosis]) if r.get(diagnosis) in label_map else IGNORE
+                                  for r in reports])
+        targets.append(y)
+    return targets
+
+
+def get_class_weights(y, num_class):
+    '''
+        Inverse class frequency weights, as the class balanced sampling of
+        the per diagnosis models.
+    '''
+    counts = torch.bincount(y[y != IGNORE], minlength=num_class).float()
+    present = counts > 0
+    weights = torch.ones(num_class)
+    weights[present] = counts[present].sum() / (present.sum().float() * counts[present])
+    return weights
+
+
+def _batch(featurized, targets, indices, length, device):
+    index = torch.LongTensor(indices)
+    x = featurized.x.index_select(0, index)[:, 0, :length].to(device)
+    lengths = torch.from_numpy(np.asarray(featurized.lengths[indices], dtype=np.int64)).to(device)
+    ys = []
+    for y in targets:
+        y = y.index_select(0, index)
+        ys.append((y[:, :length] if y.dim() == 2 else y).to(device))
+    return x, lengths, ys
+
+
+def get_loss(model, logits, ys, class_weights):
+    loss = 0
+    for k, (y, logit) in enumerate(zip(ys, logits)):
+        if (y != IGNORE).sum() == 0:
+            continue
+        if model.use_as_tagger[k]:
+            loss = loss + F.cross_entropy(logit.reshape(-1, logit.shape[-1]), y.reshape(-1), ignore_index=IGNORE)
+        else:
+            loss = loss + F.cross_entropy(logit, y, weight=class_weights[k], ignore_index=IGNORE)
+    return loss
+
+
+def evaluate(featurized, targets, indices, model, args):
+    '''
+        returns:
+        - dev_stats: list aligned with model.diagnoses of {'accuracy',
+          'precision', 'recall', 'f1'} over the reports of indices annotated
+          for the diagnosis. Tagging diagnoses are scored per token, on the
+          matching tag.
+    '''
+    preds = test_model(featurized.subset(indices), model, args)
+    dev_stats = []
+    for k, diagnosis in enumerate(model.diagnoses):
+        y = targets[k].index_select(0, torch.LongTensor(indices)).numpy()
+        pred = preds[diagnosis]
+        annotated = (y != IGNORE) if y.ndim == 1 else (y != IGNORE).all(1)
+        if annotated.sum() == 0:
+            dev_stats.append({'accuracy': None, 'precision': None, 'recall': None, 'f1': None})
+            continue
+        y, pred = y[annotated], pred[annotated]
+        if model.use_as_tagger[k]:
+            y, pred = y.reshape(-1), pred.reshape(-1)
+            average = 'binary'
+        else:
+            average = 'macro'
+        precision, recall, f1, _ = precision_recall_fscore_support(y, pred, average=average)
+        dev_stats.append({'accuracy': accuracy_score(y, pred),
+                          'precision': precision, 'recall': recall, 'f1': f1})
+    return dev_stats
+
+
+def _mean_f1(dev_stats):
+    f1s = [stats['f1'] for stats in dev_stats if stats['f1'] is not None]
+    return np.mean(f1s) if len(f1s) > 0 else 0.
+
+
+def train_model(featurized, targets, train_indices, dev_indices, model, args, logger):
+    '''
+        Train model on the reports of featurized at train_indices, for at
+        most args.max_epochs, stopping after args.patience epochs without
+        improvement of the mean dev f1, and keep the best epoch.
+
+        returns:
+        - dev_stats: dev results of the best epoch, see evaluate
+        - model: the trained model
+    '''
+    device = get_device(args)
+    model = model.to(device)
+    params = [p for p in model.parameters() if p.requires_grad]
+    optimizer = torch.optim.Adam(params, lr=args.init_lr, weight_decay=args.weight_decay)
+    train_index = torch.LongTensor(train_indices)
+    class_weights = [None if use_as_tagger else get_class_weights(y.index_select(0, train_index), num_class).to(device)
+                     for use_as_tagger, num_class, y in zip(model.use_as_tagger, model.num_classes, targets)]
+    min_length = min(inference.get_min_length(args), featurized.max_length)
+
+    best_f1, best_dev_stats, best_state, bad_epochs = -1, None, None, 0
+    for epoch in range(args.max_epochs):
+        model.train()
+        train_lengths = featurized.lengths[train_indices]
+        total_loss = 0.
+        for batch, length in inference.get_shuffled_length_batches(train_lengths, args.train_batch_size, min_length):
+            x, lengths, ys = _batch(featurized, targets, np.asarray(train_indices)[batch], length, device)
+            loss = get_loss(model, model(x, lengths), ys, class_weights)
+            if not torch.is_tensor(loss):
+                continue
+            optimizer.zero_grad()
+            loss.backward()
+            optimizer.step()
+            total_loss += loss.item()
+
+        dev_stats = evaluate(featurized, targets, dev_indices, model, args)
+        dev_f1 = _mean_f1(dev_stats)
+        logger.info("multitask - epoch {} train loss {:.4f} mean dev f1 {:.4f}".format(epoch, total_loss, dev_f1))
+        if dev_f1 > best_f1:
+            best_f1, best_dev_stats, bad_epochs = dev_f1, dev_stats, 0
+            # The frozen embeddings are shared, no need to copy them
+            best_state = {k: v.detach().clone() for k, v in model.state_dict().items()
+                          if not k.startswith('embedding_layer.')}
+        else:
+            bad_epochs += 1
+            if bad_epochs >= args.patience:
+                break
+
+    if best_state is not None:
+        model.load_state_dict(best_state, strict=False)
+    return best_dev_stats, model
+
+
+def test_model(featurized, model, args):
+    '''
+        Label every report of featurized with every head of model, in
+        length batches, see inference.test_model.
+
+        returns:
+        - preds: {diagnosis: array of shape (len(featurized),), or
+          (len(featurized), max_length) for tagging diagnoses}
+    '''
+    max_length = featurized.max_length
+    preds = [np.zeros((len(featurized), max_length), dtype=np.int64) if use_as_tagger
+             else np.zeros(len(featurized), dtype=np.int64)
+             for use_as_tagger in model.use_as_tagger]
+    device = next(model.convs.parameters()).device
+    min_length = min(inference.get_min_length(args), max_length)
+
+    model.eval()
+    with torch.no_grad():
+        for indices, length in inference.get_length_batches(featurized.lengths, args.batch_size, min_length):
+            x = featurized.x.index_select(0, torch.LongTensor(indices))[:, 0, :length].to(device)
+            lengths = torch.from_numpy(np.asarray(featurized.lengths[indices], dtype=np.int64)).to(device)
+            for k, logits in enumerate(model(x, lengths)):
+                batch_preds = logits.argmax(-1).cpu().numpy()
+                if model.use_as_tagger[k]:
+                    preds[k][indices, :length] = batch_preds
+                else:
+                    preds[k][indices] = batch_preds
+    return dict(zip(model.diagnoses, preds))
+
+
+def save_model(model, snapshot_path, meta):
+    '''
+        Save model without its frozen embeddings, and meta (see
+        snapshot_meta) with its diagnoses.
+    '''
+    tmp_path = snapshot_path + '.tmp'
+    with embedding.without_frozen_embeddings([model]):
+        torch.save(model, tmp_path)
+    os.replace(tmp_path, snapshot_path)
+    snapshot_meta.save_meta(snapshot_path, dict(meta, diagnoses=model.diagnoses))
+
+
+def load_model(snapshot_path, args):
+    '''
+        returns:
+        - model: the saved model on the device of args, its embedding layer
+          is empty until shared
+    '''
+    return torch.load(snapshot_path, map_location='cpu').to(get_device(args))
+
+
+def get_diagnoses(snapshot_path):
+    '''
+        returns:
+        - diagnoses: diagnoses the saved model has heads for, [] if there is
+          no saved model
+    '''
+    meta = snapshot_meta.load_meta(snapshot_path)
+    return meta['diagnoses'] if meta is not None else []
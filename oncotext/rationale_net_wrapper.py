@@ -6,6 +6,15 @@ import rationale_net.utils.parsing as parsing
 import rationale_net.utils.model as model_utils
 import rationale_net.learn.train as train_utils
 import oncotext.utils.dataset_factory as dataset_factory
+import oncotext.utils.model_cache as model_cache
+import oncotext.utils.embedding as embedding
+import oncotext.utils.snapshot_meta as snapshot_meta
+import oncotext.utils.quantization as quantization
+import oncotext.utils.postprocess as postprocess
+import oncotext.inference as inference
+import oncotext.multitask as multitask
+import oncotext.worker_pool as worker_pool
+import oncotext.datasets.featurized_dataset
 import copy
 import numpy as np
 import pdb
@@ -13,6 +22,12 @@ import os
 from csv import DictWriter
 import datetime
 
+FULL = 'full'
+INCREMENTAL = 'incremental'
+FORCE = 'force'
+MULTITASK = 'multitask'
+TRAIN_MODES = [FULL, INCREMENTAL, FORCE, MULTITASK]
+
 
 def parse_epoch_stats_for_dev_results(diagnosis, epoch_stats, logger):
     aspect_result = { 'NAME' : diagnosis}
@@ -29,114 +44,539 @@ def parse_epoch_stats_for_dev_results(diagnosis, epoch_stats, logger):
 
     return aspect_result
 
-def train(name, organ, reports, config, logger):
-    args = config['RATIONALE_NET_ARGS']
-    diagnoses = config['DIAGNOSES'][organ]
-    label_maps = config['POST_DIAGNOSES'][organ]
+def get_failed_result(diagnosis):
+    return {'NAME' : diagnosis,
+            'ACCURACY': 'NA Training Failed',
+            'PRECISION': 'NA',
+            'RECALL': 'NA',
+            'F1': 'NA'}
+
+def get_best_dev_stats(epoch_stats):
+    '''
+        returns:
+        - dev_stats: every dev_ stat of the best epoch
+    '''
+    best_epoch_indx = epoch_stats['best_epoch']
+    return {k: v[best_epoch_indx] for k, v in epoch_stats.items()
+            if k.startswith('dev_') and isinstance(v, list) and len(v) > best_epoch_indx}
+
+
+def get_warm_start_snapshot(name, diagnosis, config, args):
+    '''
+        returns:
+        - snapshot_path: the user's current snapshot of diagnosis, else the
+          default user's, None if neither exists
+    '''
+    for user in [name, config['DEFAULT_USERNAME']]:
+        snapshot_path = os.path.join(args.model_dir.format(user), args.model_file.format(diagnosis))
+        if os.path.exists(snapshot_path):
+            return snapshot_path
+    return None
+
+
+def train_diagnosis(name, diagnosis, reports, label_maps, config, args, embeddings, logger, token_ids=None, num_workers=None, mode=FULL):
+    '''
+        Train and save the model of one diagnosis.
+
+        params:
+        - args: shared args with the embedding setup, left untouched. The
+          model is trained with its own copy.
+        - num_workers: data loader workers, RATIONALE_NET_CONFIG's by default
+        - mode: one of TRAIN_MODES
+            - FULL: train from scratch, unless the current snapshot was
+              trained from scratch on the same data with the same args
+            - INCREMENTAL: fine-tune the current snapshot (see
+              get_warm_start_snapshot) for at most INCREMENTAL_TRAIN_STEPS
+              steps, unless it was trained on the same data with the same
+              args
+            - FORCE: always train from scratch
+
+        returns:
+        - aspect_result: dev results, see parse_epoch_stats_for_dev_results
+        - success: False if training failed
+    '''
     text_key = config['PREPROCESSED_REPORT_TEXT_KEY']
+    logger.info("RN Wrapper: Training model for {}".format(diagnosis))
+    if num_workers is None:
+        num_workers = config['RATIONALE_NET_CONFIG']['num_workers']
+    model_path = os.path.join(args.model_dir.format(name), args.model_file.format(diagnosis))
+
+    try:
+        args = dataset_factory.get_task_args(args, label_maps, diagnosis,
+                                             snapshot=None,
+                                             batch_size=args.train_batch_size,
+                                             num_workers=num_workers,
+                                             model_path=model_path)
+        fingerprint = snapshot_meta.get_train_fingerprint(
+            snapshot_meta.get_data_fingerprint(reports, diagnosis, text_key), args,
+            {diagnosis: label_maps[diagnosis]}, embedding.get_embedding_identity(config, logger))
+
+        meta = snapshot_meta.load_meta(model_path) if mode != FORCE else None
+        if meta is not None and meta.get('fingerprint') == fingerprint and \
+                (mode == INCREMENTAL or not meta['init_snapshot']):
+            logger.info("RN Wrapper: {} training data and args unchanged since {}, keeping snapshot".format(diagnosis, meta['saved_at']))
+            return meta['results'], True
+
+        if mode == INCREMENTAL:
+            args.snapshot = get_warm_start_snapshot(name, diagnosis, config, args)
+        init_snapshot = args.snapshot
+
+        train_data, dev_data = dataset_factory.get_oncotext_dataset_train(
+             reports, label_maps, args, text_key, token_ids)
+
+        steps_per_epoch = max(len(train_data) / args.batch_size, 1)
+        if init_snapshot is not None:
+            args.epochs = int(min(max(config['INCREMENTAL_TRAIN_STEPS'] // steps_per_epoch, 1),
+                                  config['INCREMENTAL_TRAIN_MAX_EPOCHS']))
+            logger.info("RN Wrapper: Fine-tuning {} from {} for {} epochs".format(diagnosis, init_snapshot, args.epochs))
+        else:
+            args.epochs = max(args.max_epochs, int(args.steps / steps_per_epoch))
+        
+        if not os.path.isdir(args.model_dir.format(name)):
+            os.makedirs(args.model_dir.format(name), exist_ok=True)
+        gen, model = model_utils.get_model(args, embeddings, train_data)
+        if init_snapshot is not None:
+            # The snapshot's embedding rows may not match the ids the datasets produce
+            embedding.share_model_embeddings([gen, model], embeddings)
+
+        epoch_stats, model, gen = train_utils.train_model(train_data, dev_data, model, gen, args)
+        logger.info("RN Wrapper. {} model finished to training! Train class balance: {}. Dev class balance: {}".format(diagnosis, train_data.class_balance, dev_data.class_balance))
+
+        aspect_result = parse_epoch_stats_for_dev_results(diagnosis, epoch_stats, logger)
+        snapshot_meta.save_meta(model_path, {'fingerprint': fingerprint,
+                                             'init_snapshot': init_snapshot,
+                                             'results': aspect_result,
+                                             'dev_stats': get_best_dev_stats(epoch_stats),
+                                             'dev_keys': snapshot_meta.get_dev_keys(dev_data.dataset, text_key)})
+        return aspect_result, True
+
+    except Exception as e:
+        logger.warn("RN Wrapper. {} model failed to train! Exception {}".format(diagnosis, e))
+        return get_failed_result(diagnosis), False
 
-    embeddings = dataset_factory.get_embedding_tensor(config, args)
+
+def get_num_train_workers(config, num_diagnoses):
+    '''
+        returns:
+        - workers: number of processes to train num_diagnoses in, the size
+          of the train pool (see worker_pool.get_pool_size), at most
+          num_diagnoses
+    '''
+    return min(worker_pool.get_pool_size(worker_pool.TRAIN, config)[0], num_diagnoses)
+
+
+def get_annotated(reports, token_ids, diagnosis):
+    '''
+        returns:
+        - reports, token_ids: the reports annotated for diagnosis, the only
+          ones its model trains on, and their token ids. Tasks of the train
+          pool carry these rather than the whole train db.
+    '''
+    annotated = [i for i, r in enumerate(reports) if diagnosis in r]
+    return ([reports[i] for i in annotated],
+            [token_ids[i] for i in annotated] if token_ids is not None else None)
+
+
+def _train_diagnosis_in_worker(task):
+    indx, name, organ, diagnosis, reports, token_ids, mode = task
+    state = worker_pool.worker_state
+    config = state['config']
+    embeddings, args = worker_pool.get_worker_embeddings()
+    # Pool workers are daemonic and can't start data loader workers
+    aspect_result, success = train_diagnosis(name, diagnosis, reports,
+                                             config['POST_DIAGNOSES'][organ], config, args,
+                                             embeddings, state['logger'],
+                                             token_ids, num_workers=0,
+                                             mode=mode)
+    return indx, aspect_result, success
+
+
+def train(name, organ, reports, config, logger, token_ids=None, progress=None, mode=FULL):
+    '''
+        Train a model per diagnosis of organ on reports. With TRAIN_WORKERS
+        other than 1, diagnoses are trained in parallel in the train pool,
+        see oncotext/worker_pool.py.
+
+        params:
+        - progress: optional callback, progress(diagnosis, status), called
+          with status 'running' before each model, and 'done' or 'failed'
+          after it
+        - mode: one of TRAIN_MODES, see train_diagnosis. MULTITASK trains
+          a single multi-task model instead, see train_multitask
+
+        returns:
+        - results: list of dev results, one per diagnosis, in the order of
+          DIAGNOSES[organ]
+    '''
+    if mode == MULTITASK:
+        return train_multitask(name, organ, reports, config, logger, token_ids, progress)
+    progress = progress or (lambda diagnosis, status: None)
+    diagnoses = list(config['DIAGNOSES'][organ])
+    label_maps = config['POST_DIAGNOSES'][organ]
+
+    embeddings, args = dataset_factory.get_embedding_tensor(config, config['RATIONALE_NET_ARGS'], logger)
     logger.info("RN Wrapper: Succesffuly got embeddings")
 
-    results = []
+    workers = get_num_train_workers(config, len(diagnoses))
+    if workers == 1:
+        results = []
+        for diagnosis in diagnoses:
+            progress(diagnosis, 'running')
+            aspect_result, success = train_diagnosis(name, diagnosis, reports, label_maps, config,
+                                                     args, embeddings, logger, token_ids,
+                                                     mode=mode)
+            progress(diagnosis, 'done' if success else 'failed')
+            results.append(aspect_result)
+        return results
 
+    pool = worker_pool.get_pool(worker_pool.TRAIN, config, logger)
+    logger.info("RN Wrapper: Training {} diagnoses in {} processes".format(len(diagnoses), pool.workers))
+    results = [None] * len(diagnoses)
     for diagnosis in diagnoses:
-        logger.info("RN Wrapper: Training model for {}".format(diagnosis))
-        args.aspect = diagnosis
-        args.snapshot = None
+        progress(diagnosis, 'running')
+    tasks = [(indx, name, organ, diagnosis) + get_annotated(reports, token_ids, diagnosis) + (mode,)
+             for indx, diagnosis in enumerate(diagnoses)]
+    for indx, aspect_result, success in pool.imap_unordered(_train_diagnosis_in_worker, tasks):
+        results[indx] = aspect_result
+        progress(diagnoses[indx], 'done' if success else 'failed')
+    return results
 
-        try:
-            if label_maps[args.aspect][0] == "NUM":
-                args.class_balance = False
-                args.use_as_tagger = True
-            else:
-                args.class_balance = True
-                args.use_as_tagger = False
-            
-            args.vocab_size = len(embeddings)
 
-            train_data, dev_data = dataset_factory.get_oncotext_dataset_train(
-                 reports, label_maps, args, text_key)
 
-            args.batch_size = args.train_batch_size
-            args.epochs = max(args.max_epochs, int(args.steps / (len(train_data) / args.batch_size)))
-            
-            if not os.path.isdir(args.model_dir.format(name)):
-                os.makedirs(args.model_dir.format(name))
-            args.model_path = os.path.join( args.model_dir.format(name),
-                                        args.model_file.format(diagnosis))
-            gen, model = model_utils.get_model(args, embeddings, train_data)
+def get_multitask_snapshot(name, organ, config, args):
+    '''
+        returns:
+        - snapshot_path: the user's multi-task model of organ, else the
+          default user's, None if neither exists
+    '''
+    for user in [name, config['DEFAULT_USERNAME']]:
+        snapshot_path = multitask.get_snapshot_path(args, user, organ)
+        if os.path.exists(snapshot_path):
+            return snapshot_path
+    return None
 
-            epoch_stats, model, gen = train_utils.train_model(train_data, dev_data, model, gen, args)
-            logger.info("RN Wrapper. {} model finished to training! Train class balance: {}. Dev class balance: {}".format(diagnosis, train_data.class_balance, dev_data.class_balance))
 
-            aspect_result = parse_epoch_stats_for_dev_results(diagnosis, epoch_stats, logger)
+def train_multitask(name, organ, reports, config, logger, token_ids=None, progress=None):
+    '''
+        Train a single multi-task model for every diagnosis of organ on
+        reports, see oncotext/multitask.py. Like train_diagnosis, the
+        current model is kept if it was trained on the same data with the
+        same args.
 
-        except Exception as e:
-            logger.warn("RN Wrapper. {} model failed to train! Exception {}".format(diagnosis, e))
-            aspect_result = {'NAME' : diagnosis,
-                            'ACCURACY': 'NA Training Failed',
-                            'PRECISION': 'NA',
-                            'RECALL': 'NA',
-                            'F1': 'NA'}
+        returns:
+        - results: list of dev results, one per diagnosis, in the order of
+          DIAGNOSES[organ]
+    '''
+    progress = progress or (lambda diagnosis, status: None)
+    diagnoses = list(config['DIAGNOSES'][organ])
+    label_maps = config['POST_DIAGNOSES'][organ]
+    text_key = config['PREPROCESSED_REPORT_TEXT_KEY']
+    for diagnosis in diagnoses:
+        progress(diagnosis, 'running')
 
-        results.append(aspect_result)
+    try:
+        embeddings, args = dataset_factory.get_embedding_tensor(config, config['RATIONALE_NET_ARGS'], logger)
+        args = args.replace(batch_size=args.pred_batch_size)
+        model_path = multitask.get_snapshot_path(args, name, organ)
+        fingerprint = snapshot_meta.get_train_fingerprint(
+            "".join(snapshot_meta.get_data_fingerprint(reports, d, text_key) for d in diagnoses), args,
+            {d: label_maps[d] for d in diagnoses}, embedding.get_embedding_identity(config, logger))
 
+        meta = snapshot_meta.load_meta(model_path)
+        if meta is not None and meta.get('fingerprint') == fingerprint:
+            logger.info("RN Wrapper: {} training data and args unchanged since {}, keeping multitask model".format(organ, meta['saved_at']))
+            results = meta['results']
+        else:
+            annotated = [i for i, r in enumerate(reports) if any(d in r for d in diagnoses)]
+            if len(annotated) == 0:
+                raise Exception("No data found for {}".format(organ))
+            featurized = dataset_factory.get_featurized_reports(
+                [reports[i] for i in annotated], args, text_key,
+                [token_ids[i] for i in annotated] if token_ids is not None else None)
+            targets = multitask.get_targets(featurized.reports, diagnoses, label_maps, text_key, args.max_length)
+            order = np.random.permutation(len(annotated))
+            split_indx = int(len(order) * args.train_split)
+
+            logger.info("RN Wrapper: Training multitask model for {} on {} reports".format(organ, len(annotated)))
+            model = multitask.MultiTaskModel(embeddings, args, diagnoses, label_maps)
+            dev_stats, model = multitask.train_model(featurized, targets, order[:split_indx], order[split_indx:],
+                                                     model, args, logger)
+            results = [{'NAME': diagnosis,
+                        'ACCURACY': stats['accuracy'],
+                        'PRECISION': stats['precision'],
+                        'RECALL': stats['recall'],
+                        'F1': stats['f1']} for diagnosis, stats in zip(diagnoses, dev_stats)]
+
+            if not os.path.isdir(args.model_dir.format(name)):
+                os.makedirs(args.model_dir.format(name), exist_ok=True)
+            multitask.save_model(model, model_path, {'fingerprint': fingerprint,
+                                                     'results': results,
+                                                     'dev_stats': dev_stats})
+        success = True
+
+    except Exception as e:
+        logger.warn("RN Wrapper. {} multitask model failed to train! Exception {}".format(organ, e))
+        results = [get_failed_result(diagnosis) for diagnosis in diagnoses]
+        success = False
+
+    for diagnosis in diagnoses:
+        progress(diagnosis, 'done' if success else 'failed')
     return results
 
 
+def get_num_inference_workers(config, num_reports):
+    '''
+        returns:
+        - workers: number of processes to label num_reports in, the size of
+          the inference pool (see worker_pool.get_pool_size), 1 if there
+          are fewer than INFERENCE_SHARD_MIN_REPORTS
+    '''
+    if num_reports < config['INFERENCE_SHARD_MIN_REPORTS']:
+        return 1
+    return worker_pool.get_pool_size(worker_pool.INFERENCE, config)[0]
+
+
+def _predict(featurized, args, label_maps, embeddings, config, logger):
+    '''
+        returns:
+        - preds: predictions of the model of args for every report of
+          featurized, as train_utils.test_model
+    '''
+    gen, model = model_cache.get_model(args, embeddings, config, logger)
+    if config['LENGTH_BUCKETED_INFERENCE']:
+        return inference.test_model(featurized, model, gen, args)
+    test_data = dataset_factory.get_oncotext_dataset_test(featurized, label_maps, args)
+    return train_utils.test_model(test_data, model, gen, args)['preds']
+
+
+def _predict_multitask(featurized, args, embeddings, config, logger):
+    '''
+        returns:
+        - preds: predictions of every head of the multi-task model at
+          args.snapshot, see multitask.test_model
+    '''
+    _, model = model_cache.get_model(args, embeddings, config, logger,
+                                     load=lambda: (None, multitask.load_model(args.snapshot, args)))
+    return multitask.test_model(featurized, model, args)
+
+
+def _predict_shard_in_worker(task):
+    x, lengths, texts, organ, diagnosis, changes, use_multitask = task
+    state = worker_pool.worker_state
+    config = state['config']
+    text_key = config['PREPROCESSED_REPORT_TEXT_KEY']
+    label_maps = config['POST_DIAGNOSES'][organ]
+    embeddings, base_args = worker_pool.get_worker_embeddings()
+    # Pool workers are daemonic and can't start data loader workers
+    args = dataset_factory.get_task_args(base_args, label_maps, diagnosis, **dict(changes, num_workers=0))
+    featurized = oncotext.datasets.featurized_dataset.FeaturizedReports.from_token_tensor(
+                    base_args, [{text_key: text} for text in texts], text_key, x, lengths)
+    if use_multitask:
+        return _predict_multitask(featurized, args, embeddings, config, state['logger'])
+    return np.asarray(_predict(featurized, args, label_maps, embeddings, config, state['logger']))
+
+
+def _predict_sharded(pool, featurized, indices, organ, diagnosis, changes, config, use_multitask=False):
+    '''
+        Same as _predict (or _predict_multitask) on the reports of
+        featurized at indices, with the task args of diagnosis derived with
+        changes, run on contiguous shards of them in the processes of pool.
+        Each task only carries the token ids and texts of its shard.
+    '''
+    text_key = config['PREPROCESSED_REPORT_TEXT_KEY']
+    shards = [shard.tolist() for shard in np.array_split(np.asarray(indices), pool.workers) if len(shard) > 0]
+    tasks = []
+    for shard in shards:
+        subset = featurized.subset(shard)
+        tasks.append((subset.x, subset.lengths, [r[text_key] for r in subset.reports],
+                      organ, diagnosis, changes, use_multitask))
+    results = pool.map(_predict_shard_in_worker, tasks)
+    if use_multitask:
+        return {d: np.concatenate([preds[d] for preds in results]) for d in results[0]}
+    if config['POST_DIAGNOSES'][organ][diagnosis][0] == "NUM":
+        # Tagging preds may come back flat
+        return np.concatenate([np.reshape(preds, (len(shard), -1)) for preds, shard in zip(results, shards)])
+    return np.concatenate([np.reshape(preds, (len(shard),)) for preds, shard in zip(results, shards)])
+
+
+def get_labeled_diagnoses(organ, config):
+    '''
+        returns:
+        - diagnoses: every diagnosis label_reports can label for organ, the
+          diagnoses of the organs Meta reports are routed to included
+    '''
+    diagnoses = list(config['DIAGNOSES'][organ])
+    if organ == config['META_KEY'] and config['ORGAN_ROUTING']:
+        for routed_organ in postprocess.get_routed_organs(config):
+            diagnoses += [d for d in config['DIAGNOSES'][routed_organ] if d not in diagnoses]
+    return diagnoses
+
 
-def label_reports(name, organ, un_reports, config, logger):
-    args = config['RATIONALE_NET_ARGS']
+def label_reports(name, organ, un_reports, config, logger, token_ids=None, prediction_caches=None, progress=None, use_multitask=False):
+    '''
+        Label un_reports with every diagnosis model of organ. With
+        CASCADED_INFERENCE, fields generate_automatic_feilds overwrites
+        anyway are not predicted, see postprocess.get_inference_plan. With
+        ORGAN_ROUTING, reports of the Meta organ are then labeled with the
+        diagnosis models of every organ its organ classifiers predicted,
+        see postprocess.get_routed_organs.
+
+        params:
+        - prediction_caches: optional list of caches of earlier predictions
+          (e.g prediction_store.StoredPredictions), consulted in order. Only
+          reports without a cached prediction for the current snapshot are
+          run through a model, and new predictions are stored in every cache.
+        - progress: optional callback, see train
+        - use_multitask: label the diagnoses the organ's multi-task model
+          (see get_multitask_snapshot) has a head for with it, in a single
+          pass. The others are labeled by their own model.
+
+        With INFERENCE_WORKERS other than 1, models run on contiguous shards
+        of the reports in the inference pool, see _predict_sharded and
+        oncotext/worker_pool.py.
+
+        returns:
+        - labeled_reports: copies of un_reports with a label per diagnosis
+    '''
+    text_key = config['PREPROCESSED_REPORT_TEXT_KEY']
+    embeddings, base_args = dataset_factory.get_embedding_tensor(config, config['RATIONALE_NET_ARGS'], logger)
+    featurized = dataset_factory.get_featurized_reports(un_reports, base_args, text_key, token_ids)
+    labels_per_diagnosis = {}
+    indices = list(range(len(featurized)))
+
+    pool = None
+    if get_num_inference_workers(config, len(featurized)) > 1:
+        pool = worker_pool.get_pool(worker_pool.INFERENCE, config, logger)
+        logger.info("RN Wrapper: Labeling {} reports in {} processes".format(len(featurized), pool.workers))
+
+    _label_diagnoses(name, organ, featurized, indices, labels_per_diagnosis, config, logger,
+                     embeddings, base_args, prediction_caches, progress, use_multitask, pool)
+
+    if organ == config['META_KEY'] and config['ORGAN_ROUTING']:
+        for routed_organ in postprocess.get_routed_organs(config):
+            routed = [i for i in indices if labels_per_diagnosis[routed_organ][i] == '1']
+            logger.info("RN Wrapper: Routing {} of {} reports to {}".format(len(routed), len(indices), routed_organ))
+            if len(routed) > 0:
+                _label_diagnoses(name, routed_organ, featurized, routed, labels_per_diagnosis, config, logger,
+                                 embeddings, base_args, prediction_caches, progress, use_multitask, pool)
+
+    logger.info("RN Wrapper: model cache stats {}".format(model_cache.get_stats()))
+    return dataset_factory.apply_labels(un_reports, labels_per_diagnosis)
+
+
+def _label_diagnoses(name, organ, featurized, indices, labels_per_diagnosis, config, logger,
+                     embeddings, base_args, prediction_caches=None, progress=None, use_multitask=False, pool=None):
+    '''
+        Label the reports of featurized at indices with every diagnosis
+        model of organ, see label_reports.
+
+        params:
+        - labels_per_diagnosis: {diagnosis: list of labels aligned with
+          featurized}, None for reports that were not labeled. Updated in
+          place.
+        - pool: optional inference WorkerPool, used for diagnoses with at
+          least INFERENCE_SHARD_MIN_REPORTS reports to label
+    '''
     diagnoses = config['DIAGNOSES'][organ]
     label_maps = config['POST_DIAGNOSES'][organ]
     default_user = config['DEFAULT_USERNAME']
     text_key = config['PREPROCESSED_REPORT_TEXT_KEY']
-    embeddings = dataset_factory.get_embedding_tensor(config, args)
+    prediction_caches = prediction_caches or []
+    progress = progress or (lambda diagnosis, status: None)
+    engine = quantization.get_engine(config)
 
-    for indx, diagnosis in enumerate(diagnoses):
-        args.aspect = diagnosis
-        
-        if label_maps[args.aspect][0] == "NUM":
-            args.class_balance = False
-            args.use_as_tagger = True
-            args.num_class = args.num_tags
-        else:
-            args.class_balance = True
-            args.use_as_tagger = False
-            args.num_class = len(label_maps[diagnosis])
-
-        args.vocab_size = len(embeddings)
-        args.batch_size = args.pred_batch_size
-        if indx == 0:
-            test_data = dataset_factory.get_oncotext_dataset_test(un_reports, label_maps, args, text_key)
-        else:
-            test_data = dataset_factory.get_oncotext_dataset_test(test_data.dataset, label_maps, args, text_key)
+    if config['CASCADED_INFERENCE']:
+        plan = postprocess.get_inference_plan(organ, diagnoses, config)
+    else:
+        plan = [(diagnosis, None) for diagnosis in diagnoses]
 
-        logger.info("RN Wrapper: Start labeling reports for {}".format(diagnosis))
+    multitask_path = get_multitask_snapshot(name, organ, config, base_args) if use_multitask else None
+    multitask_diagnoses = multitask.get_diagnoses(multitask_path) if multitask_path is not None else []
+    if use_multitask and len(multitask_diagnoses) == 0:
+        logger.warn("RN Wrapper: No multitask model for {}, using the model of each diagnosis".format(organ))
+    # Predictions of every head over indices, computed on first use
+    multitask_preds = None
+    position = {i: k for k, i in enumerate(indices)}
 
-        snapshot_path = os.path.join( args.model_dir.format(name),
-                                        args.model_file.format(diagnosis))
-        if not os.path.exists(snapshot_path):
+    for diagnosis, gate in plan:
+        progress(diagnosis, 'running')
+
+        from_multitask = diagnosis in multitask_diagnoses
+        snapshot_path = os.path.join( base_args.model_dir.format(name),
+                                        base_args.model_file.format(diagnosis))
+        if from_multitask:
+            snapshot_path = multitask_path
+        elif not os.path.exists(snapshot_path):
             default_user_snapshot_path = os.path.join(
-                                        args.model_dir.format(default_user),
-                                        args.model_file.format(diagnosis))
+                                        base_args.model_dir.format(default_user),
+                                        base_args.model_file.format(diagnosis))
             logger.warn("RN Wrapper: {} model files dont exit! Using default user {} instead".format(name, default_user))
-            args.snapshot = default_user_snapshot_path
-        else:
-            args.snapshot = snapshot_path
+            snapshot_path = default_user_snapshot_path
+
+        fingerprint = model_cache.get_prediction_fingerprint(snapshot_path, base_args, config, logger)
+        # Organs reports are routed to may share diagnoses
+        labels = labels_per_diagnosis.setdefault(diagnosis, [None] * len(featurized))
+        todo = list(indices)
+        num_skipped = 0
+        if gate is not None:
+            is_needed, skip_label = gate
+            needed = []
+            for i in todo:
+                if is_needed(labels_per_diagnosis, i):
+                    needed.append(i)
+                else:
+                    labels[i] = skip_label
+            num_skipped = len(todo) - len(needed)
+            todo = needed
+        if fingerprint is not None:
+            for cache in prediction_caches:
+                cached = cache.lookup(diagnosis, fingerprint, todo)
+                for i, label in cached.items():
+                    labels[i] = label
+                todo = [i for i in todo if i not in cached]
+
+        logger.info("RN Wrapper: Start labeling {} reports for {}, {} cached, {} skipped".format(
+                    len(todo), diagnosis, len(indices) - len(todo) - num_skipped, num_skipped))
+        if len(todo) == 0:
+            progress(diagnosis, 'done')
+            continue
+
+        bucketed = config['LENGTH_BUCKETED_INFERENCE']
+        changes = {'snapshot': snapshot_path,
+                   'batch_size': base_args.pred_batch_size,
+                   # Quantized models only run on cpu
+                   'cuda': base_args.cuda if engine == quantization.FP32 else False,
+                   # Starting loader workers takes longer than labeling a single batch
+                   'num_workers': 0 if bucketed or len(todo) <= base_args.pred_batch_size else base_args.num_workers}
+        args = dataset_factory.get_task_args(base_args, label_maps, diagnosis, **changes)
+        todo_featurized = featurized if len(todo) == len(featurized) else featurized.subset(todo)
 
         try:
             if not os.path.exists(args.snapshot):
                 raise Exception("No trained model exists at {}".format(args.snapshot))
-            gen, model = model_utils.get_model(args, embeddings, None)
-            test_stats  = train_utils.test_model(test_data, model, gen, args)
-            preds = test_stats['preds']
+            if from_multitask:
+                if multitask_preds is None:
+                    if pool is not None and len(indices) >= config['INFERENCE_SHARD_MIN_REPORTS']:
+                        multitask_preds = _predict_sharded(pool, featurized, indices, organ, diagnosis, changes,
+                                                           config, use_multitask=True)
+                    else:
+                        multitask_preds = _predict_multitask(featurized.subset(indices), args, embeddings, config, logger)
+                preds = multitask_preds[diagnosis][[position[i] for i in todo]]
+            elif pool is not None and len(todo) >= config['INFERENCE_SHARD_MIN_REPORTS']:
+                preds = _predict_sharded(pool, featurized, todo, organ, diagnosis, changes, config)
+            else:
+                preds = _predict(todo_featurized, args, label_maps, embeddings, config, logger)
+            model_failed = False
             
         except Exception as e:
             logger.warn("RN Wrapper. {} model failed to label reports! Following Exception({}). Populating all reports with 0 label".format(diagnosis, e))
-            preds = np.zeros(len(test_data), dtype=int)
+            preds = np.zeros(len(todo_featurized), dtype=int)
+            model_failed = True
 
-        test_data.dataset = dataset_factory.get_labels_from_predictions(preds, copy.deepcopy(test_data), label_maps, diagnosis, args, text_key, logger)
-        
-    return test_data.dataset
+        todo_labels = dataset_factory.get_labels_from_predictions(preds, todo_featurized, label_maps, diagnosis, args, text_key, logger)
+        for i, label in zip(todo, todo_labels):
+            labels[i] = label
+        if not model_failed and fingerprint is not None:
+            for cache in prediction_caches:
+                cache.store(diagnosis, fingerprint, dict(zip(todo, todo_labels)))
+        progress(diagnosis, 'failed' if model_failed else 'done')
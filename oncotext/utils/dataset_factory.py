@@ -1,15 +1,22 @@
 import random
 import oncotext.datasets.pathology_classification_dataset
 import oncotext.datasets.pathology_tagging_dataset
+import oncotext.datasets.featurized_dataset
+import oncotext.utils.embedding as embedding
+import oncotext.utils.tokenizer as tokenizer
 import pickle
 import numpy as np
 import pdb
 
-def get_oncotext_dataset_train(all_reports, label_maps, args, text_key):
-    reports = [r for r in all_reports if args.aspect in r ]
-    random.shuffle(reports)
-    if len(reports) == 0:
+def get_oncotext_dataset_train(all_reports, label_maps, args, text_key, token_ids=None):
+    if token_ids is None:
+        token_ids = [None] * len(all_reports)
+    pairs = [(r, ids) for r, ids in zip(all_reports, token_ids) if args.aspect in r ]
+    random.shuffle(pairs)
+    if len(pairs) == 0:
         raise Exception("No data found for {}".format(args.aspect))
+    reports = [r for r, ids in pairs]
+    token_ids = [ids for r, ids in pairs]
     split_indx = int(len(reports)* args.train_split)
     train_reports = reports[: split_indx]
     dev_reports = reports[split_indx:]
@@ -19,61 +26,120 @@ def get_oncotext_dataset_train(all_reports, label_maps, args, text_key):
     else:
         dataset_obj = oncotext.datasets.pathology_classification_dataset.PathologyClassificationDataset
         
-    train_data = dataset_obj(args, train_reports, label_maps, text_key, 'train')
-    dev_data = dataset_obj(args, dev_reports, label_maps, text_key, 'dev')
+    train_data = dataset_obj(args, train_reports, label_maps, text_key, 'train', token_ids[: split_indx])
+    dev_data = dataset_obj(args, dev_reports, label_maps, text_key, 'dev', token_ids[split_indx:])
     
     return train_data, dev_data
 
 
-def get_oncotext_dataset_test(reports, label_maps, args, text_key):
-    if label_maps[args.aspect][0] == "NUM":
-        dataset_obj = oncotext.datasets.pathology_tagging_dataset.PathologyTaggingDataset
-    else:
-        dataset_obj = oncotext.datasets.pathology_classification_dataset.PathologyClassificationDataset
-        
-    test_data = dataset_obj(args, reports, label_maps, text_key, 'test')        
+def get_featurized_reports(reports, args, text_key, token_ids=None):
+    return oncotext.datasets.featurized_dataset.FeaturizedReports(args, reports, text_key, token_ids)
+
+
+def get_oncotext_dataset_test(featurized, label_maps, args):
+    use_as_tagger = label_maps[args.aspect][0] == "NUM"
+    test_data = oncotext.datasets.featurized_dataset.PathologyTestDataset(featurized, use_as_tagger)
     return test_data
 
 
-def get_embedding_tensor(config, args):
-    embeddings =  pickle.load(open(config['EMBEDDING_PATH'],'rb'))
-    args.embedding_dim = embeddings.shape[1]
-    return embeddings
+def get_embedding_tensor(config, args, logger=None):
+    '''
+        returns:
+        - embeddings: the process wide embedding matrix
+        - args: copy of args with the embedding setup (embedding_dim,
+          vocab_size, hash_buckets, bucket_remap)
+    '''
+    embeddings = embedding.load_embeddings(config, logger)
+    remap = embedding.load_bucket_remap(config, logger)
+    args = args.replace(embedding_dim=embeddings.shape[1],
+                        vocab_size=len(embeddings),
+                        hash_buckets=len(remap) if remap is not None else len(embeddings),
+                        bucket_remap=remap)
+    return embeddings, args
+
+
+def get_task_args(args, label_maps, diagnosis, **changes):
+    '''
+        Args of the model of one diagnosis, derived from args without
+        changing them.
+    '''
+    use_as_tagger = label_maps[diagnosis][0] == "NUM"
+    return args.replace(aspect=diagnosis,
+                        use_as_tagger=use_as_tagger,
+                        class_balance=not use_as_tagger,
+                        num_class=args.num_tags if use_as_tagger else len(label_maps[diagnosis]),
+                        **changes)
 
 
-def get_labels_from_tagging_predictions(preds, test_data, diagnosis, args, text_key, logger):
+def get_ingest_tokenizer(config, logger):
+    '''
+        Tokenizer producing the raw bucket ids persisted next to reports at
+        ingest, for the current embeddings and max_length.
+    '''
+    num_buckets = embedding.get_num_buckets(config, logger)
+    max_length = config['RATIONALE_NET_CONFIG']['max_length']
+    return tokenizer.get_bucket_tokenizer(num_buckets, max_length)
+
+
+def get_labels_from_tagging_predictions(preds, featurized, diagnosis, args, text_key, logger):
     try:
-        preds = np.reshape(preds, (len(test_data), args.max_length))
+        preds = np.reshape(preds, (len(featurized), args.max_length))
     except Exception as e:
-        logger.warn("RN Wrapper. {} model returned incorrectly sized labels {}! Following Exception({}). Populating all reports with 0 label".format(diagnosis, (len(preds), len(test_data)), e))
-        preds = np.zeros((len(test_data), args.max_length), dtype=int)
+        logger.warn("RN Wrapper. {} model returned incorrectly sized labels {}! Following Exception({}). Populating all reports with 0 label".format(diagnosis, (len(preds), len(featurized)), e))
+        preds = np.zeros((len(featurized), args.max_length), dtype=int)
 
-    for i in range(len(test_data)):
+    labels = []
+    for i in range(len(featurized)):
         if 1 in preds[i]:
-            text = test_data.dataset[i][text_key].split()
+            text = featurized.reports[i][text_key].split()
             inds = np.where(preds[i] == 1)[0]
 
             prediction = ""
             for ind in inds:
                 if ind < len(text):
                     prediction += text[ind]
-            test_data.dataset[i][diagnosis] = prediction
+            labels.append(prediction)
         else:
-            test_data.dataset[i][diagnosis] = "0"
-    return test_data
-            
-def get_labels_from_classification_predictions(preds, test_data, label_maps, diagnosis, logger):
-    for i in range(len(test_data)):
+            labels.append("0")
+    return labels
+
+def get_labels_from_classification_predictions(preds, featurized, label_maps, diagnosis, logger):
+    labels = []
+    for i in range(len(featurized)):
         try:
-            prediction = label_maps[diagnosis][preds[i]]
-            test_data.dataset[i][diagnosis] = prediction
+            labels.append(label_maps[diagnosis][preds[i]])
         except Exception as e:
             logger.warn("RN Wrapper. {} model failed to return prediction".format(diagnosis))
-    return test_data
+            labels.append(None)
+    return labels
 
-def get_labels_from_predictions(preds, test_data, label_maps, diagnosis, args, text_key, logger):
+def get_labels_from_predictions(preds, featurized, label_maps, diagnosis, args, text_key, logger):
+    '''
+        returns:
+        - labels: one label per report in featurized, None where the model
+          failed to return a prediction
+    '''
     if label_maps[diagnosis][0] == "NUM":
-        test_data = get_labels_from_tagging_predictions(preds, test_data, diagnosis, args, text_key, logger)
+        labels = get_labels_from_tagging_predictions(preds, featurized, diagnosis, args, text_key, logger)
     else:
-        test_data = get_labels_from_classification_predictions(preds, test_data, label_maps, diagnosis, logger)
-    return test_data.dataset
+        labels = get_labels_from_classification_predictions(preds, featurized, label_maps, diagnosis, logger)
+    return labels
+
+def apply_labels(reports, labels_per_diagnosis):
+    '''
+        Write the predicted labels of every diagnosis into a single copy of
+        each report, leaving the input reports untouched.
+
+        params:
+        - reports: list of reports, in the order they were featurized
+        - labels_per_diagnosis: {diagnosis: list of labels aligned with reports}
+
+        returns:
+        - labeled_reports: list of new report dicts
+    '''
+    labeled_reports = [dict(r) for r in reports]
+    for diagnosis, labels in labels_per_diagnosis.items():
+        for report, label in zip(labeled_reports, labels):
+            if label is not None:
+                report[diagnosis] = label
+    return labeled_reports
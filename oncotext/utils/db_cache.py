@@ -0,0 +1,104 @@
+'''
+Process wide cache of report dbs loaded from the report store.
+
+Entries are keyed by (db kind, organ, user), hold the reports together with
+the token ids stored at ingest, read in one transaction, and are tagged with
+the shard version, so any write through report_store, or a change of the
+shard file by another process, invalidates them. Total size is capped by
+DB_CACHE_MAX_BYTES (measured in pickled bytes), evicting the least recently
+used entries first.
+
+Cached report dicts are shared between requests, callers must treat them as
+read only.
+'''
+
+import threading
+from collections import OrderedDict
+import oncotext.utils.report_store as report_store
+import pdb
+
+_cache = OrderedDict()
+_cache_bytes = 0
+_lock = threading.Lock()
+stats = {'hits': 0, 'misses': 0, 'evictions': 0}
+
+
+def _evict(max_bytes):
+    global _cache_bytes
+    while _cache_bytes > max_bytes and len(_cache) > 0:
+        key, (version, nbytes, reports) = _cache.popitem(last=False)
+        _cache_bytes -= nbytes
+        stats['evictions'] += 1
+
+
+def _load(config, key, version, loader, nbytes_fn, logger):
+    global _cache_bytes
+    with _lock:
+        if key in _cache and _cache[key][0] == version:
+            _cache.move_to_end(key)
+            stats['hits'] += 1
+            return _cache[key][2]
+        stats['misses'] += 1
+
+    logger.info("db_cache - loading {} from store".format(key))
+    value = loader()
+    nbytes = nbytes_fn(value)
+
+    max_bytes = config['DB_CACHE_MAX_BYTES']
+    with _lock:
+        if key in _cache:
+            _cache_bytes -= _cache.pop(key)[1]
+        if nbytes <= max_bytes:
+            _cache[key] = (version, nbytes, value)
+            _cache_bytes += nbytes
+            _evict(max_bytes)
+        else:
+            logger.info("db_cache - {} is larger than the cache, not caching".format(key))
+    return value
+
+
+def _nbytes(config, kind, organ, name, shard):
+    _, token_ids, _ = shard
+    return (report_store.get_shard_nbytes(config, kind, organ, name) +
+            sum(ids.nbytes for ids in token_ids if ids is not None))
+
+
+def load_db(config, kind, organ, name, hashing, logger):
+    '''
+        Same as report_store.load_shard, but served from memory while the
+        shard is unchanged. Reports and token ids come from the same read.
+
+        returns:
+        - reports: list of dicts, shared with other callers
+        - token_ids: aligned with reports, None if the shard was hashed
+          with a different setup than hashing
+    '''
+    version = report_store.get_shard_version(config, kind, organ, name)
+    if version is None:
+        return [], []
+    reports, token_ids, stored_hashing = _load(config, (kind, organ, name), version,
+                        lambda: report_store.load_shard(config, kind, organ, name),
+                        lambda shard: _nbytes(config, kind, organ, name, shard),
+                        logger)
+    if len(token_ids) > 0 and stored_hashing != hashing:
+        token_ids = None
+    return list(reports), list(token_ids) if token_ids is not None else None
+
+
+def load_reports(config, kind, organ, name, logger):
+    '''
+        Same as report_store.load_reports, see load_db.
+    '''
+    return load_db(config, kind, organ, name, None, logger)[0]
+
+
+def invalidate(kind=None, organ=None, name=None):
+    '''
+        Drop cached dbs matching all given fields, or everything if none
+        are given.
+    '''
+    global _cache_bytes
+    with _lock:
+        for key in list(_cache.keys()):
+            if all(want is None or want == have for want, have in zip((kind, organ, name), key[:3])):
+                _cache_bytes -= _cache.pop(key)[1]
@@ -0,0 +1,214 @@
+'''
+Process wide access to the hash embedding matrix.
+
+Embeddings are stored as a raw .npy file and memory mapped copy-on-write,
+so they are read from disk once per process and their pages are shared by
+every worker forked after loading. If the .npy file is missing we fall back
+to the legacy pickle at EMBEDDING_PATH, still loading it only once.
+
+If scripts/compact_embeddings.py has been run, only the rows of hash buckets
+seen in the report dbs are loaded, together with a bucket -> row remap that
+the datasets apply after hashing. Buckets never seen map to row 0, the
+padding row.
+'''
+
+import os
+import pickle
+import threading
+import contextlib
+import numpy as np
+import torch
+from sklearn.utils import murmurhash3_32
+import pdb
+
+_embeddings = {}
+_remaps = {}
+_identities = {}
+_lock = threading.Lock()
+
+
+def convert_pickle_to_npy(pickle_path, npy_path):
+    '''
+        Convert a pickled embedding matrix to a .npy file that can be memory
+        mapped.
+
+        returns:
+        - shape of the converted matrix
+    '''
+    embeddings = pickle.load(open(pickle_path, 'rb'))
+    embeddings = np.ascontiguousarray(embeddings)
+    _save_npy(npy_path, embeddings)
+    return embeddings.shape
+
+
+def _save_npy(path, array):
+    tmp_path = path + '.tmp.npy'
+    np.save(tmp_path, array)
+    os.replace(tmp_path, path)
+
+
+def is_compacted(config):
+    return os.path.exists(config['EMBEDDING_COMPACT_PATH']) and \
+        os.path.exists(config['EMBEDDING_REMAP_PATH'])
+
+
+def load_full_embeddings(config, logger=None):
+    '''
+        Load the full (num_buckets, embedding_dim) matrix, preferring the
+        memory mapped .npy.
+    '''
+    npy_path = config['EMBEDDING_NPY_PATH']
+    if os.path.exists(npy_path):
+        return np.load(npy_path, mmap_mode='c')
+    if logger is not None:
+        logger.warn("embedding - {} not found, loading pickle {} instead. Run scripts/convert_embeddings.py to memory map it".format(npy_path, config['EMBEDDING_PATH']))
+    return pickle.load(open(config['EMBEDDING_PATH'], 'rb'))
+
+
+def load_embeddings(config, logger=None):
+    '''
+        returns:
+        - embeddings: np.ndarray of shape (num_rows, embedding_dim), shared
+          by all callers in this process. Compacted if a compact table
+          exists.
+    '''
+    compacted = is_compacted(config)
+    key = config['EMBEDDING_COMPACT_PATH'] if compacted else config['EMBEDDING_NPY_PATH']
+    with _lock:
+        if key not in _embeddings:
+            if compacted:
+                paths = [key, config['EMBEDDING_REMAP_PATH']]
+                _embeddings[key] = np.load(key, mmap_mode='c')
+                _remaps[key] = np.load(config['EMBEDDING_REMAP_PATH'], mmap_mode='r')
+            else:
+                paths = [key if os.path.exists(key) else config['EMBEDDING_PATH']]
+                _embeddings[key] = load_full_embeddings(config, logger)
+                _remaps[key] = None
+            _identities[key] = _get_files_identity(paths)
+    return _embeddings[key]
+
+
+def _get_files_identity(paths):
+    identity = []
+    for path in paths:
+        stat = os.stat(path)
+        identity.append("{}:{}:{}".format(os.path.realpath(path), stat.st_mtime_ns, stat.st_size))
+    return "|".join(identity)
+
+
+def get_embedding_identity(config, logger=None):
+    '''
+        Identifies the embedding table and bucket remap this process loaded
+        (paths, mtimes and sizes at load time), e.g to tag predictions made
+        with them.
+    '''
+    load_embeddings(config, logger)
+    key = config['EMBEDDING_COMPACT_PATH'] if is_compacted(config) else config['EMBEDDING_NPY_PATH']
+    return _identities[key]
+
+
+def load_bucket_remap(config, logger=None):
+    '''
+        returns:
+        - remap: int32 array mapping hash bucket -> embedding row, or None
+          if embeddings are not compacted
+    '''
+    load_embeddings(config, logger)
+    key = config['EMBEDDING_COMPACT_PATH'] if is_compacted(config) else config['EMBEDDING_NPY_PATH']
+    return _remaps[key]
+
+
+def get_num_buckets(config, logger=None):
+    '''
+        Number of hash buckets tokens are hashed into, the row count of the
+        full (uncompacted) embedding matrix.
+    '''
+    remap = load_bucket_remap(config, logger)
+    if remap is not None:
+        return len(remap)
+    return len(load_embeddings(config, logger))
+
+
+def preload(config, logger):
+    '''
+        Load embeddings up front, e.g before forking server workers so that
+        they all share the mapping. Failures are only logged, requests will
+        retry the load.
+    '''
+    try:
+        embeddings = load_embeddings(config, logger)
+        logger.info("embedding - preloaded embeddings of shape {}".format(embeddings.shape))
+    except Exception as e:
+        logger.warn("embedding - could not preload embeddings. Exception {}".format(e))
+
+
+def collect_buckets(texts, num_buckets):
+    '''
+        returns:
+        - buckets: sorted int array of every hash bucket used by texts,
+          always including 0, the padding bucket
+    '''
+    buckets = set([0])
+    seen = set()
+    for text in texts:
+        for token in text.split():
+            if token in seen:
+                continue
+            seen.add(token)
+            buckets.add(murmurhash3_32(token, positive=True) % num_buckets)
+    return np.array(sorted(buckets), dtype=np.int64)
+
+
+def compact_embeddings(full_embeddings, buckets, compact_path, remap_path):
+    '''
+        Write the rows of buckets as a compact embedding matrix, and a
+        bucket -> row remap covering every bucket of full_embeddings.
+        Bucket 0 stays row 0, unseen buckets map to it.
+    '''
+    assert buckets[0] == 0
+    compact = np.ascontiguousarray(full_embeddings[buckets])
+    remap = np.zeros(len(full_embeddings), dtype=np.int32)
+    remap[buckets] = np.arange(len(buckets), dtype=np.int32)
+    _save_npy(compact_path, compact)
+    _save_npy(remap_path, remap)
+    return compact.shape
+
+
+def share_model_embeddings(models, embeddings):
+    '''
+        Point the frozen embedding layers of loaded snapshots at the process
+        wide embedding matrix. Snapshots carry their own copy of the
+        embeddings, possibly full sized, this swaps it for the shared (and
+        possibly compacted) one, matching the ids the datasets produce.
+    '''
+    shared = None
+    for model in models:
+        layer = getattr(model, 'embedding_layer', None)
+        if layer is None or layer.weight.requires_grad:
+            continue
+        if layer.weight.shape[1] != embeddings.shape[1]:
+            continue
+        if shared is None:
+            shared = torch.from_numpy(embeddings)
+        layer.weight.data = shared.to(layer.weight.device)
+        layer.num_embeddings = shared.shape[0]
+    return models
+
+
+@contextlib.contextmanager
+def without_frozen_embeddings(models):
+    '''
+        Empty the frozen embedding layers of models for the duration of the
+        block, e.g to save them without a copy of the embedding matrix.
+        share_model_embeddings fills them again after loading.
+    '''
+    layers = [getattr(model, 'embedding_layer', None) for model in models if model is not None]
+    layers = [layer for layer in layers if layer is not None and not layer.weight.requires_grad]
+    weights = [layer.weight.data for layer in layers]
+    for layer in layers:
+        layer.weight.data = layer.weight.data.new_empty((0, layer.weight.shape[1]))
+    try:
+        yield models
+    finally:
+        for layer, weight in zip(layers, weights):
+            layer.weight.data = weight
@@ -0,0 +1,176 @@
+'''
+Content addressed cache of model predictions, shared by every user.
+
+Entries are keyed by a hash of the segmented report text, organ, diagnosis
+and the prediction fingerprint of the snapshot that labeled it (see
+model_cache.get_prediction_fingerprint), so the same report
+segment is never run through the same model twice, whichever user
+submitted it (e.g users falling back to the default user's models). The
+cache is a single sqlite db at INFERENCE_CACHE_PATH, its size is capped by
+INFERENCE_CACHE_MAX_BYTES (counted as key + label bytes), evicting the least
+recently used entries first. Setting INFERENCE_CACHE_MAX_BYTES to 0
+disables it.
+
+Statements stick to what the sqlite of the docker image (3.11) parses, e.g
+no upsert: store updates existing entries, then inserts the others. A hit
+only refreshes the last use of an entry when it is older than
+TOUCH_INTERVAL seconds, so lookups are read only most of the time.
+'''
+
+import time
+import hashlib
+import sqlite3
+import pdb
+
+SCHEMA = '''
+    CREATE TABLE IF NOT EXISTS inferences (
+        key TEXT PRIMARY KEY,
+        label TEXT NOT NULL,
+        nbytes INTEGER NOT NULL,
+        last_used REAL NOT NULL
+    );
+    CREATE INDEX IF NOT EXISTS inferences_by_last_used ON inferences (last_used);
+    CREATE TABLE IF NOT EXISTS totals (
+        id INTEGER PRIMARY KEY CHECK (id = 0),
+        nbytes INTEGER NOT NULL
+    );
+    INSERT OR IGNORE INTO totals VALUES (0, 0);
+    CREATE TRIGGER IF NOT EXISTS inferences_insert AFTER INSERT ON inferences BEGIN
+        UPDATE totals SET nbytes = nbytes + NEW.nbytes;
+    END;
+    CREATE TRIGGER IF NOT EXISTS inferences_update AFTER UPDATE OF nbytes ON inferences BEGIN
+        UPDATE totals SET nbytes = nbytes + NEW.nbytes - OLD.nbytes;
+    END;
+    CREATE TRIGGER IF NOT EXISTS inferences_delete AFTER DELETE ON inferences BEGIN
+        UPDATE totals SET nbytes = nbytes - OLD.nbytes;
+    END;
+'''
+# INSERT OR REPLACE would delete the old row without firing
+# inferences_delete, the totals would drift
+UPDATE = 'UPDATE inferences SET label = ?, nbytes = ?, last_used = ? WHERE key = ?'
+INSERT = 'INSERT OR IGNORE INTO inferences VALUES (?, ?, ?, ?)'
+# Max number of sqlite parameters per query
+CHUNK_SIZE = 500
+# Evict down to this fraction of the cap, so eviction does not run on every
+# store once the cache is full
+EVICT_TO = 0.9
+# Age in seconds after which a hit refreshes the last use of an entry
+TOUCH_INTERVAL = 3600
+
+
+_initialized = set()
+
+
+def connect(path):
+    conn = sqlite3.connect(path, timeout=60)
+    # Losing the last writes on power loss is fine for a cache
+    conn.execute('PRAGMA synchronous=NORMAL')
+    if path not in _initialized:
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.executescript(SCHEMA)
+        _initialized.add(path)
+    return conn
+
+
+def _chunks(items):
+    for start in range(0, len(items), CHUNK_SIZE):
+        yield items[start:start + CHUNK_SIZE]
+
+
+def is_enabled(config):
+    return config['INFERENCE_CACHE_MAX_BYTES'] > 0
+
+
+def get_stats(config):
+    conn = connect(config['INFERENCE_CACHE_PATH'])
+    try:
+        entries = conn.execute('SELECT COUNT(*) FROM inferences').fetchone()[0]
+        nbytes = conn.execute('SELECT nbytes FROM totals').fetchone()[0]
+    finally:
+        conn.close()
+    return {'entries': entries, 'bytes': nbytes}
+
+
+class InferenceCache(object):
+    '''
+        Prediction cache over a list of reports of organ, as consulted by
+        rationale_net_wrapper.label_reports. Reports are addressed by their
+        index in reports.
+    '''
+
+    def __init__(self, config, organ, reports, text_key):
+        self.path = config['INFERENCE_CACHE_PATH']
+        self.max_bytes = config['INFERENCE_CACHE_MAX_BYTES']
+        self.organ = organ
+        self.text_hashes = [hashlib.sha1(r[text_key].encode('utf-8')).hexdigest() for r in reports]
+
+    def _key(self, i, diagnosis, fingerprint):
+        key = "\0".join([self.organ, diagnosis, fingerprint, self.text_hashes[i]])
+        return hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+    def lookup(self, diagnosis, fingerprint, indices):
+        '''
+            returns:
+            - labels: {index: label} for the reports of indices whose text
+              was labeled earlier by the snapshot fingerprint
+        '''
+        indices_by_key = {}
+        for i in indices:
+            indices_by_key.setdefault(self._key(i, diagnosis, fingerprint), []).append(i)
+        keys = list(indices_by_key.keys())
+
+        labels = {}
+        now = time.time()
+        stale = []
+        conn = connect(self.path)
+        try:
+            for chunk in _chunks(keys):
+                rows = conn.execute('SELECT key, label, last_used FROM inferences WHERE key IN ({})'.format(
+                                    ','.join('?' * len(chunk))), chunk).fetchall()
+                for key, label, last_used in rows:
+                    for i in indices_by_key[key]:
+                        labels[i] = label
+                    if now - last_used > TOUCH_INTERVAL:
+                        stale.append((now, key))
+            if len(stale) > 0:
+                with conn:
+                    conn.executemany('UPDATE inferences SET last_used = ? WHERE key = ?', stale)
+        finally:
+            conn.close()
+        return labels
+
+    def store(self, diagnosis, fingerprint, labels):
+        '''
+            params:
+            - labels: {index: label}, None labels are not stored
+        '''
+        now = time.time()
+        rows = {}
+        for i, label in labels.items():
+            if label is None:
+                continue
+            key = self._key(i, diagnosis, fingerprint)
+            rows[key] = (label, len(key) + len(label.encode('utf-8')), now)
+
+        conn = connect(self.path)
+        try:
+            with conn:
+                conn.executemany(UPDATE, [row + (key,) for key, row in rows.items()])
+                conn.executemany(INSERT, [(key,) + row for key, row in rows.items()])
+                self._evict(conn)
+        finally:
+            conn.close()
+
+    def _evict(self, conn):
+        total = conn.execute('SELECT nbytes FROM totals').fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        target = total - int(self.max_bytes * EVICT_TO)
+        freed = 0
+        evicted = []
+        for key, nbytes in conn.execute('SELECT key, nbytes FROM inferences ORDER BY last_used'):
+            if freed >= target:
+                break
+            evicted.append((key,))
+            freed += nbytes
+        conn.executemany('DELETE FROM inferences WHERE key = ?', evicted)
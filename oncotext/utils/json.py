@@ -15,4 +15,9 @@ def make_json_compliant(data):
     return data
 
 
-
+def make_report_json_compliant(report):
+    '''
+        Same as make_json_compliant for a single report, returning a copy
+        instead of changing report in place.
+    '''
+    return make_json_compliant([dict(report)])[0]
@@ -0,0 +1,156 @@
+'''
+Process wide LRU cache of loaded model snapshots.
+
+Entries are keyed by snapshot path and mtime, so retraining a model
+invalidates it, and users falling back to the default user's snapshots
+share the default user's entries. The total size of cached parameters is
+capped by MODEL_CACHE_MAX_BYTES. The embedding layers point at the shared
+embedding matrix and are not counted. Snapshots are loaded for the
+INFERENCE_ENGINE of the config, see oncotext/utils/quantization.py.
+'''
+
+import os
+import hashlib
+import threading
+from collections import OrderedDict
+import torch
+import rationale_net.utils.model as model_utils
+import oncotext.utils.embedding as embedding
+import oncotext.utils.quantization as quantization
+import pdb
+
+_cache = OrderedDict()
+_cache_bytes = 0
+_lock = threading.Lock()
+stats = {'hits': 0, 'misses': 0, 'evictions': 0}
+
+
+def _model_nbytes(models):
+    nbytes = 0
+    for model in models:
+        if model is None:
+            continue
+        # Quantized layers keep their weights in packed params, only in the
+        # state dict
+        for key, value in model.state_dict().items():
+            if key.startswith('embedding_layer.'):
+                continue
+            for tensor in (value if isinstance(value, tuple) else [value]):
+                if torch.is_tensor(tensor):
+                    nbytes += tensor.numel() * tensor.element_size()
+    return nbytes
+
+
+def _evict(max_bytes):
+    global _cache_bytes
+    while _cache_bytes > max_bytes and len(_cache) > 0:
+        key, (nbytes, gen, model) = _cache.popitem(last=False)
+        _cache_bytes -= nbytes
+        stats['evictions'] += 1
+
+
+def get_snapshot_fingerprint(snapshot_path):
+    '''
+        Identifies the version of a snapshot on disk, e.g to tag
+        predictions made with it.
+
+        returns:
+        - fingerprint: hex string, None if the snapshot does not exist
+    '''
+    try:
+        stat = os.stat(snapshot_path)
+    except OSError:
+        return None
+    key = "{}:{}:{}".format(os.path.realpath(snapshot_path), stat.st_mtime_ns, stat.st_size)
+    return hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+
+def get_prediction_fingerprint(snapshot_path, args, config, logger=None):
+    '''
+        Identifies everything predictions of a snapshot depend on: the
+        snapshot version, the embedding table and bucket remap it runs with,
+        the max_length reports are hashed to, the inference mode and the
+        engine. Predictions cached under one fingerprint stay valid as long
+        as none of these change.
+
+        returns:
+        - fingerprint: hex string, None if the snapshot does not exist
+    '''
+    snapshot_fingerprint = get_snapshot_fingerprint(snapshot_path)
+    if snapshot_fingerprint is None:
+        return None
+    key = "{}:{}:{}:{}:{}".format(snapshot_fingerprint,
+                                  embedding.get_embedding_identity(config, logger),
+                                  args.max_length,
+                                  config['LENGTH_BUCKETED_INFERENCE'],
+                                  quantization.get_engine(config))
+    return hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+
+def _load_quantized(args, engine, logger, load):
+    '''
+        Load the converted snapshot saved for this version of args.snapshot,
+        converting and saving it first if there is none.
+    '''
+    fingerprint = get_snapshot_fingerprint(args.snapshot)
+    models = quantization.load_quantized(args.snapshot, engine, fingerprint)
+    if models is not None:
+        return models
+
+    logger.info("model_cache - converting snapshot {} to {}".format(args.snapshot, engine))
+    gen, model = quantization.quantize_models(load())
+    try:
+        quantization.save_quantized(args.snapshot, engine, fingerprint, gen, model)
+    except Exception as e:
+        logger.warn("model_cache - could not save converted snapshot {}. Exception {}".format(args.snapshot, e))
+    return gen, model
+
+
+def get_model(args, embeddings, config, logger, load=None):
+    '''
+        Load the snapshot at args.snapshot, or reuse it if it is cached and
+        unchanged on disk.
+
+        params:
+        - load: optional function returning the fp32 gen, model of
+          args.snapshot, model_utils.get_model by default
+
+        returns:
+        - gen, model: as model_utils.get_model, shared with other callers
+    '''
+    global _cache_bytes
+    engine = quantization.get_engine(config)
+    key = (os.path.realpath(args.snapshot), os.stat(args.snapshot).st_mtime_ns, embeddings.shape, engine)
+
+    with _lock:
+        if key in _cache:
+            _cache.move_to_end(key)
+            stats['hits'] += 1
+            nbytes, gen, model = _cache[key]
+            return gen, model
+        stats['misses'] += 1
+
+    logger.info("model_cache - loading snapshot {} for {}".format(args.snapshot, engine))
+    load = load or (lambda: model_utils.get_model(args, embeddings, None))
+    if engine == quantization.FP32:
+        gen, model = load()
+    else:
+        gen, model = _load_quantized(args, engine, logger, load)
+    embedding.share_model_embeddings([gen, model], embeddings)
+    nbytes = _model_nbytes([gen, model])
+
+    max_bytes = config['MODEL_CACHE_MAX_BYTES']
+    with _lock:
+        # Drop entries of older versions of the same snapshot
+        for old_key in [k for k in _cache if k[0] == key[0] and k[3] == key[3]]:
+            _cache_bytes -= _cache.pop(old_key)[0]
+        if nbytes <= max_bytes:
+            _cache[key] = (nbytes, gen, model)
+            _cache_bytes += nbytes
+            _evict(max_bytes)
+    return gen, model
+
+
+def get_stats():
+    with _lock:
+        return dict(stats, entries=len(_cache), bytes=_cache_bytes)
@@ -1,60 +1,67 @@
 from operator import itemgetter
 import pickle
 from oncotext.utils.generic import hasCat
+import oncotext.utils.report_store as report_store
 import datetime
 import pdb
 
-def prune_non_breast(reportDB, name, config, logger):
-    logger.info("prune_non_breast - Loading non breast reports")
-    if os.path.exists(config['DB_NON_BREAST_PATH']):
-        non_breast_db = pickle.load(open(config['DB_NON_BREAST_PATH'],'rb'))
-    else:
-        non_breast_db = {name: []}
+def prune_non_breast(reportDB, name, organ, config, logger):
+    '''
+        Move reports predicted as non breast out of the user's unlabeled
+        shard and into their non breast shard. Only the shards of
+        (organ, name) are read and written. Token ids stored with the
+        reports move along with them.
+    '''
     logger.info("prune_non_breast - Loading db_unlabeled reports")
-    db_unlabeled = pickle.load(open(config['DB_UNLABLED_PATH'],'rb'))
+    db_unlabeled, token_ids, hashing = report_store.load_shard(config, report_store.UNLABELED, organ, name)
 
     id_to_report = { r['ID']: r for r in reportDB }
     prune_key = config['PRUNE_KEY']
-    count = 0
 
     def prune(report):
         return report[prune_key] == '0'
 
-    pruned_db_unlabeled = [r for r in db_unlabeled[name]
-                if not prune(id_to_report[r['ID']])
-            ]
-    new_non_breast_db = [r for r in db_unlabeled[name]
-                if prune(id_to_report[r['ID']])
-            ]
+    pruned = [prune(id_to_report[r['ID']]) for r in db_unlabeled]
+    pruned_db_unlabeled = [r for r, p in zip(db_unlabeled, pruned) if not p]
+    pruned_token_ids = [ids for ids, p in zip(token_ids, pruned) if not p]
+    new_non_breast_db = [r for r, p in zip(db_unlabeled, pruned) if p]
+    new_non_breast_token_ids = [ids for ids, p in zip(token_ids, pruned) if p]
 
-    non_breast_db[name].extend(new_non_breast_db)
+    report_store.replace_reports(config, report_store.UNLABELED, organ, name, pruned_db_unlabeled,
+                                 pruned_token_ids, hashing)
+    num_non_breast = report_store.add_reports(config, report_store.NON_BREAST, organ, name, new_non_breast_db,
+                                              new_non_breast_token_ids, hashing)
 
     logger.info(
             "prune_non_breast - Pruned db_unlabeled ({}) to breast {} and non {}. Total non breast {}".format(
-                        len(db_unlabeled[name]),
+                        len(db_unlabeled),
                         len(pruned_db_unlabeled),
                         len(new_non_breast_db),
-                        len(non_breast_db[name])
+                        num_non_breast
                         )
             )
-    db_unlabeled[name] = pruned_db_unlabeled
-
-    pickle.dump(db_unlabeled, open(config['DB_UNLABLED_PATH'],'wb'))
-    pickle.dump(non_breast_db, open(config['DB_NON_BREAST_PATH'],'wb'))
 
     prune_report_db = [r for r in reportDB if not prune(r)]
 
     return prune_report_db
 
-def apply_corrections(reportDB, trainDB, config, logger):
+def get_correction_map(trainDB, config):
+    '''
+        returns:
+        - textToLabel: {segmented text: train report}, see apply_corrections
+    '''
     text_key = config['PREPROCESSED_REPORT_TEXT_KEY']
-    diagnoses = config['DIAGNOSES']
-    corrections = 0
-    num_match = 0
     textToLabel = {}
 
     for g in trainDB:
         textToLabel[g[text_key]] = g
+    return textToLabel
+
+def apply_corrections(reportDB, textToLabel, config, logger):
+    text_key = config['PREPROCESSED_REPORT_TEXT_KEY']
+    diagnoses = config['DIAGNOSES']
+    corrections = 0
+    num_match = 0
 
     for t in reportDB:
         text = t[text_key]
@@ -72,6 +79,17 @@ def apply_corrections(reportDB, trainDB, config, logger):
 
     return reportDB
 
+def get_routed_organs(config):
+    '''
+        Organs the organ classifiers of the Meta organ route reports to:
+        Meta diagnoses named after an organ with diagnoses of its own, e.g
+        PRUNE_KEY.
+    '''
+    meta_key = config['META_KEY']
+    return [o for o in config['DIAGNOSES'][meta_key]
+            if o != meta_key and len(config['DIAGNOSES'].get(o, {})) > 0]
+
+
 # Runs enforces global constraints like ER/PR NA given no cancer
 def generate_automatic_feilds(reportDB, organ, config):
 
@@ -117,10 +135,53 @@ def generate_automatic_feilds(reportDB, organ, config):
                 numerical = [k for k in config['POST_DIAGNOSES']['OrganProstate'] if config['POST_DIAGNOSES']['OrganProstate'][k] == ["NUM"]]
                 for k in numerical:
                     r[k] = '0'
+
+    elif organ == config['META_KEY'] and config['ORGAN_ROUTING']:
+        # Reports were labeled by the models of the organs they were routed
+        # to. Pick them by those labels, not by their organ label, which
+        # train reports may have corrected since.
+        for routed_organ in get_routed_organs(config):
+            diagnoses = config['DIAGNOSES'][routed_organ]
+            generate_automatic_feilds([r for r in reportDB if all(d in r for d in diagnoses)], routed_organ, config)
                 
     return reportDB
 
 
+def get_inference_plan(organ, diagnoses, config):
+    '''
+        Order in which to run the diagnosis models of organ, so the fields
+        generate_automatic_feilds overwrites anyway are only predicted where
+        their value can matter: breast markers where a cancer is predicted,
+        grades where DCIS / CancerInvasive is, numerical prostate fields
+        where ProstateCa is. Diagnoses without a gate come first.
+
+        returns:
+        - plan: list of (diagnosis, gate). gate is None, or (is_needed,
+          skip_label), is_needed(labels_per_diagnosis, i) tells from the
+          labels of the diagnoses earlier in the plan whether report i needs
+          the model, the others get skip_label
+    '''
+    diagnoses = list(diagnoses)
+    gates = {}
+    if organ == 'OrganBreast':
+        if all(c in diagnoses for c in config['CANCERS']):
+            def has_cancer(labels, i):
+                return any(labels[c][i] == '1' for c in config['CANCERS'])
+            for k in config['MARKERS']:
+                gates[k] = (has_cancer, '9')
+
+        for grade, cancer in [('GradeMaxDCIS', 'DCIS'), ('GradeMaxInvasive', 'CancerInvasive')]:
+            if cancer in diagnoses:
+                gates[grade] = (lambda labels, i, cancer=cancer: labels[cancer][i] != '0', '9')
+
+    elif organ == "OrganProstate" and 'ProstateCa' in diagnoses:
+        numerical = [k for k in config['POST_DIAGNOSES']['OrganProstate'] if config['POST_DIAGNOSES']['OrganProstate'][k] == ["NUM"]]
+        for k in numerical:
+            gates[k] = (lambda labels, i: labels['ProstateCa'][i] != '0', '0')
+
+    return [(d, None) for d in diagnoses if d not in gates] + [(d, gates[d]) for d in diagnoses if d in gates]
+
+
 def aggregate_episodes_breast(reports, config):
 
     patientDict = {}
@@ -204,14 +265,29 @@ def aggregate_episodes(reports, organ, config, logger):
         return reports
     
     
-def apply_rules(reportDB, trainDB, organ, config, logger):
+def needs_whole_db(organ):
+    '''
+        Whether apply_rules looks across reports for organ (episodes are
+        aggregated per patient), so reports can't be postprocessed in
+        chunks.
+    '''
+    return organ == 'OrganBreast'
+
+
+def apply_rules(reportDB, trainDB, organ, config, logger, textToLabel=None):
     '''
         - Match up predicted labels with train ones, and correct errors
         - Procedurally create labels for things like cancer/atypia
         - Aggregate into episodes
+
+        params:
+        - textToLabel: optional correction map of trainDB, see
+          get_correction_map, to reuse it across calls
     '''
+    if textToLabel is None:
+        textToLabel = get_correction_map(trainDB, config)
     logger.info("postprocess - apply corrections")
-    reportDB = apply_corrections(reportDB, trainDB, config, logger)
+    reportDB = apply_corrections(reportDB, textToLabel, config, logger)
     logger.info("postprocess - generate automatic fields")
     reportDB = generate_automatic_feilds(reportDB, organ, config)
     logger.info("postprocess - aggregate episodes")
@@ -0,0 +1,96 @@
+'''
+Predictions made on a user's stored reports, persisted between /predict
+calls.
+
+Predictions live in a sidecar sqlite db next to the user's shard (see
+report_store.get_predictions_path), so writing them does not invalidate the
+cached reports. Rows are keyed by report key (report ID + hash of the
+segmented text) and diagnosis, and tagged with the prediction fingerprint of
+the snapshot that produced them (see model_cache.get_prediction_fingerprint).
+A prediction is only reused while the snapshot, embeddings and inference
+setup are unchanged, storing predictions of a new fingerprint drops those of
+older ones.
+'''
+
+import os
+import hashlib
+import sqlite3
+import oncotext.utils.report_store as report_store
+import pdb
+
+SCHEMA = '''
+    CREATE TABLE IF NOT EXISTS predictions (
+        report_key TEXT NOT NULL,
+        diagnosis TEXT NOT NULL,
+        fingerprint TEXT NOT NULL,
+        label TEXT NOT NULL,
+        PRIMARY KEY (report_key, diagnosis)
+    );
+'''
+
+
+def get_report_key(report, text_key):
+    '''
+        Identifies a report by its ID and segmented text, so a report that
+        is re-uploaded with edited text is labeled again.
+    '''
+    text_hash = hashlib.sha1(report[text_key].encode('utf-8')).hexdigest()
+    return "{}:{}".format(report.get(report_store.ID_KEY), text_hash)
+
+
+def connect(path):
+    conn = sqlite3.connect(path, timeout=60)
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.executescript(SCHEMA)
+    return conn
+
+
+class StoredPredictions(object):
+    '''
+        Prediction cache over the reports of one user shard, as consulted by
+        rationale_net_wrapper.label_reports. Reports are addressed by their
+        index in reports.
+    '''
+
+    def __init__(self, config, kind, organ, name, reports, text_key):
+        self.path = report_store.get_predictions_path(config, kind, organ, name)
+        self.keys = [get_report_key(r, text_key) for r in reports]
+
+    def lookup(self, diagnosis, fingerprint, indices):
+        '''
+            returns:
+            - labels: {index: label} for the reports of indices predicted
+              earlier with the snapshot fingerprint
+        '''
+        if not os.path.exists(self.path):
+            return {}
+        conn = connect(self.path)
+        try:
+            rows = conn.execute('SELECT report_key, label FROM predictions WHERE diagnosis = ? AND fingerprint = ?',
+                                (diagnosis, fingerprint))
+            stored = dict(rows.fetchall())
+        finally:
+            conn.close()
+        labels = {}
+        for i in indices:
+            if self.keys[i] in stored:
+                labels[i] = stored[self.keys[i]]
+        return labels
+
+    def store(self, diagnosis, fingerprint, labels):
+        '''
+            params:
+            - labels: {index: label}, None labels are not stored
+        '''
+        rows = [(self.keys[i], diagnosis, fingerprint, label)
+                for i, label in labels.items() if label is not None]
+        if not os.path.isdir(os.path.dirname(self.path)):
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        conn = connect(self.path)
+        try:
+            with conn:
+                conn.execute('DELETE FROM predictions WHERE diagnosis = ? AND fingerprint != ?',
+                             (diagnosis, fingerprint))
+                conn.executemany('INSERT OR REPLACE INTO predictions VALUES (?, ?, ?, ?)', rows)
+        finally:
+            conn.close()
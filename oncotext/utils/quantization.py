@@ -0,0 +1,99 @@
+'''
+Dynamically quantized CPU inference.
+
+With INFERENCE_ENGINE set to 'int8', the Linear and recurrent layers of
+loaded snapshots are converted to int8 weights with
+torch.quantization.quantize_dynamic, activations are quantized on the fly.
+The conversion runs once per snapshot version: the converted modules are
+saved next to the snapshot, e.g oncotext_ER.int8.pt next to oncotext_ER.pt,
+tagged with the fingerprint of the source snapshot, and reloaded as long as
+it matches. Frozen embedding layers stay in fp32, are not saved in the
+converted file and point at the shared embedding matrix like any other
+loaded model.
+
+Scope: dynamic quantization only covers Linear and recurrent layers. Conv
+layers are not converted and stay in fp32, and for the cnn encoders of the
+per diagnosis models (and the multi-task model) the convs over every token
+are where nearly all the compute is: only the small hidden and output
+layers on top of the pooled features run in int8. Expect little speedup
+for cnn snapshots, mainly smaller Linear weights, and a real one only for
+rnn encoders. scripts/evaluate_quantization.py measures, per diagnosis, the
+accuracy delta on the held out dev split saved at training, the share of
+parameters converted and the speedup, check it before switching engines.
+'''
+
+import os
+import tempfile
+import torch
+import oncotext.utils.embedding as embedding
+import pdb
+
+FP32 = 'fp32'
+INT8 = 'int8'
+ENGINES = [FP32, INT8]
+
+QUANTIZED_LAYERS = {torch.nn.Linear, torch.nn.LSTM, torch.nn.GRU}
+
+
+def get_engine(config):
+    engine = config['INFERENCE_ENGINE']
+    if engine not in ENGINES:
+        raise Exception("Unknown INFERENCE_ENGINE {}, expected one of {}".format(engine, ENGINES))
+    return engine
+
+
+def get_quantized_path(snapshot_path, engine):
+    return "{}.{}.pt".format(os.path.splitext(snapshot_path)[0], engine)
+
+
+def quantize_models(models):
+    '''
+        returns:
+        - models: quantized copies of models, on cpu in eval mode
+    '''
+    quantized = []
+    for model in models:
+        if model is None:
+            quantized.append(None)
+            continue
+        model = model.cpu().eval()
+        quantized.append(torch.quantization.quantize_dynamic(model, QUANTIZED_LAYERS, dtype=torch.qint8))
+    return quantized
+
+
+def load_quantized(snapshot_path, engine, fingerprint):
+    '''
+        returns:
+        - gen, model: converted models saved by save_quantized for the
+          snapshot version fingerprint, None if there are none. Frozen
+          embedding layers are empty until shared.
+    '''
+    path = get_quantized_path(snapshot_path, engine)
+    if fingerprint is None or not os.path.exists(path):
+        return None
+    try:
+        saved = torch.load(path, map_location='cpu')
+    except Exception:
+        return None
+    if saved.get('source_fingerprint') != fingerprint:
+        return None
+    return saved['gen'], saved['model']
+
+
+def save_quantized(snapshot_path, engine, fingerprint, gen, model):
+    '''
+        Save converted models next to their snapshot, without the weights
+        of frozen embedding layers.
+    '''
+    path = get_quantized_path(snapshot_path, engine)
+    # Request threads and inference workers may convert the same snapshot
+    # at once, each writes its own file
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+    os.close(fd)
+    try:
+        with embedding.without_frozen_embeddings([gen, model]):
+            torch.save({'source_fingerprint': fingerprint, 'gen': gen, 'model': model}, tmp_path)
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
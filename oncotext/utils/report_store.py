@@ -0,0 +1,372 @@
+'''
+Append-only report store backed by sqlite.
+
+Every (db kind, organ, user) gets its own shard file under REPORT_STORE_DIR,
+e.g. report_store/reportDBAPI_train_OrganBreast/<user>.db, so a request only
+ever touches the caller's own data. Reports are kept as pickled rows keyed
+by report ID, and adding a batch only costs as much as the batch itself.
+Rows can also carry the hashed token ids of the report, computed once at
+ingest. Organs and users are listed from the shard directories themselves,
+so writes to different shards never contend on a shared file.
+'''
+
+import os
+import sqlite3
+import pickle
+import threading
+from urllib.parse import quote, unquote
+import numpy as np
+import pdb
+
+TRAIN = 'train'
+UNLABELED = 'unlabeled'
+NON_BREAST = 'non_breast'
+KINDS = [TRAIN, UNLABELED, NON_BREAST]
+
+DB_KIND_TO_CONFIG_KEY = {
+    TRAIN: 'DB_TRAIN_PATH',
+    UNLABELED: 'DB_UNLABLED_PATH',
+    NON_BREAST: 'DB_NON_BREAST_PATH'
+}
+
+SHARD_EXT = '.db'
+PREDICTIONS_DIR = 'predictions'
+ID_KEY = 'ID'
+
+SCHEMA = '''
+    CREATE TABLE IF NOT EXISTS reports (
+        seq INTEGER PRIMARY KEY AUTOINCREMENT,
+        report_id TEXT,
+        report BLOB NOT NULL,
+        token_ids BLOB
+    );
+    CREATE INDEX IF NOT EXISTS reports_by_id ON reports (report_id);
+    CREATE TABLE IF NOT EXISTS meta (
+        key TEXT PRIMARY KEY,
+        value TEXT
+    );
+'''
+HASHING_KEY = 'hashing'
+
+# Guards _shard_locks and _write_versions. Writes to a shard hold the lock
+# of its path only, so tenants never wait on each other.
+_lock = threading.Lock()
+_shard_locks = {}
+_write_versions = {}
+
+
+def _db_prefix(config, kind):
+    return os.path.splitext(os.path.basename(config[DB_KIND_TO_CONFIG_KEY[kind]]))[0]
+
+
+def get_shard_dir(config, kind, organ):
+    '''
+        Directory holding the per user shards of a db kind and organ, i.e
+        REPORT_STORE_DIR/reportDBAPI_train_<organ>
+    '''
+    return os.path.join(config['REPORT_STORE_DIR'], _db_prefix(config, kind) + "_" + organ)
+
+
+def get_shard_path(config, kind, organ, name):
+    '''
+        Path of the shard holding the reports of user name.
+    '''
+    return os.path.join(get_shard_dir(config, kind, organ), quote(name, safe='') + SHARD_EXT)
+
+
+def get_predictions_path(config, kind, organ, name):
+    '''
+        Path of the sidecar db holding predictions made on the reports of
+        user name, see oncotext/utils/prediction_store.py
+    '''
+    return os.path.join(get_shard_dir(config, kind, organ), PREDICTIONS_DIR,
+                        quote(name, safe='') + SHARD_EXT)
+
+
+def get_pickle_path(config, kind, organ):
+    '''
+        Path of the legacy whole-db pickle for a db kind and organ.
+    '''
+    base_path = os.path.splitext(config[DB_KIND_TO_CONFIG_KEY[kind]])[0]
+    return base_path + "_" + organ + ".p"
+
+
+def connect(path):
+    conn = sqlite3.connect(path, timeout=60)
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.executescript(SCHEMA)
+    columns = [row[1] for row in conn.execute('PRAGMA table_info(reports)')]
+    if 'token_ids' not in columns:
+        conn.execute('ALTER TABLE reports ADD COLUMN token_ids BLOB')
+    return conn
+
+
+def _get_meta(conn, key):
+    row = conn.execute('SELECT value FROM meta WHERE key = ?', (key,)).fetchone()
+    return row[0] if row is not None else None
+
+
+def _serialize(report):
+    return sqlite3.Binary(pickle.dumps(report, protocol=pickle.HIGHEST_PROTOCOL))
+
+
+def _deserialize(blob):
+    return pickle.loads(blob)
+
+
+def _serialize_ids(ids):
+    if ids is None:
+        return None
+    return sqlite3.Binary(np.ascontiguousarray(ids, dtype=np.int32).tobytes())
+
+
+def _deserialize_ids(blob):
+    if blob is None:
+        return None
+    return np.frombuffer(blob, dtype=np.int32)
+
+
+def get_shard_version(config, kind, organ, name):
+    '''
+        Cheap fingerprint of a shard that changes whenever it is written,
+        whether by this process (write counter) or by another one (mtime and
+        size of the db and its write ahead log).
+
+        returns:
+        - version: hashable tuple, None if the shard does not exist
+    '''
+    path = get_shard_path(config, kind, organ, name)
+    if not os.path.exists(path):
+        return None
+    version = [_write_versions.get((kind, organ, name), 0)]
+    for suffix in ['', '-wal']:
+        if os.path.exists(path + suffix):
+            stat = os.stat(path + suffix)
+            version.extend([stat.st_mtime_ns, stat.st_size])
+    return tuple(version)
+
+
+def get_shard_nbytes(config, kind, organ, name):
+    '''
+        Total size of the pickled reports of a user.
+    '''
+    path = get_shard_path(config, kind, organ, name)
+    if not os.path.exists(path):
+        return 0
+    conn = connect(path)
+    try:
+        nbytes = conn.execute('SELECT SUM(LENGTH(report)) FROM reports').fetchone()[0]
+    finally:
+        conn.close()
+    return nbytes or 0
+
+
+def has_user(config, kind, organ, name):
+    return count_reports(config, kind, organ, name) > 0
+
+
+def count_reports(config, kind, organ, name):
+    path = get_shard_path(config, kind, organ, name)
+    if not os.path.exists(path):
+        return 0
+    conn = connect(path)
+    try:
+        count = conn.execute('SELECT COUNT(*) FROM reports').fetchone()[0]
+    finally:
+        conn.close()
+    return count
+
+
+def load_reports(config, kind, organ, name):
+    '''
+        Load all reports of a user, in the order they were added.
+
+        returns:
+        - reports: list of dicts, empty if the user has no reports
+    '''
+    path = get_shard_path(config, kind, organ, name)
+    if not os.path.exists(path):
+        return []
+    conn = connect(path)
+    try:
+        rows = conn.execute('SELECT report FROM reports ORDER BY seq')
+        reports = [_deserialize(row[0]) for row in rows]
+    finally:
+        conn.close()
+    return reports
+
+
+def _get_shard_lock(path):
+    with _lock:
+        return _shard_locks.setdefault(path, threading.Lock())
+
+
+def _bump_version(kind, organ, name):
+    key = (kind, organ, name)
+    with _lock:
+        _write_versions[key] = _write_versions.get(key, 0) + 1
+
+
+def _write_reports(config, kind, organ, name, reports, replace, token_ids, hashing):
+    path = get_shard_path(config, kind, organ, name)
+    if token_ids is None:
+        token_ids = [None] * len(reports)
+    rows = [(r.get(ID_KEY), _serialize(r), _serialize_ids(ids))
+                for r, ids in zip(reports, token_ids)]
+    with _get_shard_lock(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        conn = connect(path)
+        try:
+            with conn:
+                if replace:
+                    conn.execute('DELETE FROM reports')
+                if hashing is not None and _get_meta(conn, HASHING_KEY) != hashing:
+                    # Token ids of an older hashing setup are useless, drop them
+                    conn.execute('UPDATE reports SET token_ids = NULL')
+                    conn.execute('INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)',
+                                 (HASHING_KEY, hashing))
+                if hashing is None:
+                    rows = [(report_id, report, None) for report_id, report, ids in rows]
+                conn.executemany(
+                    'INSERT INTO reports (report_id, report, token_ids) VALUES (?, ?, ?)', rows)
+            count = conn.execute('SELECT COUNT(*) FROM reports').fetchone()[0]
+        finally:
+            conn.close()
+        _bump_version(kind, organ, name)
+    return count
+
+
+def add_reports(config, kind, organ, name, reports, token_ids=None, hashing=None):
+    '''
+        Append reports to a user's shard. Cost is proportional to
+        len(reports), independent of the size of other users' data.
+
+        params:
+        - token_ids: optional list of int32 arrays, the hashed tokens of
+          each report, stored alongside it
+        - hashing: key of the hashing setup that produced token_ids
+
+        returns:
+        - count: number of reports the user has after the append
+    '''
+    return _write_reports(config, kind, organ, name, reports, False, token_ids, hashing)
+
+
+def replace_reports(config, kind, organ, name, reports, token_ids=None, hashing=None):
+    '''
+        Overwrite all reports of a user with reports. See add_reports.
+        Token ids of the old reports are not kept, pass the ids of reports
+        that are written back unchanged (see load_shard).
+
+        returns:
+        - count: number of reports the user has after the write
+    '''
+    return _write_reports(config, kind, organ, name, reports, True, token_ids, hashing)
+
+
+def load_shard(config, kind, organ, name):
+    '''
+        Load all reports of a user with the token ids stored alongside them,
+        in a single read transaction, so both always come from the same
+        version of the shard.
+
+        returns:
+        - reports: list of dicts, in the order they were added
+        - token_ids: list aligned with reports of int32 arrays, None for
+          reports stored without token ids
+        - hashing: key of the hashing setup of the token ids, None if none
+          were stored
+    '''
+    path = get_shard_path(config, kind, organ, name)
+    if not os.path.exists(path):
+        return [], [], None
+    conn = connect(path)
+    try:
+        conn.execute('BEGIN')
+        hashing = _get_meta(conn, HASHING_KEY)
+        rows = conn.execute('SELECT report, token_ids FROM reports ORDER BY seq').fetchall()
+        conn.rollback()
+    finally:
+        conn.close()
+    reports = [_deserialize(row[0]) for row in rows]
+    token_ids = [_deserialize_ids(row[1]) for row in rows]
+    return reports, token_ids, hashing
+
+
+def load_token_ids(config, kind, organ, name, hashing):
+    '''
+        Load the token ids stored at ingest, aligned with load_reports.
+
+        returns:
+        - token_ids: list of int32 arrays, None for reports stored without
+          token ids. None altogether if the shard was hashed with a
+          different setup than hashing.
+    '''
+    _, token_ids, stored_hashing = load_shard(config, kind, organ, name)
+    if len(token_ids) > 0 and stored_hashing != hashing:
+        return None
+    return token_ids
+
+
+def remove_user(config, kind, organ, name):
+    paths = [get_shard_path(config, kind, organ, name),
+             get_predictions_path(config, kind, organ, name)]
+    with _get_shard_lock(paths[0]):
+        for path in paths:
+            for suffix in ['', '-wal', '-shm']:
+                if os.path.exists(path + suffix):
+                    os.remove(path + suffix)
+        _bump_version(kind, organ, name)
+
+
+def list_organs(config, kind):
+    '''
+        Organs with a shard directory for db kind, see get_shard_dir.
+    '''
+    store_dir = config['REPORT_STORE_DIR']
+    if not os.path.isdir(store_dir):
+        return []
+    prefix = _db_prefix(config, kind) + "_"
+    return sorted(d[len(prefix):] for d in os.listdir(store_dir)
+                  if d.startswith(prefix) and os.path.isdir(os.path.join(store_dir, d)))
+
+
+def list_users(config, kind, organ):
+    '''
+        Users with a shard for db kind and organ, see get_shard_path.
+    '''
+    shard_dir = get_shard_dir(config, kind, organ)
+    if not os.path.isdir(shard_dir):
+        return []
+    return sorted(unquote(f[:-len(SHARD_EXT)]) for f in os.listdir(shard_dir)
+                  if f.endswith(SHARD_EXT) and os.path.isfile(os.path.join(shard_dir, f)))
+
+
+def migrate_pickle(config, kind, organ, logger):
+    '''
+        Copy a legacy {name: [reports]} pickle into per user shards. Users
+        already present in the store are skipped, so the migration can be
+        re-run.
+
+        returns:
+        - migrated: list of user names that were copied over
+    '''
+    pickle_path = get_pickle_path(config, kind, organ)
+    if not os.path.exists(pickle_path):
+        logger.info("report_store - no pickle at {}. Nothing to migrate".format(pickle_path))
+        return []
+    try:
+        db = pickle.load(open(pickle_path, 'rb'))
+    except Exception as e:
+        db = pickle.load(open(pickle_path, 'rb'), encoding='bytes')
+
+    migrated = []
+    for name in db:
+        user = name.decode() if isinstance(name, bytes) else name
+        if has_user(config, kind, organ, user):
+            logger.info("report_store - {} already has {} {} reports. Skipping".format(user, kind, organ))
+            continue
+        count = add_reports(config, kind, organ, user, db[name])
+        logger.info("report_store - migrated {} {} {} reports of {}".format(count, kind, organ, user))
+        migrated.append(user)
+    return migrated
@@ -0,0 +1,97 @@
+'''
+Metadata saved next to each trained snapshot, e.g oncotext_ER.json next to
+oncotext_ER.pt: a fingerprint of the data and hyperparameters the model was
+trained with, its dev results, so retraining can tell whether anything
+changed, and the keys of its dev reports, so it can be evaluated again on
+the same held out split.
+'''
+
+import os
+import json
+import hashlib
+import datetime
+import pdb
+
+META_EXT = '.json'
+
+# Rationale net args that change the model a training run produces
+TRAIN_ARG_KEYS = ['model_form', 'hidden_dim', 'num_layers', 'filters', 'filter_num',
+                  'dropout', 'init_lr', 'weight_decay', 'objective', 'steps', 'max_epochs',
+                  'patience', 'train_split', 'tuning_metric', 'train_batch_size',
+                  'get_rationales', 'selection_lambda', 'continuity_lambda', 'use_gumbel',
+                  'gumbel_temprature', 'gumbel_decay', 'num_samples', 'tag_lambda',
+                  'num_tags', 'max_length', 'embedding_dim', 'hash_buckets',
+                  'use_as_tagger', 'class_balance', 'num_class']
+
+
+def _to_json(value):
+    # numpy scalars and arrays in dev stats
+    if hasattr(value, 'tolist'):
+        return value.tolist()
+    return str(value)
+
+
+def get_meta_path(snapshot_path):
+    return os.path.splitext(snapshot_path)[0] + META_EXT
+
+
+def load_meta(snapshot_path):
+    '''
+        returns:
+        - meta: dict saved by save_meta, None if there is none or the
+          snapshot itself is missing
+    '''
+    meta_path = get_meta_path(snapshot_path)
+    if not os.path.exists(snapshot_path) or not os.path.exists(meta_path):
+        return None
+    try:
+        return json.load(open(meta_path))
+    except ValueError:
+        return None
+
+
+def save_meta(snapshot_path, meta):
+    meta = dict(meta, saved_at=datetime.datetime.now().isoformat())
+    meta_path = get_meta_path(snapshot_path)
+    tmp_path = meta_path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(meta, f, default=_to_json)
+    os.replace(tmp_path, meta_path)
+
+
+def get_data_fingerprint(reports, diagnosis, text_key):
+    '''
+        Hash of the (text, label) pairs of the reports annotated for
+        diagnosis, i.e the ones get_oncotext_dataset_train selects,
+        independent of their order.
+    '''
+    pair_hashes = sorted(
+        hashlib.sha1("{}\0{}".format(r[text_key], r[diagnosis]).encode('utf-8')).hexdigest()
+        for r in reports if diagnosis in r)
+    return hashlib.sha1("\n".join(pair_hashes).encode('utf-8')).hexdigest()
+
+
+def get_train_fingerprint(data_fingerprint, args, label_maps, embedding_identity):
+    '''
+        Hash of the training data fingerprint, the args in TRAIN_ARG_KEYS,
+        the label maps (their order gives the class indices) and the
+        embeddings (see embedding.get_embedding_identity) of a model.
+
+        params:
+        - label_maps: {diagnosis: labels} of the diagnoses the model predicts
+    '''
+    train_args = {key: getattr(args, key, None) for key in TRAIN_ARG_KEYS}
+    key = data_fingerprint + json.dumps([train_args, label_maps, embedding_identity],
+                                        sort_keys=True, default=str)
+    return hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+
+def get_report_key(report, text_key):
+    '''
+        Short hash of the text of a report, identifies it in dev_keys.
+    '''
+    return hashlib.sha1(report[text_key].encode('utf-8')).hexdigest()[:16]
+
+
+def get_dev_keys(dev_reports, text_key):
+    return sorted(set(get_report_key(r, text_key) for r in dev_reports))
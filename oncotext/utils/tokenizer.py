@@ -0,0 +1,147 @@
+'''
+Hashing tokenizer shared by the pathology datasets.
+
+Turns a batch of preprocessed report texts into a contiguous int32 matrix of
+embedding row ids, padded with 0 to max_length. Each distinct token is
+murmurhashed once per batch, and the buckets of frequent tokens are memoized
+across batches in a bounded dict, so hashing cost scales with new
+vocabulary rather than with report volume.
+'''
+
+import itertools
+import threading
+import numpy as np
+from sklearn.utils import murmurhash3_32
+import pdb
+
+DEFAULT_CACHE_SIZE = 500000
+
+_tokenizers = {}
+_lock = threading.Lock()
+
+
+class HashingTokenizer(object):
+
+    def __init__(self, num_buckets, max_length, bucket_remap=None, cache_size=DEFAULT_CACHE_SIZE):
+        '''
+            params:
+            - num_buckets: number of hash buckets tokens are hashed into
+            - max_length: number of tokens kept per text
+            - bucket_remap: optional int array mapping bucket -> embedding row
+            - cache_size: max number of token -> bucket entries memoized
+        '''
+        self.num_buckets = int(num_buckets)
+        self.max_length = max_length
+        self.bucket_remap = bucket_remap
+        self.cache_size = cache_size
+        self.cache = {}
+
+    def hash(self, token):
+        """Unsigned 32 bit murmurhash for feature hashing."""
+        return murmurhash3_32(token, positive=True) % self.num_buckets
+
+    def buckets(self, tokens):
+        '''
+            returns:
+            - buckets: int64 array, the hash bucket of each token
+        '''
+        cache = self.cache
+        new_buckets = {t: self.hash(t) for t in set(tokens).difference(cache)}
+        free = self.cache_size - len(cache)
+        if len(new_buckets) <= free:
+            cache.update(new_buckets)
+            lookup = cache.__getitem__
+        else:
+            for t in list(new_buckets)[:max(free, 0)]:
+                cache[t] = new_buckets[t]
+            lookup = lambda t: cache[t] if t in cache else new_buckets[t]
+        return np.fromiter(map(lookup, tokens), dtype=np.int64, count=len(tokens))
+
+    @property
+    def hashing_key(self):
+        '''
+            Identifies the bucket ids this tokenizer produces, before any
+            remap, e.g for token ids persisted at ingest.
+        '''
+        return "murmurhash3_32:{}:{}".format(self.num_buckets, self.max_length)
+
+    def _hash_texts(self, texts):
+        token_lists = [text.split()[:self.max_length] for text in texts]
+        lengths = np.array([len(tokens) for tokens in token_lists], dtype=np.int64)
+        flat_tokens = list(itertools.chain.from_iterable(token_lists))
+        return self.buckets(flat_tokens), lengths
+
+    def _pad(self, flat_buckets, lengths):
+        if self.bucket_remap is not None:
+            flat_buckets = self.bucket_remap[flat_buckets]
+        x = np.zeros((len(lengths), self.max_length), dtype=np.int32)
+        mask = np.arange(self.max_length)[None, :] < lengths[:, None]
+        x[mask] = flat_buckets
+        return x
+
+    def bucket_ids(self, texts):
+        '''
+            returns:
+            - ids: list of unpadded int32 arrays, the hash buckets of the
+              first max_length tokens of each text, before any remap
+        '''
+        if len(texts) == 0:
+            return []
+        flat_buckets, lengths = self._hash_texts(texts)
+        return np.split(flat_buckets.astype(np.int32), np.cumsum(lengths)[:-1])
+
+    def tokenize_batch(self, texts):
+        '''
+            params:
+            - texts: list of preprocessed texts
+
+            returns:
+            - x: int32 array of shape (len(texts), max_length), token ids
+              padded with 0
+            - lengths: int array, number of tokens kept per text
+        '''
+        flat_buckets, lengths = self._hash_texts(texts)
+        return self._pad(flat_buckets, lengths), lengths
+
+    def featurize(self, texts, token_ids=None):
+        '''
+            Same as tokenize_batch, but reuses bucket ids computed earlier
+            by bucket_ids (e.g at ingest). Only texts whose entry in
+            token_ids is None are hashed.
+        '''
+        if token_ids is None:
+            return self.tokenize_batch(texts)
+        token_ids = list(token_ids)
+        missing = [i for i, ids in enumerate(token_ids) if ids is None]
+        for i, ids in zip(missing, self.bucket_ids([texts[i] for i in missing])):
+            token_ids[i] = ids
+        token_ids = [ids[:self.max_length] for ids in token_ids]
+        lengths = np.array([len(ids) for ids in token_ids], dtype=np.int64)
+        if len(token_ids) > 0:
+            flat_buckets = np.concatenate(token_ids).astype(np.int64)
+        else:
+            flat_buckets = np.zeros(0, dtype=np.int64)
+        return self._pad(flat_buckets, lengths), lengths
+
+
+def _get_tokenizer(num_buckets, max_length, bucket_remap):
+    key = (int(num_buckets), max_length, id(bucket_remap) if bucket_remap is not None else None)
+    with _lock:
+        if key not in _tokenizers:
+            _tokenizers[key] = HashingTokenizer(num_buckets, max_length, bucket_remap)
+        return _tokenizers[key]
+
+
+def get_tokenizer(args):
+    '''
+        Process wide tokenizer for the hashing setup in args (hash_buckets,
+        bucket_remap, max_length), so its memo is shared across requests.
+    '''
+    return _get_tokenizer(args.hash_buckets, args.max_length, args.bucket_remap)
+
+
+def get_bucket_tokenizer(num_buckets, max_length):
+    '''
+        Process wide tokenizer producing raw hash buckets, without remap.
+    '''
+    return _get_tokenizer(num_buckets, max_length, None)
@@ -0,0 +1,146 @@
+'''
+Long-lived process pools for parallel training and inference.
+
+Each pool is started once per server process (see start_pools, called at
+startup by app.py, or on first use) and reused by every train /
+label_reports call. Its processes are forked from a forkserver, a clean
+single threaded process started for the purpose, never from the threaded
+server itself: a fork taken while a request thread holds e.g the logging
+lock, the model cache lock or a sqlite connection would leave the child
+deadlocked on it. Dead workers are replaced from the forkserver too.
+
+Workers reopen the memory mapped embeddings themselves, so their pages are
+shared with the server through the page cache, and keep their own model
+cache, so each worker loads a model once for all calls. Tasks carry the
+data they work on: token ids of a shard of reports (tensors move through
+shared memory) or the reports to train on.
+'''
+
+import logging
+import threading
+import multiprocessing
+import torch
+import oncotext.logger as oncotext_logger
+import oncotext.utils.dataset_factory as dataset_factory
+import pdb
+
+TRAIN = 'train'
+INFERENCE = 'inference'
+# Imported once by the forkserver, workers fork with them loaded
+PRELOAD = ['oncotext.rationale_net_wrapper']
+
+_pools = {}
+_lock = threading.Lock()
+
+# Set in each worker by _init_worker
+worker_state = {}
+
+
+def get_num_workers(workers, threads, max_workers):
+    '''
+        returns:
+        - workers: workers, or if it is 0, as many as fit the cores with
+          threads torch threads each, at most max_workers
+        - threads: torch intra-op threads per worker, threads, or if it is
+          0, the cores split evenly
+    '''
+    cores = multiprocessing.cpu_count()
+    if workers <= 0:
+        workers = max(1, cores // max(threads, 1))
+    workers = max(1, min(workers, max_workers))
+    if threads <= 0:
+        threads = max(1, cores // workers)
+    return workers, threads
+
+
+def get_pool_size(kind, config):
+    '''
+        returns:
+        - workers, threads: size of the pool of kind, from TRAIN_WORKERS /
+          INFERENCE_WORKERS and their _THREADS_PER_WORKER
+    '''
+    prefix = 'TRAIN' if kind == TRAIN else 'INFERENCE'
+    return get_num_workers(config[prefix + '_WORKERS'], config[prefix + '_THREADS_PER_WORKER'],
+                           multiprocessing.cpu_count())
+
+
+def _get_log_path(logger):
+    for handler in logger.handlers:
+        if isinstance(handler, logging.FileHandler):
+            return handler.baseFilename
+    return None
+
+
+def _init_worker(config, logger_name, log_path, num_threads):
+    torch.set_num_threads(num_threads)
+    if log_path is not None:
+        logger = oncotext_logger.get_logger(logger_name, log_path)
+    else:
+        logger = logging.getLogger(logger_name)
+    worker_state.update(config=config, logger=logger)
+    # Map the embeddings up front rather than on the first task
+    get_worker_embeddings()
+
+
+def get_worker_embeddings():
+    '''
+        returns:
+        - embeddings, args: of the current worker, see
+          dataset_factory.get_embedding_tensor
+    '''
+    config = worker_state['config']
+    return dataset_factory.get_embedding_tensor(config, config['RATIONALE_NET_ARGS'], worker_state['logger'])
+
+
+class WorkerPool(object):
+
+    def __init__(self, config, logger, workers, threads):
+        context = multiprocessing.get_context('forkserver')
+        context.set_forkserver_preload(PRELOAD)
+        # Flask's config also holds non picklable settings of its own
+        worker_config = {k: v for k, v in config.items() if k.isupper()}
+        self.workers = workers
+        self.threads = threads
+        self.pool = context.Pool(workers, _init_worker,
+                                 (worker_config, logger.name, _get_log_path(logger), threads))
+
+    def map(self, fn, tasks):
+        return self.pool.map(fn, tasks)
+
+    def imap_unordered(self, fn, tasks):
+        return self.pool.imap_unordered(fn, tasks)
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+
+
+def get_pool(kind, config, logger):
+    '''
+        returns:
+        - pool: the WorkerPool of kind (TRAIN or INFERENCE) of this
+          process, started with get_pool_size(kind, config) workers on
+          first use
+    '''
+    with _lock:
+        if kind not in _pools:
+            workers, threads = get_pool_size(kind, config)
+            logger.info("worker_pool - starting {} pool of {} processes with {} threads each".format(
+                        kind, workers, threads))
+            _pools[kind] = WorkerPool(config, logger, workers, threads)
+        return _pools[kind]
+
+
+def start_pools(config, logger):
+    '''
+        Start the pools the config asks for (TRAIN_WORKERS or
+        INFERENCE_WORKERS other than 1) up front, so the first request
+        doesn't wait for them. Failures are only logged, calls retry on
+        first use.
+    '''
+    for kind in [TRAIN, INFERENCE]:
+        if get_pool_size(kind, config)[0] > 1:
+            try:
+                get_pool(kind, config, logger)
+            except Exception as e:
+                logger.warn("worker_pool - could not start {} pool. Exception {}".format(kind, e))
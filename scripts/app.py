@@ -6,14 +6,25 @@ sys.path.append(os.path.join(dirname(dirname(realpath(__file__))),
                              'text_nn'))
 import oncotext.logger as logger
 from flask import Flask
-from flask import request, json, jsonify
+from flask import request, json, jsonify, Response
 import oncotext.rationale_net_wrapper as rationale_net_wrapper
 import oncotext.utils.postprocess as postprocess
 import oncotext.utils.preprocess as preprocess
 import oncotext.utils.generic as generic
 import oncotext.utils.json as json_utils
 import oncotext.evaluation as evaluation
+import oncotext.jobs as jobs_utils
+import oncotext.batching as batching
+import oncotext.worker_pool as worker_pool
+import oncotext.utils.report_store as report_store
+import oncotext.utils.db_cache as db_cache
+import oncotext.utils.embedding as embedding
+import oncotext.utils.model_cache as model_cache
+import oncotext.utils.dataset_factory as dataset_factory
+import oncotext.utils.prediction_store as prediction_store
+import oncotext.utils.inference_cache as inference_cache
 import pickle
+import zlib
 import pdb
 
 app = Flask(__name__)
@@ -30,8 +41,13 @@ app = Flask(__name__)
 app.config.from_object(__name__)
 logger = logger.get_logger(LOGNAME, LOGPATH)
 
-DB_TRAIN_PATH = config['DB_TRAIN_PATH'].split(".")[0]
-DB_UNLABLED_PATH = config['DB_UNLABLED_PATH'].split(".")[0]
+# Map embeddings once, before any server workers fork, so they share pages
+embedding.preload(config, logger)
+# Train / inference worker processes live for the whole server, see oncotext/worker_pool.py
+worker_pool.start_pools(config, logger)
+
+job_manager = jobs_utils.JobManager(config['JOB_WORKERS'], config['JOB_HISTORY_SIZE'], logger)
+
 DEFAULT_USER = config['DEFAULT_USERNAME']
 DEFAULT_ORGAN = config['DEFAULT_ORGAN']
 
@@ -39,7 +55,42 @@ SUCCESS_MSG = "Request Success"
 TRAIN_SUCCESS_MSG = "Request Success. Dev results returned"
 NOP_MSG = "Request No Op. Invalid arg"
 NO_SUCH_USR_MSG = "Error! User {} doesn't have a {} db initialized!"
+NO_SUCH_JOB_MSG = "Error! No job with id {}"
+TOO_MANY_REPORTS_MSG = "Error! Got {} reports, at most {} can be labeled per request. Use addUnlabeled and predict instead"
+JOB_SUBMITTED_MSG = "Request Accepted. Poll /jobs/<job_id> for its status"
+
+
+def tokenize_for_store(reports):
+    '''
+        Hash report texts once at ingest, so train / predict can skip text
+        processing.
+        returns:- token_ids, hashing key. (None, None) if embeddings are not
+                  available yet.
+    '''
+    try:
+        tokenizer = dataset_factory.get_ingest_tokenizer(config, logger)
+    except Exception as e:
+        logger.warn("tokenize_for_store - could not get tokenizer, storing reports without token ids. Exception {}".format(e))
+        return None, None
+    texts = [r[config['PREPROCESSED_REPORT_TEXT_KEY']] for r in reports]
+    return tokenizer.bucket_ids(texts), tokenizer.hashing_key
+
 
+def load_db(kind, organ, name):
+    '''
+        Load a user's reports, and the token ids stored with them at ingest.
+        returns:- reports, token_ids (None if unavailable)
+    '''
+    try:
+        hashing = dataset_factory.get_ingest_tokenizer(config, logger).hashing_key
+    except Exception as e:
+        logger.warn("load_db - could not get tokenizer, ignoring stored token ids. Exception {}".format(e))
+        hashing = None
+    # Both come from the same read of the shard, so they are always aligned
+    reports, token_ids = db_cache.load_db(config, kind, organ, name, hashing, logger)
+    if hashing is None:
+        token_ids = None
+    return reports, token_ids
 
 
 @app.route("/addTrain", methods=['POST'])
@@ -73,21 +124,17 @@ def addTrainData():
     logger.info( "addTrain - data has keys {}".format( data[0].keys()))
     logger.info("addTrain - [{}] len data {}".format(name, len(data)))
 
-    filename = DB_TRAIN_PATH+"_"+organ+".p"
-    if os.path.isfile(filename):
-        db_train = pickle.load(open(filename, 'rb'), encoding='bytes')
-    else:
-        db_train = {}
-        
-    if name not in db_train:
+    if not report_store.has_user(config, report_store.TRAIN, organ, name):
         logger.info("Adding {} to db_train_{}".format(name, organ))
         default_train = pickle.load(open(config['DB_BASE_PATH'],'rb'), encoding='bytes')
-        db_train[name] = default_train[organ] if organ in default_train else []        
+        if organ in default_train:
+            token_ids, hashing = tokenize_for_store(default_train[organ])
+            report_store.add_reports(config, report_store.TRAIN, organ, name, default_train[organ], token_ids, hashing)
 
-    db_train[name].extend(data)
+    token_ids, hashing = tokenize_for_store(data)
+    count = report_store.add_reports(config, report_store.TRAIN, organ, name, data, token_ids, hashing)
 
-    logger.info("addTrain - Len train[{}] {}".format(name, len(db_train[name])))
-    pickle.dump(db_train, open(filename, 'wb'))
+    logger.info("addTrain - Len train[{}] {}".format(name, count))
 
     return SUCCESS_MSG, 200
 
@@ -111,16 +158,6 @@ def addUnlabeledData():
     name = request.args.get("name") or DEFAULT_USER
     organ = request.args.get("organ") or DEFAULT_ORGAN
 
-    filename = DB_UNLABLED_PATH+"_"+organ+".p"
-    if os.path.isfile(filename):
-        db_unlabeled = pickle.load(open(filename, 'rb'), encoding='bytes')
-    else:
-        db_unlabeled = {}
-        
-    if name not in db_unlabeled:
-        logger.info( "addUnlabeled - Adding {} to db_unlabeled_{}".format(name, organ))
-        db_unlabeled[name] = []
-
     data = preprocess.remove_duplicates(data, config['RAW_REPORT_TEXT_KEY'], config['PREPROCESSED_REPORT_TEXT_KEY'], logger)
     data = preprocess.apply_rules(data,
                                   organ,
@@ -132,83 +169,183 @@ def addUnlabeledData():
                                   config['SEGMENT_TYPE_KEY'],
                                   logger)
 
+    token_ids, hashing = tokenize_for_store(data)
     if organ == config['META_KEY']:
         logger.info( "addUnlabeled - Adding {} reports to db_unlabeled".format(len(data)))
-        db_unlabeled[name].extend(data)
+        report_store.add_reports(config, report_store.UNLABELED, organ, name, data, token_ids, hashing)
     else:
         logger.info( "addUnlabeled - Re-writing {} reports to db_unlabeled".format(len(data)))
-        db_unlabeled[name] = data
+        report_store.replace_reports(config, report_store.UNLABELED, organ, name, data, token_ids, hashing)
+
+    logger.info("addUnlabeled - db updated at path {}".format(
+        report_store.get_shard_path(config, report_store.UNLABELED, organ, name)))
 
-    pickle.dump(db_unlabeled, open(filename, 'wb'))
-    logger.info("addUnlabeled - db redumped to path {}".format(filename))
-    
     return SUCCESS_MSG, 200
 
 
+def run_train(name, organ, mode, progress=None):
+    '''
+        Train every diagnosis model of organ on the user's train db.
+        returns:- dev_results
+    '''
+    train_reports, token_ids = load_db(report_store.TRAIN, organ, name)
+    return rationale_net_wrapper.train(name, organ, train_reports, config, logger, token_ids, progress, mode)
+
+
+def get_train_params():
+    '''
+        returns:- name, organ, mode of a train request
+    '''
+    name = request.args.get("name") or DEFAULT_USER
+    organ = request.args.get("organ") or DEFAULT_ORGAN
+    mode = request.args.get("mode") or rationale_net_wrapper.FULL
+    return name, organ, mode
+
+
 @app.route("/train", methods=['GET'])
 def train():
     '''
         Launches ML model to retrain on current data on db_train[model]
         for all diagnoses.
         params: - name: ID of user, used to identify which data to use.
+                - mode: "full" (default) trains models from scratch,
+                    "incremental" fine-tunes the current models for a few
+                    steps. Both keep the models whose training data and
+                    args did not change. "force" retrains every model from
+                    scratch. "multitask" trains a single model with a head
+                    per diagnosis, used by /predict?multitask=true.
         returns:- dev_results, msg, status code
     '''
-    name = request.args.get("name") or DEFAULT_USER
-    organ = request.args.get("organ") or DEFAULT_ORGAN
+    name, organ, mode = get_train_params()
+    if mode not in rationale_net_wrapper.TRAIN_MODES:
+        return NOP_MSG
 
-    filename = DB_TRAIN_PATH+"_"+organ+".p"
-    db_train = pickle.load(open(filename, 'rb'))
-    
-    if name not in db_train:
+    if not report_store.has_user(config, report_store.TRAIN, organ, name):
         return NO_SUCH_USR_MSG.format(name, 'train'), 500
-    
-    result_dict = rationale_net_wrapper.train(name, organ, db_train[name], config, logger)
+
+    result_dict = run_train(name, organ, mode)
 
     return json.dumps({'results': result_dict,
             'msg':TRAIN_SUCCESS_MSG}), 200
 
 
-# Kicks off job to run model on the corresping data
-# Will return all unlabeled data
-@app.route("/predict", methods=['GET'])
-def predict():
+@app.route("/trainAsync", methods=['GET'])
+def trainAsync():
     '''
-        Launches ML model to label on current data on db_predict[model]
-        for all diagnoses.
+        Same as /train, but runs as a background job.
         params: - name: ID of user, used to identify which data to use.
-                - eval_sets: list of lists of reports to evaluate predictions
-                    on
-                - debug: Set to "True" to skip running nn code
-        returns:- labeled_db, results, msg, status code
+                - mode: see /train
+        returns:- job_id, msg, status code. Poll /jobs/<job_id> for the
+                  dev_results
     '''
-    name = request.args.get("name") or DEFAULT_USER
-    organ = request.args.get("organ") or DEFAULT_ORGAN
+    name, organ, mode = get_train_params()
+    if mode not in rationale_net_wrapper.TRAIN_MODES:
+        return NOP_MSG
+
+    if not report_store.has_user(config, report_store.TRAIN, organ, name):
+        return NO_SUCH_USR_MSG.format(name, 'train'), 500
+
+    job = job_manager.submit('train', name, organ, config['DIAGNOSES'][organ],
+                             lambda progress: run_train(name, organ, mode, progress))
+    return json.dumps({'job_id': job.id, 'msg': JOB_SUBMITTED_MSG}), 202
+
+
+def get_prediction_caches(organ, name, reports, incremental):
+    '''
+        Caches of earlier predictions label_reports should consult for
+        reports, see rationale_net_wrapper.label_reports
+    '''
+    prediction_caches = []
+    if incremental:
+        prediction_caches.append(prediction_store.StoredPredictions(
+            config, report_store.UNLABELED, organ, name, reports,
+            config['PREPROCESSED_REPORT_TEXT_KEY']))
+    if inference_cache.is_enabled(config):
+        prediction_caches.append(inference_cache.InferenceCache(
+            config, organ, reports, config['PREPROCESSED_REPORT_TEXT_KEY']))
+    return prediction_caches
+
+
+def iter_labeled_chunks(name, organ, reports, token_ids, incremental, use_multitask=False):
+    '''
+        Label and postprocess reports chunk by chunk, for organs whose
+        postprocessing is per report. Organs aggregated into episodes are
+        labeled in one chunk.
+        returns:- generator of lists of labeled reports
+    '''
+    user_train_db = db_cache.load_reports(config, report_store.TRAIN, organ, name, logger)
+    # Built once, every chunk is corrected against the same train db
+    correction_map = postprocess.get_correction_map(user_train_db, config)
+    chunk_size = config['PREDICT_STREAM_CHUNK_SIZE']
+    if postprocess.needs_whole_db(organ) or chunk_size <= 0:
+        chunk_size = max(len(reports), 1)
+    for start in range(0, len(reports), chunk_size):
+        chunk = reports[start:start + chunk_size]
+        chunk_token_ids = token_ids[start:start + chunk_size] if token_ids is not None else None
+        labeled = rationale_net_wrapper.label_reports(name,
+                                                      organ,
+                                                      chunk,
+                                                      config,
+                                                      logger,
+                                                      chunk_token_ids,
+                                                      get_prediction_caches(organ, name, chunk, incremental),
+                                                      use_multitask=use_multitask)
+        yield postprocess.apply_rules(labeled, user_train_db, organ, config, logger, correction_map)
+
+
+def stream_predictions(labeled_chunks, eval_sets, use_gzip):
+    '''
+        Serialize labeled reports as NDJSON, one {"report": ...} line per
+        report as soon as its chunk is labeled, followed by a
+        {"results": ..., "msg": ...} line. Failures after the response has
+        started are reported as a final {"error": ...} line.
+        returns:- generator of response chunks, gzipped if use_gzip
+    '''
+    compressor = zlib.compressobj(wbits=31) if use_gzip else None
+
+    def encode(lines, flush=False):
+        data = "".join(lines).encode('utf-8')
+        if compressor is None:
+            return data
+        data = compressor.compress(data)
+        return data + compressor.flush(zlib.Z_FINISH if flush else zlib.Z_SYNC_FLUSH)
+
+    # Only reports scored by an eval set are kept until the end
+    eval_reports = []
+    num_streamed = 0
     try:
-        eval_sets = json.loads(request.data.decode())
+        for chunk in labeled_chunks:
+            yield encode([json.dumps({'report': json_utils.make_report_json_compliant(r)}) + "\n"
+                          for r in chunk])
+            num_streamed += len(chunk)
+            eval_reports.extend(r for r in chunk if r['filename'] in eval_sets)
+        results = evaluation.evaluate(eval_reports, eval_sets, config, logger)
+        yield encode([json.dumps({'results': results, 'msg': SUCCESS_MSG}) + "\n"], flush=True)
     except Exception as e:
-        eval_sets = {}
-        logger.warn("No eval sets provided for prediction!")
-        
-    filename = DB_UNLABLED_PATH+"_"+organ+".p"
-    db_unlabeled = pickle.load(open(filename, 'rb'))
+        logger.error("predict - streaming failed after {} reports. Exception {}".format(num_streamed, e))
+        yield encode([json.dumps({'error': str(e)}) + "\n"], flush=True)
 
-    if name not in db_unlabeled:
-        return NO_SUCH_USR_MSG.format(name, 'unlabeled'), 500
 
+def run_predict(name, organ, eval_sets, incremental, progress=None, use_multitask=False):
+    '''
+        Label the user's unlabeled db with every diagnosis model of organ,
+        postprocess and evaluate it.
+        returns:- labeled_db (json compliant), results
+    '''
+    unlabeled_reports, token_ids = load_db(report_store.UNLABELED, organ, name)
     reportDB = rationale_net_wrapper.label_reports(name,
                                                    organ,
-                                                   db_unlabeled[name],
+                                                   unlabeled_reports,
                                                    config,
-                                                   logger)
+                                                   logger,
+                                                   token_ids,
+                                                   get_prediction_caches(organ, name, unlabeled_reports, incremental),
+                                                   progress,
+                                                   use_multitask)
 
     pickle.dump(reportDB, open(os.path.join(config['PICKLE_DIR'], 'reportDBAPI_labeled_intermediate_'+organ+'.p'), 'wb'))
     # reportDB = pickle.load(open(os.path.join(config['PICKLE_DIR'], 'reportDBAPI_labeled_intermediate_'+organ+'.p'), 'rb'))
-    user_train_db = []
-    train_filename = DB_TRAIN_PATH+"_"+organ+".p"
-    if os.path.exists(train_filename):
-        train_db = pickle.load(open(train_filename, 'rb'))
-        if name in train_db:
-            user_train_db = train_db[name]
+    user_train_db = db_cache.load_reports(config, report_store.TRAIN, organ, name, logger)
 
     reportDB = postprocess.apply_rules(reportDB,
                                        user_train_db,
@@ -217,12 +354,181 @@ def predict():
                                        logger)
     
     results = evaluation.evaluate(reportDB, eval_sets, config, logger)
+    return json_utils.make_json_compliant(reportDB), results
+
+
+def get_predict_params():
+    '''
+        returns:- name, organ, eval_sets, incremental, use_multitask of a
+                  predict request
+    '''
+    name = request.args.get("name") or DEFAULT_USER
+    organ = request.args.get("organ") or DEFAULT_ORGAN
+    incremental = (request.args.get("incremental") or '').lower() == 'true'
+    use_multitask = (request.args.get("multitask") or '').lower() == 'true'
+    try:
+        eval_sets = json.loads(request.data.decode())
+    except Exception as e:
+        eval_sets = {}
+        logger.warn("No eval sets provided for prediction!")
+    return name, organ, eval_sets, incremental, use_multitask
+
+
+# Kicks off job to run model on the corresping data
+# Will return all unlabeled data
+@app.route("/predict", methods=['GET'])
+def predict():
+    '''
+        Launches ML model to label on current data on db_predict[model]
+        for all diagnoses.
+        params: - name: ID of user, used to identify which data to use.
+                - eval_sets: list of lists of reports to evaluate predictions
+                    on
+                - debug: Set to "True" to skip running nn code
+                - incremental: Set to "true" to reuse predictions of
+                    earlier calls, only running models on reports that
+                    are new, or whose diagnosis model changed since.
+                - stream: Set to "true" to get an NDJSON response, see
+                    stream_predictions. Gzipped if the client accepts it.
+                - multitask: Set to "true" to label with the organ's
+                    multi-task model, trained with /train?mode=multitask
+        returns:- labeled_db, results, msg, status code
+    '''
+    name, organ, eval_sets, incremental, use_multitask = get_predict_params()
+    stream = (request.args.get("stream") or '').lower() == 'true'
+        
+    if not report_store.has_user(config, report_store.UNLABELED, organ, name):
+        return NO_SUCH_USR_MSG.format(name, 'unlabeled'), 500
+
+    if stream:
+        unlabeled_reports, token_ids = load_db(report_store.UNLABELED, organ, name)
+        use_gzip = 'gzip' in request.headers.get('Accept-Encoding', '')
+        labeled_chunks = iter_labeled_chunks(name, organ, unlabeled_reports, token_ids, incremental, use_multitask)
+        response = Response(stream_predictions(labeled_chunks, eval_sets, use_gzip),
+                            mimetype='application/x-ndjson')
+        if use_gzip:
+            response.headers['Content-Encoding'] = 'gzip'
+        return response
+
+    reportDB, results = run_predict(name, organ, eval_sets, incremental, use_multitask=use_multitask)
     
-    return json.dumps({'reportDB': json_utils.make_json_compliant(reportDB),
+    return json.dumps({'reportDB': reportDB,
                        'results': results,
                        'msg': SUCCESS_MSG})
 
 
+@app.route("/predictAsync", methods=['GET'])
+def predictAsync():
+    '''
+        Same as /predict, but runs as a background job. Takes the same
+        params, except stream.
+        returns:- job_id, msg, status code. Poll /jobs/<job_id> for the
+                  labeled_db and results
+    '''
+    name, organ, eval_sets, incremental, use_multitask = get_predict_params()
+
+    if not report_store.has_user(config, report_store.UNLABELED, organ, name):
+        return NO_SUCH_USR_MSG.format(name, 'unlabeled'), 500
+
+    def run(progress):
+        reportDB, results = run_predict(name, organ, eval_sets, incremental, progress, use_multitask)
+        return {'reportDB': reportDB, 'results': results}
+
+    job = job_manager.submit('predict', name, organ, rationale_net_wrapper.get_labeled_diagnoses(organ, config), run)
+    return json.dumps({'job_id': job.id, 'msg': JOB_SUBMITTED_MSG}), 202
+
+
+def label_text_batch(key, reports):
+    '''
+        Label a micro-batch of reports coalesced from /predictText requests.
+    '''
+    name, organ, use_multitask = key
+    return rationale_net_wrapper.label_reports(name,
+                                               organ,
+                                               reports,
+                                               config,
+                                               logger,
+                                               None,
+                                               get_prediction_caches(organ, name, reports, False),
+                                               use_multitask=use_multitask)
+
+
+text_batcher = batching.MicroBatcher(label_text_batch,
+                                     config['MICRO_BATCH_MAX_SIZE'],
+                                     config['MICRO_BATCH_MAX_WAIT_MS'],
+                                     logger,
+                                     config['MICRO_BATCH_WORKERS'])
+
+
+@app.route("/predictText", methods=['POST'])
+def predictText():
+    '''
+        Label a handful of reports sent in the request, in memory. Nothing
+        is read from or written to the user's dbs, models come from the
+        model cache and predictions from the inference cache when warm.
+        Concurrent requests are labeled together, see oncotext/batching.py
+        params: - data: list of reports, at most PREDICT_TEXT_MAX_REPORTS
+                - name: ID of user, whose models to use. Falls back to the
+                    default user's models.
+                - multitask: Set to "true" to use the multi-task model, see
+                    /predict
+        returns:- labeled reports, msg, status code
+    '''
+    data = json.loads(request.data) or []
+    name = request.args.get("name") or DEFAULT_USER
+    organ = request.args.get("organ") or DEFAULT_ORGAN
+    use_multitask = (request.args.get("multitask") or '').lower() == 'true'
+
+    if len(data) > config['PREDICT_TEXT_MAX_REPORTS']:
+        return TOO_MANY_REPORTS_MSG.format(len(data), config['PREDICT_TEXT_MAX_REPORTS']), 400
+
+    data = preprocess.apply_rules(data,
+                                  organ,
+                                  config['RAW_REPORT_TEXT_KEY'],
+                                  config['PREPROCESSED_REPORT_TEXT_KEY'],
+                                  config['REPORT_TIME_KEY'],
+                                  config['SIDE_KEY'],
+                                  config['SEGMENT_ID_KEY'],
+                                  config['SEGMENT_TYPE_KEY'],
+                                  logger)
+    if len(data) == 0:
+        return json.dumps({'reportDB': [], 'msg': NOP_MSG}), 200
+
+    reportDB = text_batcher.submit((name, organ, use_multitask), data)
+    reportDB = postprocess.generate_automatic_feilds(reportDB, organ, config)
+
+    return json.dumps({'reportDB': json_utils.make_json_compliant(reportDB),
+                       'msg': SUCCESS_MSG}), 200
+
+
+@app.route("/jobs/<job_id>", methods=['GET'])
+def jobs(job_id):
+    '''
+        Status of a job submitted through /trainAsync or /predictAsync.
+        returns:- job (status, progress per diagnosis, timings, result once
+                  done, error if failed), status code
+    '''
+    job = job_manager.get(job_id)
+    if job is None:
+        return NO_SUCH_JOB_MSG.format(job_id), 404
+    return json.dumps(job), 200
+
+
+@app.route("/stats", methods=['GET'])
+def stats():
+    '''
+        Report hit/miss counters of the in process db and model caches,
+        the size of the inference cache, and micro-batching counters of
+        /predictText.
+        returns:- stats, status code
+    '''
+    return json.dumps({'db_cache': db_cache.stats,
+                       'model_cache': model_cache.get_stats(),
+                       'inference_cache': inference_cache.get_stats(config),
+                       'micro_batching': text_batcher.get_stats(),
+                       'msg': SUCCESS_MSG}), 200
+
+
 if __name__ == "__main__":
     app.run(host="0.0.0.0", port=config['PORT'])
 
@@ -0,0 +1,86 @@
+import os, shutil
+from os.path import dirname, realpath
+import sys
+sys.path.append(dirname(dirname(realpath(__file__))))
+import argparse
+import time
+from config import Config, get_config_dict
+import oncotext.rationale_net_wrapper as rationale_net_wrapper
+import oncotext.utils.report_store as report_store
+import oncotext.utils.snapshot_meta as snapshot_meta
+import oncotext.logger as logger
+import pdb
+
+parser = argparse.ArgumentParser(description='Compare the multi-task model against the per diagnosis models')
+
+parser.add_argument('--name',  type=str, default=Config.DEFAULT_USERNAME, help="User whose models to compare")
+parser.add_argument('--organ',  type=str, default='OrganBreast', help="Organ whose models to compare")
+parser.add_argument('--kind',  type=str, default=report_store.UNLABELED, help="Db of the user to time labeling on")
+parser.add_argument('--num_reports',  type=int, default=2000, help="Reports to time labeling on")
+parser.add_argument('--repeats',  type=int, default=3, help="Timed runs per mode, best is reported")
+
+LOGPATH = 'LOGS'
+LOGNAME = 'oncotext'
+logger = logger.get_logger(LOGNAME, LOGPATH)
+
+args = parser.parse_args()
+
+
+def best_time(config, reports, use_multitask):
+    # First run loads the models into the model cache
+    rationale_net_wrapper.label_reports(args.name, args.organ, reports, config, logger, use_multitask=use_multitask)
+    times = []
+    for _ in range(args.repeats):
+        start = time.time()
+        rationale_net_wrapper.label_reports(args.name, args.organ, reports, config, logger, use_multitask=use_multitask)
+        times.append(time.time() - start)
+    return min(times)
+
+
+def get_f1(snapshot_path, diagnosis):
+    '''
+        returns:
+        - f1: dev f1 of diagnosis saved with the snapshot at training, None
+          if unknown
+    '''
+    meta = snapshot_meta.load_meta(snapshot_path)
+    if meta is None:
+        return None
+    results = meta['results'] if isinstance(meta['results'], list) else [meta['results']]
+    for result in results:
+        if result['NAME'] == diagnosis:
+            return result['F1']
+    return None
+
+
+def format_f1(f1):
+    return "{:>10.4f}".format(f1) if isinstance(f1, float) else "{:>10}".format(str(f1))
+
+
+if __name__ == "__main__":
+    '''
+        Time labeling reports of a user's db with every per diagnosis model,
+        and with the multi-task model, and list the dev f1 each model
+        reached at training. Train both first, with /train and
+        /train?mode=multitask.
+    '''
+    # Label every diagnosis of every report in both modes
+    config = dict(get_config_dict(), CASCADED_INFERENCE=False, ORGAN_ROUTING=False)
+    rn_args = config['RATIONALE_NET_ARGS']
+    multitask_path = rationale_net_wrapper.get_multitask_snapshot(args.name, args.organ, config, rn_args)
+    if multitask_path is None:
+        sys.exit("No multitask model for {} {}, train one with /train?mode=multitask".format(args.name, args.organ))
+
+    reports = report_store.load_reports(config, args.kind, args.organ, args.name)[:args.num_reports]
+    independent_seconds = best_time(config, reports, False)
+    multitask_seconds = best_time(config, reports, True)
+
+    print("{} reports of {} {}".format(len(reports), args.name, args.organ))
+    for mode, seconds in [('per diagnosis models', independent_seconds), ('multitask model', multitask_seconds)]:
+        print("{:>22}: {:>10.0f} reports/sec".format(mode, len(reports) / seconds))
+
+    print("{:>24} {:>10} {:>10}".format('diagnosis', 'dev f1', 'multitask'))
+    for diagnosis in config['DIAGNOSES'][args.organ]:
+        snapshot_path = rationale_net_wrapper.get_warm_start_snapshot(args.name, diagnosis, config, rn_args)
+        f1 = get_f1(snapshot_path, diagnosis) if snapshot_path is not None else None
+        print("{:>24} {} {}".format(diagnosis, format_f1(f1), format_f1(get_f1(multitask_path, diagnosis))))
@@ -0,0 +1,81 @@
+import os, shutil
+from os.path import dirname, realpath
+import sys
+sys.path.append(dirname(dirname(realpath(__file__))))
+import argparse
+import random
+import time
+from sklearn.utils import murmurhash3_32
+from oncotext.utils.tokenizer import HashingTokenizer
+import pdb
+
+parser = argparse.ArgumentParser(description='Benchmark the hashing tokenizer against per token hashing')
+
+parser.add_argument('--num_reports',  type=int, default=20000, help="Number of synthetic reports")
+parser.add_argument('--report_length',  type=int, default=300, help="Mean number of tokens per report")
+parser.add_argument('--vocab_size',  type=int, default=1000000, help="Number of hash buckets")
+parser.add_argument('--max_length',  type=int, default=720, help="Tokens kept per report")
+parser.add_argument('--repeats',  type=int, default=3, help="Timed runs per tokenizer, best is reported")
+
+args = parser.parse_args()
+
+VOCAB = ['breast', 'left', 'right', 'biopsy', 'core', 'needle', 'invasive', 'ductal', 'lobular',
+         'carcinoma', 'in', 'situ', 'dcis', 'grade', 'nuclear', 'margin', 'negative', 'positive',
+         'estrogen', 'progesterone', 'receptor', 'her2', 'ihc', 'fish', 'score', 'lymph', 'node',
+         'nodes', 'sentinel', 'metastatic', 'no', 'evidence', 'of', 'malignancy', 'atypical',
+         'hyperplasia', 'fibroadenoma', 'specimen', 'received', 'formalin', 'labeled', 'with',
+         'the', 'and', 'a', 'is', 'identified', 'tumor', 'size', 'cm', 'mm', '0.5', '1.2', '3',
+         'lvi', 'present', 'absent', 'calcifications', 'associated', 'focal', 'extensive']
+
+
+def synthetic_reports(num_reports, report_length):
+    reports = []
+    for i in range(num_reports):
+        length = max(1, int(random.gauss(report_length, report_length / 3)))
+        tokens = [random.choice(VOCAB) for _ in range(length)]
+        # sprinkle in rare tokens like accession ids and measurements
+        tokens.extend('s{}-{}'.format(random.randint(0, 99), random.randint(0, 99999)) for _ in range(3))
+        reports.append(' '.join(tokens))
+    return reports
+
+
+def per_token_baseline(texts):
+    '''
+        Tokenization as the datasets did it: one murmurhash call per token,
+        padded with list extends.
+    '''
+    rows = []
+    for raw_text in texts:
+        text = raw_text.split()[:args.max_length]
+        text_indx = [murmurhash3_32(token, positive=True) % args.vocab_size for token in text]
+        if len(text_indx) < args.max_length:
+            text_indx.extend([0 for _ in range(args.max_length - len(text_indx))])
+        rows.append(text_indx)
+    return rows
+
+
+def best_time(fn, texts):
+    times = []
+    for _ in range(args.repeats):
+        start = time.time()
+        fn(texts)
+        times.append(time.time() - start)
+    return min(times)
+
+
+if __name__ == "__main__":
+    random.seed(0)
+    texts = synthetic_reports(args.num_reports, args.report_length)
+
+    baseline = best_time(per_token_baseline, texts)
+    cold = best_time(lambda t: HashingTokenizer(args.vocab_size, args.max_length).tokenize_batch(t), texts)
+    warm_tokenizer = HashingTokenizer(args.vocab_size, args.max_length)
+    warm_tokenizer.tokenize_batch(texts)
+    warm = best_time(warm_tokenizer.tokenize_batch, texts)
+
+    x, lengths = warm_tokenizer.tokenize_batch(texts[:100])
+    assert x.tolist() == per_token_baseline(texts[:100])
+
+    print("{} synthetic reports, ~{} tokens each".format(args.num_reports, args.report_length))
+    for name, seconds in [('per token loop', baseline), ('tokenizer, cold memo', cold), ('tokenizer, warm memo', warm)]:
+        print("{:>22}: {:>10.0f} reports/sec".format(name, args.num_reports / seconds))
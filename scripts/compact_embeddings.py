@@ -0,0 +1,49 @@
+import os, shutil
+from os.path import dirname, realpath
+import sys
+sys.path.append(dirname(dirname(realpath(__file__))))
+import argparse
+import pickle
+from config import Config, get_config_dict
+import oncotext.utils.embedding as embedding
+import oncotext.utils.report_store as report_store
+import tqdm
+import pdb
+
+parser = argparse.ArgumentParser(description='Compact hash embeddings to the buckets used by the report dbs')
+
+parser.add_argument('--compact_path',  type=str, default=Config.EMBEDDING_COMPACT_PATH, help="Place where to write the compact embeddings ")
+parser.add_argument('--remap_path',  type=str, default=Config.EMBEDDING_REMAP_PATH, help="Place where to write the bucket to row remap ")
+parser.add_argument('--kinds', type=str, nargs='*', default=[report_store.TRAIN, report_store.UNLABELED], help="Which dbs to collect tokens from")
+
+args = parser.parse_args()
+
+'''
+Hash every token of every report in the train and unlabeled dbs (all organs
+and users, plus the base train db) with the same murmurhash scheme as the
+datasets, and keep only the embedding rows of buckets that actually occur.
+Snapshots keep working, since their frozen embedding layers are swapped for
+the compact table on load. Re-run after ingesting new vocabulary, unseen
+tokens fall back to the padding row.
+'''
+if __name__ == "__main__":
+    config = get_config_dict()
+    text_key = Config.PREPROCESSED_REPORT_TEXT_KEY
+
+    texts = []
+    db_base = pickle.load(open(Config.DB_BASE_PATH, 'rb'), encoding='bytes')
+    if isinstance(db_base, dict):
+        for organ in db_base:
+            texts.extend(r[text_key] for r in db_base[organ] if text_key in r)
+
+    for kind in args.kinds:
+        for organ in report_store.list_organs(config, kind):
+            for name in report_store.list_users(config, kind, organ):
+                reports = report_store.load_reports(config, kind, organ, name)
+                texts.extend(r[text_key] for r in reports if text_key in r)
+
+    full_embeddings = embedding.load_full_embeddings(config)
+    buckets = embedding.collect_buckets(tqdm.tqdm(texts), len(full_embeddings))
+    shape = embedding.compact_embeddings(full_embeddings, buckets, args.compact_path, args.remap_path)
+    print("From {} texts, kept {} of {} buckets. Compact embeddings of shape {} written to {}".format(
+            len(texts), len(buckets), len(full_embeddings), shape, args.compact_path))
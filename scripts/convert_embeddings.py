@@ -0,0 +1,20 @@
+import os, shutil
+from os.path import dirname, realpath
+import sys
+sys.path.append(dirname(dirname(realpath(__file__))))
+import argparse
+from config import Config
+import oncotext.utils.embedding as embedding
+import pdb
+
+parser = argparse.ArgumentParser(description='Convert pickled embeddings to a memory mappable .npy file')
+
+parser.add_argument('--embedding_path',  type=str, default=Config.EMBEDDING_PATH, help="Place where pickled embeddings are stored ")
+parser.add_argument('--npy_path',  type=str, default=Config.EMBEDDING_NPY_PATH, help="Place where to write the .npy embeddings ")
+
+args = parser.parse_args()
+
+
+if __name__ == "__main__":
+    shape = embedding.convert_pickle_to_npy(args.embedding_path, args.npy_path)
+    print("Converted embeddings of shape {} from {} to {}".format(shape, args.embedding_path, args.npy_path))
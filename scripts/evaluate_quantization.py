@@ -0,0 +1,128 @@
+import os, shutil
+from os.path import dirname, realpath
+import sys
+sys.path.append(dirname(dirname(realpath(__file__))))
+import argparse
+import time
+import numpy as np
+import torch
+from config import Config, get_config_dict
+import oncotext.utils.dataset_factory as dataset_factory
+import oncotext.utils.report_store as report_store
+import oncotext.utils.model_cache as model_cache
+import oncotext.utils.quantization as quantization
+import oncotext.utils.snapshot_meta as snapshot_meta
+import oncotext.inference as inference
+import oncotext.logger as logger
+import pdb
+
+parser = argparse.ArgumentParser(description='Compare the accuracy of quantized models against the fp32 snapshots')
+
+parser.add_argument('--name',  type=str, default=Config.DEFAULT_USERNAME, help="User whose snapshots and train db to use")
+parser.add_argument('--organ',  type=str, default='OrganBreast', help="Organ whose diagnoses to evaluate")
+parser.add_argument('--diagnoses', type=str, nargs='*', default=None, help="Diagnoses to evaluate, all of the organ by default")
+parser.add_argument('--engine',  type=str, default=quantization.INT8, help="Engine to compare against fp32")
+
+LOGPATH = 'LOGS'
+LOGNAME = 'oncotext'
+logger = logger.get_logger(LOGNAME, LOGPATH)
+
+args = parser.parse_args()
+
+
+def get_dev_reports(reports, diagnosis, snapshot_path, text_key):
+    '''
+        Reports annotated for diagnosis that were in the dev split of the
+        snapshot, as saved in its meta at training, None if the snapshot
+        has no saved split (trained before splits were saved, retrain it
+        with mode force).
+    '''
+    meta = snapshot_meta.load_meta(snapshot_path)
+    if meta is None or 'dev_keys' not in meta:
+        return None
+    dev_keys = set(meta['dev_keys'])
+    return [r for r in reports if diagnosis in r and snapshot_meta.get_report_key(r, text_key) in dev_keys]
+
+
+def get_quantized_share(model):
+    '''
+        Fraction of the parameters of model, frozen embeddings aside, in
+        layers the engine converts. Conv layers stay in fp32, so for cnn
+        encoders most of the compute is not converted.
+    '''
+    total, quantized = 0, 0
+    for module in model.modules():
+        if len(list(module.children())) > 0 or isinstance(module, torch.nn.Embedding):
+            continue
+        n = sum(p.numel() for p in module.parameters(recurse=False))
+        total += n
+        if type(module) in quantization.QUANTIZED_LAYERS:
+            quantized += n
+    return quantized / max(total, 1)
+
+
+def label(config, featurized, task_args, embeddings, label_maps, diagnosis, text_key):
+    gen, model = model_cache.get_model(task_args, embeddings, config, logger)
+    start = time.time()
+    preds = inference.test_model(featurized, model, gen, task_args)
+    seconds = time.time() - start
+    labels = dataset_factory.get_labels_from_predictions(preds, featurized, label_maps, diagnosis, task_args, text_key, logger)
+    return labels, seconds
+
+
+if __name__ == "__main__":
+    '''
+        Label the held out dev split of each snapshot (saved with it at
+        training) with the fp32 snapshots and their converted copies, and
+        report accuracy, agreement, the share of parameters the engine
+        converts and the measured speedup per diagnosis.
+    '''
+    config = get_config_dict()
+    engine_config = dict(config, INFERENCE_ENGINE=args.engine)
+    quantization.get_engine(engine_config)
+    text_key = config['PREPROCESSED_REPORT_TEXT_KEY']
+    label_maps = config['POST_DIAGNOSES'][args.organ]
+    diagnoses = args.diagnoses or list(config['DIAGNOSES'][args.organ])
+
+    reports = report_store.load_reports(config, report_store.TRAIN, args.organ, args.name)
+    embeddings, base_args = dataset_factory.get_embedding_tensor(config, config['RATIONALE_NET_ARGS'], logger)
+
+    print("{:>24} {:>6} {:>8} {:>8} {:>8} {:>9} {:>9} {:>8}".format(
+          'diagnosis', 'n', 'fp32', args.engine, 'delta', 'agreement', 'converted', 'speedup'))
+    total_fp32_seconds, total_engine_seconds = 0., 0.
+    for diagnosis in diagnoses:
+        snapshot_path = os.path.join(base_args.model_dir.format(args.name), base_args.model_file.format(diagnosis))
+        if not os.path.exists(snapshot_path):
+            print("{:>24} no snapshot at {}".format(diagnosis, snapshot_path))
+            continue
+        dev_reports = get_dev_reports(reports, diagnosis, snapshot_path, text_key)
+        if dev_reports is None:
+            print("{:>24} no dev split saved with the snapshot, retrain it".format(diagnosis))
+            continue
+        if len(dev_reports) == 0:
+            print("{:>24} no dev reports left in the train db".format(diagnosis))
+            continue
+
+        featurized = dataset_factory.get_featurized_reports(dev_reports, base_args, text_key)
+        task_args = dataset_factory.get_task_args(base_args, label_maps, diagnosis,
+                                                  snapshot=snapshot_path,
+                                                  batch_size=base_args.pred_batch_size,
+                                                  num_workers=0,
+                                                  cuda=False)
+        gold = np.array([str(r[diagnosis]) for r in dev_reports])
+        fp32_labels, fp32_seconds = label(config, featurized, task_args, embeddings, label_maps, diagnosis, text_key)
+        engine_labels, engine_seconds = label(engine_config, featurized, task_args, embeddings, label_maps, diagnosis, text_key)
+        fp32_labels = np.array([str(l) for l in fp32_labels])
+        engine_labels = np.array([str(l) for l in engine_labels])
+
+        _, fp32_model = model_cache.get_model(task_args, embeddings, config, logger)
+        total_fp32_seconds += fp32_seconds
+        total_engine_seconds += engine_seconds
+
+        fp32_accuracy = np.mean(fp32_labels == gold)
+        engine_accuracy = np.mean(engine_labels == gold)
+        print("{:>24} {:>6} {:>8.4f} {:>8.4f} {:>+8.4f} {:>9.4f} {:>8.0%} {:>7.2f}x".format(
+              diagnosis, len(dev_reports), fp32_accuracy, engine_accuracy,
+              engine_accuracy - fp32_accuracy, np.mean(fp32_labels == engine_labels),
+              get_quantized_share(fp32_model), fp32_seconds / max(engine_seconds, 1e-9)))
+    print("{:>24} {:>61.2f}x".format('overall speedup', total_fp32_seconds / max(total_engine_seconds, 1e-9)))
@@ -2,9 +2,11 @@ import os, shutil
 from os.path import dirname, realpath
 import sys
 sys.path.append(dirname(dirname(realpath(__file__))))
-from config import Config
+from config import Config, get_config_dict
 import pickle
 import oncotext.utils.preprocess as preprocess
+import oncotext.utils.report_store as report_store
+import oncotext.utils.dataset_factory as dataset_factory
 import oncotext.logger as logger
 
 
@@ -18,47 +20,67 @@ logger = logger.get_logger(LOGNAME, LOGPATH)
 Run preprocessing on all db's inside train and unlabeled
 '''
 if __name__ == "__main__":
-    ## Load dbs
-
-    ## Run preprocess on each db
+    config = get_config_dict()
 
+    ## Run preprocess on the base db, a report list per organ, or a single
+    ## report list (the empty default)
     db_base = pickle.load(open(Config.DB_BASE_PATH, 'rb'), encoding='bytes')
-    db_base = preprocess.apply_rules(db_base,
-                                     Config.RAW_REPORT_TEXT_KEY,
-                                     Config.PREPROCESSED_REPORT_TEXT_KEY,
-                                     Config.REPORT_TIME_KEY,
-                                     Config.SIDE_KEY,
-                                     logger)
+    if isinstance(db_base, dict):
+        base_lists = db_base.items()
+    else:
+        base_lists = [(Config.DEFAULT_ORGAN, db_base)]
+    preprocessed = []
+    for organ, reports in base_lists:
+        preprocessed.append((organ, preprocess.apply_rules(reports,
+                                                           organ,
+                                                           Config.RAW_REPORT_TEXT_KEY,
+                                                           Config.PREPROCESSED_REPORT_TEXT_KEY,
+                                                           Config.REPORT_TIME_KEY,
+                                                           Config.SIDE_KEY,
+                                                           Config.SEGMENT_ID_KEY,
+                                                           Config.SEGMENT_TYPE_KEY,
+                                                           logger)))
+    db_base = dict(preprocessed) if isinstance(db_base, dict) else preprocessed[0][1]
     pickle.dump(db_base, open(Config.DB_BASE_PATH, 'wb'))
     logger.info(SUCCES_STR.format(Config.DB_BASE_PATH))
 
-    db_paths = [
-                ## have users
-                (Config.DB_TRAIN_PATH, False),
-                (Config.DB_UNLABLED_PATH, True),
-                (Config.DB_NON_BREAST_PATH, True)]
-    for path, make_unique in db_paths:
-        if not os.path.exists(path):
-            continue
-        try:
-            db = pickle.load(open(path,'rb'))
-        except Exception as e:
-            db = pickle.load(open(path, 'rb'), encoding='bytes')
-        for name in db:
-            if make_unique:
-                db[name] = preprocess.remove_duplicates(
-                                        db[name],
+    ## Run preprocess on each user shard of the store. Preprocessing changes
+    ## the report texts, so token ids are hashed again from the new texts
+    try:
+        tokenizer = dataset_factory.get_ingest_tokenizer(config, logger)
+    except Exception as e:
+        logger.warn("Could not get tokenizer, storing reports without token ids. Exception {}".format(e))
+        tokenizer = None
+    db_kinds = [
+                (report_store.TRAIN, False),
+                (report_store.UNLABELED, True),
+                (report_store.NON_BREAST, True)]
+    for kind, make_unique in db_kinds:
+        for organ in report_store.list_organs(config, kind):
+            for name in report_store.list_users(config, kind, organ):
+                reports = report_store.load_reports(config, kind, organ, name)
+                if make_unique:
+                    reports = preprocess.remove_duplicates(
+                                            reports,
+                                            Config.RAW_REPORT_TEXT_KEY,
+                                            Config.PREPROCESSED_REPORT_TEXT_KEY,
+                                            logger)
+
+                reports = preprocess.apply_rules(
+                                        reports,
+                                        organ,
                                         Config.RAW_REPORT_TEXT_KEY,
                                         Config.PREPROCESSED_REPORT_TEXT_KEY,
+                                        Config.REPORT_TIME_KEY,
+                                        Config.SIDE_KEY,
+                                        Config.SEGMENT_ID_KEY,
+                                        Config.SEGMENT_TYPE_KEY,
                                         logger)
-
-            db[name] = preprocess.apply_rules(
-                                    db[name],
-                                    Config.RAW_REPORT_TEXT_KEY,
-                                    Config.PREPROCESSED_REPORT_TEXT_KEY,
-                                    Config.REPORT_TIME_KEY,
-                                    Config.SIDE_KEY,
-                                    logger)
-            logger.info("Len of DB {} {} is now {}".format(path, name, len(db[name])))
-        pickle.dump(db, open(path,'wb'))
-        logger.info(SUCCES_STR.format(path))
+                token_ids, hashing = None, None
+                if tokenizer is not None:
+                    token_ids = tokenizer.bucket_ids([r[Config.PREPROCESSED_REPORT_TEXT_KEY] for r in reports])
+                    hashing = tokenizer.hashing_key
+                count = report_store.replace_reports(config, kind, organ, name, reports, token_ids, hashing)
+                path = report_store.get_shard_path(config, kind, organ, name)
+                logger.info("Len of DB {} is now {}".format(path, count))
+                logger.info(SUCCES_STR.format(path))
@@ -0,0 +1,37 @@
+import os, shutil
+from os.path import dirname, realpath
+import sys
+sys.path.append(dirname(dirname(realpath(__file__))))
+from config import Config, get_config_dict
+import oncotext.utils.report_store as report_store
+import oncotext.logger as logger
+import argparse
+import pdb
+
+parser = argparse.ArgumentParser(description='Migrate pickled report dbs into the report store')
+
+parser.add_argument('--organs', type=str, nargs='*', default=None, help="Organs to migrate. Defaults to all organs in the config xlsx, plus Meta")
+parser.add_argument('--kinds', type=str, nargs='*', default=[report_store.TRAIN, report_store.UNLABELED, report_store.NON_BREAST], help="Which dbs to migrate")
+
+SUCCES_STR = "Migrated {} {} db for users {}"
+LOGPATH = 'LOGS'
+LOGNAME = 'oncotext'
+logger = logger.get_logger(LOGNAME, LOGPATH)
+
+args = parser.parse_args()
+
+'''
+Copy every reportDBAPI_<kind>_<organ>.p pickle into the append-only report
+store used by app.py. Pickles are left in place, and users already in the
+store are skipped, so it is safe to re-run.
+'''
+if __name__ == "__main__":
+    config = get_config_dict()
+    organs = args.organs
+    if organs is None:
+        organs = list(Config.COLUMN_KEYS.keys()) + [Config.META_KEY]
+
+    for kind in args.kinds:
+        for organ in organs:
+            migrated = report_store.migrate_pickle(config, kind, organ, logger)
+            logger.info(SUCCES_STR.format(kind, organ, migrated))
@@ -7,6 +7,7 @@ import argparse
 from config import Config
 import gensim.models.word2vec as word2vec
 import oncotext.utils.preprocess as preprocess
+import oncotext.utils.embedding as embedding
 import tqdm
 import pdb
 
@@ -14,6 +15,7 @@ parser = argparse.ArgumentParser(description='Embeddings Producer with Gensim Wo
 
 parser.add_argument('--reports_path',  type=str, default=os.path.join(Config.PICKLE_DIR, 'reportDBAPI_test_Meta.p'), help="Place where reports are stored ")
 parser.add_argument('--embedding_path',  type=str, default=os.path.join(Config.PICKLE_DIR, 'hash_embeddings.p'), help="Place where embeddings are stored ")
+parser.add_argument('--npy_path',  type=str, default=os.path.join(Config.PICKLE_DIR, 'hash_embeddings.npy'), help="Place where memory mappable embeddings are stored ")
 parser.add_argument('--word2indx_path',  type=str, default=os.path.join(Config.PICKLE_DIR, 'vocabIndxDict.p'), help="Place where word2indx are stored ")
 parser.add_argument('--user',  type=str, default='default', help="user who's reports to use")
 parser.add_argument('--dim',  type=int, default=200, help="Dimension for embedding")
@@ -47,6 +49,7 @@ if __name__ == "__main__":
     vocab = model.wv.vocab
     vocab_to_indx = {v: vocab[v].index for v in vocab}
     pickle.dump(embeddings, open(args.embedding_path,'wb'))
+    embedding.convert_pickle_to_npy(args.embedding_path, args.npy_path)
     pickle.dump(vocab_to_indx, open(args.word2indx_path,'wb'))
 
 
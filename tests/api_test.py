@@ -1,18 +1,39 @@
 import json
+import argparse
 import sys
 import os
 from os.path import dirname, realpath
 sys.path.append(dirname(dirname(realpath(__file__))))
+sys.path.append(os.path.join(dirname(dirname(realpath(__file__))), 'text_nn'))
 import requests
 import unittest
+import logging
 import pdb
 import pickle
 import uuid
-from config import Config
+import random
+import tempfile
+import time
+import copy
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import torch
+from sklearn.utils import murmurhash3_32
+from config import Config, get_config_dict
+import oncotext.utils.report_store as report_store
+import oncotext.utils.tokenizer as tokenizer
+import oncotext.utils.embedding as embedding
+import oncotext.utils.model_cache as model_cache
+import oncotext.utils.quantization as quantization
+import oncotext.jobs as jobs
+import oncotext.utils.postprocess as postprocess
+import oncotext.utils.inference_cache as inference_cache
+import oncotext.rationale_net_wrapper as rationale_net_wrapper
+import oncotext.multitask as multitask
+import oncotext.utils.snapshot_meta as snapshot_meta
 
 DOMAIN = "http://localhost:5000/"
-TRAIN_DB_PATH = Config.DB_TRAIN_PATH
-UNK_DB_PATH = Config.DB_UNLABLED_PATH
+CONFIG = get_config_dict()
 
 ADDITIONAL_DATA = [{ }]
 FAKE_REPORT_TEXT = "Foo blah blah DCIS glue"
@@ -20,6 +41,28 @@ ADDITIONAL_DATA[0][Config.RAW_REPORT_TEXT_KEY] = FAKE_REPORT_TEXT
 ADDITIONAL_DATA[0]['DCIS'] = '1'
 
 
+class TinyModel(torch.nn.Module):
+    '''
+        Smallest model with the layout of the snapshots: a frozen embedding
+        layer and a Linear one.
+    '''
+
+    def __init__(self):
+        super(TinyModel, self).__init__()
+        self.embedding_layer = torch.nn.Embedding(10, 4)
+        self.embedding_layer.weight.requires_grad = False
+        self.fc = torch.nn.Linear(4, 2)
+
+    def forward(self, x):
+        return self.fc(self.embedding_layer(x).mean(1))
+
+
+def touch(path):
+    # A retrain rewrites the snapshot, moving its mtime
+    stat = os.stat(path)
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+
+
 class Test_MIT_App(unittest.TestCase):
 
     def setUp(self):
@@ -28,19 +71,8 @@ class Test_MIT_App(unittest.TestCase):
         self.prod_name = "default"
 
     def tearDown(self):
-        with open(TRAIN_DB_PATH,'rb') as f:
-            train_db = pickle.load(f, encoding='bytes')
-        if self.name in train_db:
-            del train_db[self.name]
-            with open(TRAIN_DB_PATH, 'wb') as f:
-                pickle.dump(train_db, f)
-
-        with open(UNK_DB_PATH,'rb') as f:
-            unk_db = pickle.load( f, encoding='bytes')
-        if self.name in unk_db:
-            del unk_db[self.name]
-            with open(UNK_DB_PATH, 'wb') as f:
-                pickle.dump(unk_db, f)
+        for kind in [report_store.TRAIN, report_store.UNLABELED]:
+            report_store.remove_user(CONFIG, kind, Config.DEFAULT_ORGAN, self.name)
 
     def test_add_train(self):
         payload = json.dumps(ADDITIONAL_DATA)
@@ -63,6 +95,163 @@ class Test_MIT_App(unittest.TestCase):
 
         self.assertEqual(response.status_code, 200)
 
+    def test_add_unk_only_writes_user_shard(self):
+        payload = json.dumps(ADDITIONAL_DATA)
+        params = {"name":self.name}
+        default_count = report_store.count_reports(CONFIG, report_store.UNLABELED, Config.DEFAULT_ORGAN, self.prod_name)
+
+        response = requests.post( os.path.join(DOMAIN, 'addUnlabeled'),
+                                 data=payload,
+                                 params=params )
+        self.assertEqual(response.status_code, 200)
+
+        self.assertEqual(report_store.count_reports(CONFIG, report_store.UNLABELED, Config.DEFAULT_ORGAN, self.name), 1)
+        self.assertEqual(report_store.count_reports(CONFIG, report_store.UNLABELED, Config.DEFAULT_ORGAN, self.prod_name), default_count)
+        self.assertIn(self.name, report_store.list_users(CONFIG, report_store.UNLABELED, Config.DEFAULT_ORGAN))
+
+    def test_store_writes_to_other_shards_do_not_wait(self):
+        organ = Config.DEFAULT_ORGAN
+        other = "{}-other".format(self.name)
+        path = report_store.get_shard_path(CONFIG, report_store.UNLABELED, organ, other)
+        try:
+            # A write in progress on another user's shard
+            with report_store._get_shard_lock(path):
+                with ThreadPoolExecutor(max_workers=1) as executor:
+                    future = executor.submit(report_store.add_reports, CONFIG, report_store.UNLABELED,
+                                             organ, self.name, [{'ID': 'a', 'text': 'a'}])
+                    self.assertEqual(future.result(timeout=30), 1)
+        finally:
+            report_store.remove_user(CONFIG, report_store.UNLABELED, organ, other)
+
+    def test_store_reads_token_ids_with_their_reports(self):
+        organ = Config.DEFAULT_ORGAN
+        first = [{'ID': 'a', 'text': 'a'}, {'ID': 'b', 'text': 'b'}]
+        second = [{'ID': 'c', 'text': 'c'}, {'ID': 'd', 'text': 'd'}]
+        report_store.add_reports(CONFIG, report_store.UNLABELED, organ, self.name, first, [[1], [2]], 'test')
+        report_store.replace_reports(CONFIG, report_store.UNLABELED, organ, self.name, second, [[3], [4]], 'test')
+
+        reports, token_ids, hashing = report_store.load_shard(CONFIG, report_store.UNLABELED, organ, self.name)
+        self.assertEqual([r['ID'] for r in reports], ['c', 'd'])
+        self.assertEqual([list(ids) for ids in token_ids], [[3], [4]])
+        self.assertEqual(hashing, 'test')
+
+    def test_inference_cache_replaces_labels_and_keeps_totals(self):
+        config = dict(CONFIG, INFERENCE_CACHE_PATH=os.path.join(tempfile.mkdtemp(), 'inference_cache.db'))
+        reports = [{'text': 'a'}, {'text': 'b'}]
+        cache = inference_cache.InferenceCache(config, Config.DEFAULT_ORGAN, reports, 'text')
+        cache.store('DCIS', 'fingerprint', {0: '1', 1: '0'})
+        cache.store('DCIS', 'fingerprint', {0: '10'})
+
+        self.assertEqual(cache.lookup('DCIS', 'fingerprint', [0, 1]), {0: '10', 1: '0'})
+        conn = inference_cache.connect(config['INFERENCE_CACHE_PATH'])
+        try:
+            nbytes = conn.execute('SELECT SUM(nbytes) FROM inferences').fetchone()[0]
+        finally:
+            conn.close()
+        self.assertEqual(inference_cache.get_stats(config), {'entries': 2, 'bytes': nbytes})
+
+    def test_compacted_embeddings_match_full_rows(self):
+        num_buckets = 50
+        directory = tempfile.mkdtemp()
+        config = dict(CONFIG, EMBEDDING_COMPACT_PATH=os.path.join(directory, 'compact.npy'),
+                      EMBEDDING_REMAP_PATH=os.path.join(directory, 'remap.npy'))
+        full = np.random.RandomState(0).randn(num_buckets, 4).astype(np.float32)
+        texts = ["dcis grade 2", "er positive pr negative"]
+        buckets = embedding.collect_buckets(texts, num_buckets)
+        embedding.compact_embeddings(full, buckets, config['EMBEDDING_COMPACT_PATH'], config['EMBEDDING_REMAP_PATH'])
+
+        self.assertTrue(embedding.is_compacted(config))
+        compact = embedding.load_embeddings(config)
+        remap = embedding.load_bucket_remap(config)
+        self.assertEqual(compact.shape, (len(buckets), 4))
+        self.assertEqual(embedding.get_num_buckets(config), num_buckets)
+        # Every token looks up the row it had in the full matrix
+        raw, _ = tokenizer.HashingTokenizer(num_buckets, 8).tokenize_batch(texts)
+        remapped, _ = tokenizer.HashingTokenizer(num_buckets, 8, bucket_remap=remap).tokenize_batch(texts)
+        self.assertTrue(np.array_equal(compact[remapped], full[raw]))
+        unseen = [b for b in range(num_buckets) if b not in set(buckets.tolist())]
+        self.assertTrue(len(unseen) > 0 and (remap[unseen] == 0).all())
+
+    def test_model_cache_reloads_retrained_snapshot(self):
+        snapshot_path = os.path.join(tempfile.mkdtemp(), 'oncotext_DCIS.pt')
+        open(snapshot_path, 'w').close()
+        args = argparse.Namespace(snapshot=snapshot_path)
+        embeddings = np.random.RandomState(0).randn(10, 4).astype(np.float32)
+        config = dict(CONFIG, INFERENCE_ENGINE=quantization.FP32)
+        logger = logging.getLogger('api_test')
+        loads = []
+
+        def load():
+            loads.append(snapshot_path)
+            return None, TinyModel()
+
+        _, first = model_cache.get_model(args, embeddings, config, logger, load)
+        _, again = model_cache.get_model(args, embeddings, config, logger, load)
+        self.assertIs(again, first)
+        self.assertEqual(len(loads), 1)
+        self.assertTrue(np.array_equal(first.embedding_layer.weight.numpy(), embeddings))
+
+        touch(snapshot_path)
+        _, retrained = model_cache.get_model(args, embeddings, config, logger, load)
+        self.assertIsNot(retrained, first)
+        self.assertEqual(len(loads), 2)
+
+    def test_int8_snapshot_converts_and_reloads(self):
+        snapshot_path = os.path.join(tempfile.mkdtemp(), 'oncotext_DCIS.pt')
+        open(snapshot_path, 'w').close()
+        args = argparse.Namespace(snapshot=snapshot_path)
+        embeddings = np.random.RandomState(0).randn(10, 4).astype(np.float32)
+        config = dict(CONFIG, INFERENCE_ENGINE=quantization.INT8)
+        logger = logging.getLogger('api_test')
+        fp32 = TinyModel()
+        embedding.share_model_embeddings([fp32], embeddings)
+
+        _, converted = model_cache.get_model(args, embeddings, config, logger,
+                                             lambda: (None, copy.deepcopy(fp32)))
+        self.assertIsNot(type(converted.fc), torch.nn.Linear)
+        self.assertTrue(os.path.exists(quantization.get_quantized_path(snapshot_path, quantization.INT8)))
+
+        fingerprint = model_cache.get_snapshot_fingerprint(snapshot_path)
+        _, reloaded = quantization.load_quantized(snapshot_path, quantization.INT8, fingerprint)
+        embedding.share_model_embeddings([reloaded], embeddings)
+        x = torch.LongTensor([[1, 2, 3, 0]])
+        with torch.no_grad():
+            self.assertTrue(torch.equal(reloaded(x), converted(x)))
+            self.assertTrue(torch.allclose(converted(x), fp32(x), atol=0.05))
+
+        # The converted copy of an older version of the snapshot is not used
+        touch(snapshot_path)
+        self.assertIsNone(quantization.load_quantized(snapshot_path, quantization.INT8,
+                                                      model_cache.get_snapshot_fingerprint(snapshot_path)))
+
+    def test_tokenizer_matches_per_token_hashing(self):
+        num_buckets, max_length = 1000, 8
+        texts = ["dcis grade 2 no invasive carcinoma", "",
+                 " ".join("token{}".format(i) for i in range(20)), "er positive pr positive"]
+
+        def per_token(text):
+            ids = [murmurhash3_32(token, positive=True) % num_buckets for token in text.split()[:max_length]]
+            return ids + [0] * (max_length - len(ids))
+        expected = [per_token(text) for text in texts]
+
+        # A memo too small for the vocabulary takes the overflow path
+        for cache_size in [tokenizer.DEFAULT_CACHE_SIZE, 3]:
+            hashing = tokenizer.HashingTokenizer(num_buckets, max_length, cache_size=cache_size)
+            for _ in range(2):
+                x, lengths = hashing.tokenize_batch(texts)
+                self.assertEqual(x.tolist(), expected)
+                self.assertEqual(lengths.tolist(), [min(len(t.split()), max_length) for t in texts])
+
+        # Token ids stored at ingest give the same matrix, remapped alike
+        remap = np.arange(num_buckets, dtype=np.int32)[::-1].copy()
+        hashing = tokenizer.HashingTokenizer(num_buckets, max_length, bucket_remap=remap)
+        token_ids = hashing.bucket_ids(texts)
+        token_ids[1] = None
+        x, _ = hashing.featurize(texts, token_ids)
+        self.assertEqual(x.tolist(), hashing.tokenize_batch(texts)[0].tolist())
+        padded = np.array(expected)
+        self.assertEqual(x[padded > 0].tolist(), remap[padded[padded > 0]].tolist())
+
     def test_full_predict_flow(self):
         payload = json.dumps(ADDITIONAL_DATA)
         params = {"name":self.name}
@@ -85,6 +274,409 @@ class Test_MIT_App(unittest.TestCase):
                                  params=params )
         self.assertEqual(response.status_code, 200)
 
+    def test_incremental_predict_matches_full(self):
+        payload = json.dumps(ADDITIONAL_DATA)
+        params = {"name":self.name}
+
+        response = requests.post( os.path.join(DOMAIN, 'addUnlabeled'),
+                                 data=payload,
+                                 params=params )
+        self.assertEqual(response.status_code, 200)
+        full = requests.get( os.path.join(DOMAIN, 'predict'),
+                             params=params )
+        self.assertEqual(full.status_code, 200)
+        for _ in range(2):
+            incremental = requests.get( os.path.join(DOMAIN, 'predict'),
+                                        params=dict(params, incremental='true') )
+            self.assertEqual(incremental.status_code, 200)
+            self.assertEqual(incremental.json()['reportDB'], full.json()['reportDB'])
+
+    def test_streaming_predict_matches_full(self):
+        payload = json.dumps(ADDITIONAL_DATA)
+        params = {"name":self.name}
+
+        response = requests.post( os.path.join(DOMAIN, 'addUnlabeled'),
+                                 data=payload,
+                                 params=params )
+        self.assertEqual(response.status_code, 200)
+        full = requests.get( os.path.join(DOMAIN, 'predict'),
+                             params=params )
+        self.assertEqual(full.status_code, 200)
+        streamed = requests.get( os.path.join(DOMAIN, 'predict'),
+                                 params=dict(params, stream='true'),
+                                 headers={'Accept-Encoding': 'gzip'},
+                                 stream=True )
+        self.assertEqual(streamed.status_code, 200)
+        lines = [json.loads(line) for line in streamed.iter_lines() if line]
+        self.assertEqual([l['report'] for l in lines[:-1]], full.json()['reportDB'])
+        self.assertEqual(lines[-1]['results'], full.json()['results'])
+
+    def test_predict_routes_meta_reports_by_organ(self):
+        payload = json.dumps(ADDITIONAL_DATA)
+        params = {"name":self.name}
+
+        response = requests.post( os.path.join(DOMAIN, 'addUnlabeled'),
+                                 data=payload,
+                                 params=params )
+        self.assertEqual(response.status_code, 200)
+        response = requests.get( os.path.join(DOMAIN, 'predict'),
+                                 params=params )
+        self.assertEqual(response.status_code, 200)
+        for report in response.json()['reportDB']:
+            for organ in postprocess.get_routed_organs(CONFIG):
+                # Train reports may correct the organ label after routing
+                if report[organ] == '1' and report['train'] == '0':
+                    self.assertTrue(all(d in report for d in CONFIG['DIAGNOSES'][organ]))
+
+    def test_rules_follow_routing_when_train_corrects_organ(self):
+        meta = CONFIG['META_KEY']
+        text_key = CONFIG['PREPROCESSED_REPORT_TEXT_KEY']
+        routed_organs = postprocess.get_routed_organs(CONFIG)
+        logger = logging.getLogger('api_test')
+
+        # Predicted in no routed organ, so labeled by the Meta models only,
+        # while the train db says it is in every one of them
+        unrouted = {d: '0' for d in CONFIG['DIAGNOSES'][meta]}
+        unrouted[text_key] = FAKE_REPORT_TEXT
+        train_report = dict(unrouted)
+        for organ in routed_organs:
+            train_report[organ] = '1'
+        # Routed to every organ and labeled by their models
+        routed = {d: '1' for d in CONFIG['DIAGNOSES'][meta]}
+        routed[text_key] = FAKE_REPORT_TEXT + " routed"
+        for organ in routed_organs:
+            labels = self.fake_labels(organ, 1, random.Random(0))
+            routed.update({d: labels[d][0] for d in labels})
+
+        reports = postprocess.apply_rules([unrouted, routed], [train_report], meta, CONFIG, logger)
+        for organ in routed_organs:
+            self.assertEqual(reports[0][organ], '1')
+        self.assertEqual(reports[0]['train'], '1')
+        self.assertNotIn('cancer', reports[0])
+        if 'OrganBreast' in routed_organs:
+            self.assertIn('cancer', reports[1])
+
+    def get_train_data(self, num_reports, suffix=''):
+        # Distinct texts, so the dev split of each model is not empty
+        return [{Config.RAW_REPORT_TEXT_KEY: "{} {}{}".format(FAKE_REPORT_TEXT, i, suffix),
+                 'DCIS': str(i % 2)} for i in range(num_reports)]
+
+    def get_snapshot_path(self, diagnosis):
+        return os.path.join(CONFIG['RATIONALE_NET_CONFIG']['model_dir'].format(self.name),
+                            CONFIG['RATIONALE_NET_CONFIG']['model_file'].format(diagnosis))
+
+    def test_incremental_train_warm_starts_on_changed_data(self):
+        params = {"name":self.name}
+
+        response = requests.post( os.path.join(DOMAIN, 'addTrain'),
+                                 data=json.dumps(self.get_train_data(10)),
+                                 params=params )
+        self.assertEqual(response.status_code, 200)
+        full = requests.get( os.path.join(DOMAIN, 'train'),
+                             params=params )
+        self.assertEqual(full.status_code, 200)
+        snapshot_path = self.get_snapshot_path('DCIS')
+        mtime = os.stat(snapshot_path).st_mtime_ns
+
+        unchanged = requests.get( os.path.join(DOMAIN, 'train'),
+                                  params=dict(params, mode='incremental') )
+        self.assertEqual(unchanged.status_code, 200)
+        self.assertEqual(os.stat(snapshot_path).st_mtime_ns, mtime)
+
+        response = requests.post( os.path.join(DOMAIN, 'addTrain'),
+                                 data=json.dumps(self.get_train_data(10, ' new')),
+                                 params=params )
+        self.assertEqual(response.status_code, 200)
+        incremental = requests.get( os.path.join(DOMAIN, 'train'),
+                                    params=dict(params, mode='incremental') )
+        self.assertEqual(incremental.status_code, 200)
+        self.assertNotEqual(os.stat(snapshot_path).st_mtime_ns, mtime)
+        self.assertEqual(snapshot_meta.load_meta(snapshot_path)['init_snapshot'], snapshot_path)
+        result = [r for r in incremental.json()['results'] if r['NAME'] == 'DCIS'][0]
+        self.assertIsInstance(result['ACCURACY'], float)
+
+    def test_multitask_train_and_predict(self):
+        params = {"name":self.name}
+        organ = Config.DEFAULT_ORGAN
+        label_maps = CONFIG['POST_DIAGNOSES'][organ]
+
+        for route, data in [('addTrain', self.get_train_data(10)), ('addUnlabeled', ADDITIONAL_DATA)]:
+            response = requests.post( os.path.join(DOMAIN, route),
+                                     data=json.dumps(data),
+                                     params=params )
+            self.assertEqual(response.status_code, 200)
+        response = requests.get( os.path.join(DOMAIN, 'train'),
+                                 params=dict(params, mode='multitask') )
+        self.assertEqual(response.status_code, 200)
+        results = response.json()['results']
+        self.assertEqual([r['NAME'] for r in results], list(CONFIG['DIAGNOSES'][organ]))
+        for result in results:
+            # None where the dev split has no report annotated for it
+            for key in ['ACCURACY', 'PRECISION', 'RECALL', 'F1']:
+                self.assertTrue(result[key] is None or isinstance(result[key], float))
+        dcis = [r for r in results if r['NAME'] == 'DCIS'][0]
+        self.assertTrue(0 <= dcis['ACCURACY'] <= 1 and 0 <= dcis['F1'] <= 1)
+
+        snapshot_path = os.path.join(CONFIG['RATIONALE_NET_CONFIG']['model_dir'].format(self.name),
+                                     multitask.MODEL_FILE.format(organ))
+        diagnoses = multitask.get_diagnoses(snapshot_path)
+        self.assertIn('DCIS', diagnoses)
+        full = requests.get( os.path.join(DOMAIN, 'predict'),
+                             params=params )
+        self.assertEqual(full.status_code, 200)
+        predicted = requests.get( os.path.join(DOMAIN, 'predict'),
+                                  params=dict(params, multitask='true') )
+        self.assertEqual(predicted.status_code, 200)
+        reports = predicted.json()['reportDB']
+        self.assertEqual(len(reports), len(full.json()['reportDB']))
+        for report in reports:
+            for diagnosis in diagnoses:
+                self.assertIn(diagnosis, report)
+                if label_maps[diagnosis] != ["NUM"]:
+                    self.assertIn(report[diagnosis], label_maps[diagnosis])
+
+    def test_parallel_train_matches_in_process(self):
+        params = {"name":self.name}
+        organ = Config.DEFAULT_ORGAN
+        response = requests.post( os.path.join(DOMAIN, 'addTrain'),
+                                 data=json.dumps(self.get_train_data(10)),
+                                 params=params )
+        self.assertEqual(response.status_code, 200)
+
+        reports = report_store.load_reports(CONFIG, report_store.TRAIN, organ, self.name)
+        logger = logging.getLogger('api_test')
+        parallel = rationale_net_wrapper.train(self.name, organ, reports, dict(CONFIG, TRAIN_WORKERS=2),
+                                               logger, mode=rationale_net_wrapper.FORCE)
+        dcis = [r for r in parallel if r['NAME'] == 'DCIS'][0]
+        self.assertIsInstance(dcis['ACCURACY'], float)
+        # Models trained in the pool are kept by an in-process run on the same data
+        in_process = rationale_net_wrapper.train(self.name, organ, reports, dict(CONFIG, TRAIN_WORKERS=1), logger)
+        self.assertEqual(in_process, parallel)
+
+    def test_sharded_predict_matches_in_process(self):
+        payload = json.dumps(ADDITIONAL_DATA)
+        params = {"name":self.name}
+
+        response = requests.post( os.path.join(DOMAIN, 'addTrain'),
+                                 data=payload,
+                                 params=params )
+        self.assertEqual(response.status_code, 200)
+        response = requests.get( os.path.join(DOMAIN, 'train'),
+                                 params=params )
+        self.assertEqual(response.status_code, 200)
+
+        train_reports = report_store.load_reports(CONFIG, report_store.TRAIN, Config.DEFAULT_ORGAN, self.name)
+        reports = [dict(r) for r in train_reports * 3]
+        logger = logging.getLogger('api_test')
+        in_process = rationale_net_wrapper.label_reports(self.name, Config.DEFAULT_ORGAN, reports,
+                                                         dict(CONFIG, INFERENCE_WORKERS=1), logger)
+        sharded = rationale_net_wrapper.label_reports(self.name, Config.DEFAULT_ORGAN, reports,
+                                                      dict(CONFIG, INFERENCE_WORKERS=2, INFERENCE_SHARD_MIN_REPORTS=1),
+                                                      logger)
+        self.assertEqual(sharded, in_process)
+
+    def test_length_bucketed_predict_matches_padded(self):
+        payload = json.dumps(ADDITIONAL_DATA)
+        params = {"name":self.name}
+
+        response = requests.post( os.path.join(DOMAIN, 'addTrain'),
+                                 data=payload,
+                                 params=params )
+        self.assertEqual(response.status_code, 200)
+        response = requests.get( os.path.join(DOMAIN, 'train'),
+                                 params=params )
+        self.assertEqual(response.status_code, 200)
+
+        reports = report_store.load_reports(CONFIG, report_store.TRAIN, Config.DEFAULT_ORGAN, self.name)
+        logger = logging.getLogger('api_test')
+        padded = rationale_net_wrapper.label_reports(self.name, Config.DEFAULT_ORGAN, [dict(r) for r in reports],
+                                                     dict(CONFIG, LENGTH_BUCKETED_INFERENCE=False), logger)
+        bucketed = rationale_net_wrapper.label_reports(self.name, Config.DEFAULT_ORGAN, [dict(r) for r in reports],
+                                                       dict(CONFIG, LENGTH_BUCKETED_INFERENCE=True), logger)
+        self.assertEqual(bucketed, padded)
+
+    def fake_labels(self, organ, num_reports, rng):
+        # Every other report has no cancer, so the gates of the plan skip it
+        labels = {}
+        for diagnosis in CONFIG['DIAGNOSES'][organ]:
+            values = CONFIG['POST_DIAGNOSES'][organ][diagnosis]
+            labels[diagnosis] = []
+            for i in range(num_reports):
+                if values == ["NUM"]:
+                    labels[diagnosis].append(str(rng.randint(1, 5)))
+                elif i % 2 == 0 and '0' in values:
+                    labels[diagnosis].append('0')
+                else:
+                    labels[diagnosis].append(rng.choice(values))
+        return labels
+
+    def test_cascaded_plan_matches_ungated_labels(self):
+        rng = random.Random(0)
+        num_reports = 50
+        for organ in ['OrganBreast', 'OrganProstate']:
+            predicted = self.fake_labels(organ, num_reports, rng)
+            plan = postprocess.get_inference_plan(organ, CONFIG['DIAGNOSES'][organ], CONFIG)
+            self.assertEqual(sorted(d for d, _ in plan), sorted(CONFIG['DIAGNOSES'][organ]))
+
+            gated = {}
+            skipped = set()
+            for diagnosis, gate in plan:
+                gated[diagnosis] = list(predicted[diagnosis])
+                if gate is None:
+                    continue
+                is_needed, skip_label = gate
+                for i in range(num_reports):
+                    if not is_needed(gated, i):
+                        gated[diagnosis][i] = skip_label
+                        skipped.add(diagnosis)
+
+            if organ == 'OrganBreast':
+                self.assertTrue(set(CONFIG['MARKERS']) & skipped)
+                self.assertIn('GradeMaxDCIS', skipped)
+                self.assertIn('GradeMaxInvasive', skipped)
+            else:
+                numerical = [d for d in CONFIG['DIAGNOSES'][organ] if CONFIG['POST_DIAGNOSES'][organ][d] == ["NUM"]]
+                self.assertTrue(len(numerical) > 0 and set(numerical) <= skipped)
+
+            ungated_reports = [{d: predicted[d][i] for d in predicted} for i in range(num_reports)]
+            gated_reports = [{d: gated[d][i] for d in gated} for i in range(num_reports)]
+            self.assertEqual(postprocess.generate_automatic_feilds(gated_reports, organ, CONFIG),
+                             postprocess.generate_automatic_feilds(ungated_reports, organ, CONFIG))
+
+    def test_train_fingerprint_covers_labels_and_embeddings(self):
+        args = argparse.Namespace(**CONFIG['RATIONALE_NET_CONFIG'])
+        fingerprint = snapshot_meta.get_train_fingerprint('data', args, {'DCIS': ['0', '1']}, 'embeddings')
+        self.assertEqual(snapshot_meta.get_train_fingerprint('data', args, {'DCIS': ['0', '1']}, 'embeddings'),
+                         fingerprint)
+        self.assertNotEqual(snapshot_meta.get_train_fingerprint('data', args, {'DCIS': ['1', '0']}, 'embeddings'),
+                            fingerprint)
+        self.assertNotEqual(snapshot_meta.get_train_fingerprint('data', args, {'DCIS': ['0', '1']}, 'regenerated'),
+                            fingerprint)
+
+    def test_train_skips_unchanged_models(self):
+        payload = json.dumps(ADDITIONAL_DATA)
+        params = {"name":self.name}
+
+        response = requests.post( os.path.join(DOMAIN, 'addTrain'),
+                                 data=payload,
+                                 params=params )
+        self.assertEqual(response.status_code, 200)
+        first = requests.get( os.path.join(DOMAIN, 'train'),
+                              params=params )
+        self.assertEqual(first.status_code, 200)
+        snapshot_path = os.path.join(CONFIG['RATIONALE_NET_CONFIG']['model_dir'].format(self.name),
+                                     CONFIG['RATIONALE_NET_CONFIG']['model_file'].format('DCIS'))
+        mtime = os.stat(snapshot_path).st_mtime_ns
+        second = requests.get( os.path.join(DOMAIN, 'train'),
+                               params=params )
+        self.assertEqual(second.status_code, 200)
+        self.assertEqual(second.json()['results'], first.json()['results'])
+        self.assertEqual(os.stat(snapshot_path).st_mtime_ns, mtime)
+
+    def test_predict_text(self):
+        payload = json.dumps(ADDITIONAL_DATA)
+        params = {"name":self.name, "organ":"OrganBreast"}
+
+        response = requests.post( os.path.join(DOMAIN, 'predictText'),
+                                  data=payload,
+                                  params=params )
+        self.assertEqual(response.status_code, 200)
+        reports = response.json()['reportDB']
+        self.assertTrue(len(reports) > 0)
+        self.assertIn('cancer', reports[0])
+        self.assertFalse(report_store.has_user(CONFIG, report_store.UNLABELED, "OrganBreast", self.name))
+
+    def test_concurrent_predict_text(self):
+        payload = json.dumps(ADDITIONAL_DATA)
+        params = {"name":self.name, "organ":"OrganBreast"}
+        before = requests.get( os.path.join(DOMAIN, 'stats') ).json()['micro_batching']
+
+        with ThreadPoolExecutor(max_workers=8) as pool:
+            responses = list(pool.map(lambda i: requests.post( os.path.join(DOMAIN, 'predictText'),
+                                                               data=payload,
+                                                               params=params ),
+                                      range(8)))
+        for response in responses:
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.json()['reportDB'][0]['cancer'], responses[0].json()['reportDB'][0]['cancer'])
+
+        after = requests.get( os.path.join(DOMAIN, 'stats') ).json()['micro_batching']
+        self.assertEqual(after['requests'] - before['requests'], 8)
+        self.assertTrue(after['batches'] - before['batches'] <= 8)
+
+    def test_predict_text_rejects_large_batches(self):
+        payload = json.dumps(ADDITIONAL_DATA * (CONFIG['PREDICT_TEXT_MAX_REPORTS'] + 1))
+        response = requests.post( os.path.join(DOMAIN, 'predictText'),
+                                  data=payload,
+                                  params={"name":self.name} )
+        self.assertEqual(response.status_code, 400)
+
+    def wait_for_job(self, job_id, timeout=600):
+        for _ in range(timeout):
+            response = requests.get( os.path.join(DOMAIN, 'jobs', job_id) )
+            self.assertEqual(response.status_code, 200)
+            job = response.json()
+            if job['status'] in ['done', 'failed']:
+                return job
+            time.sleep(1)
+        self.fail("job {} did not finish".format(job_id))
+
+    def test_async_predict_flow(self):
+        payload = json.dumps(ADDITIONAL_DATA)
+        params = {"name":self.name}
+
+        response = requests.post( os.path.join(DOMAIN, 'addUnlabeled'),
+                                 data=payload,
+                                 params=params )
+        self.assertEqual(response.status_code, 200)
+        response = requests.get( os.path.join(DOMAIN, 'trainAsync'),
+                                 params=params )
+        self.assertEqual(response.status_code, 500)
+        response = requests.post( os.path.join(DOMAIN, 'addTrain'),
+                                 data=payload,
+                                 params=params )
+        self.assertEqual(response.status_code, 200)
+        response = requests.get( os.path.join(DOMAIN, 'trainAsync'),
+                                 params=params )
+        self.assertEqual(response.status_code, 202)
+        job = self.wait_for_job(response.json()['job_id'])
+        self.assertEqual(job['status'], 'done')
+        self.assertEqual(job['progress']['done'], job['progress']['total'])
+        response = requests.get( os.path.join(DOMAIN, 'predictAsync'),
+                                 params=params )
+        self.assertEqual(response.status_code, 202)
+        job = self.wait_for_job(response.json()['job_id'])
+        self.assertEqual(job['status'], 'done')
+        self.assertEqual(len(job['result']['reportDB']), 1)
+
+    def test_job_progress_while_polled(self):
+        meta = CONFIG['META_KEY']
+        diagnoses = rationale_net_wrapper.get_labeled_diagnoses(meta, CONFIG)
+        for organ in postprocess.get_routed_organs(CONFIG):
+            self.assertTrue(set(CONFIG['DIAGNOSES'][organ]) <= set(diagnoses))
+        job = jobs.Job('predict', self.name, meta, diagnoses)
+
+        def report_progress():
+            for k in range(2000):
+                job.progress(diagnoses[k % len(diagnoses)], jobs.RUNNING)
+                job.progress("extra {}".format(k), jobs.DONE)
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            future = executor.submit(report_progress)
+            while not future.done():
+                job.to_dict()
+            future.result()
+        self.assertEqual(job.to_dict()['progress']['total'], len(diagnoses) + 2000)
+
+    def test_unknown_job(self):
+        response = requests.get( os.path.join(DOMAIN, 'jobs', str(uuid.uuid4())) )
+        self.assertEqual(response.status_code, 404)
+
+    def test_stats(self):
+        response = requests.get( os.path.join(DOMAIN, 'stats') )
+        self.assertEqual(response.status_code, 200)
+        for cache in ['db_cache', 'model_cache', 'inference_cache', 'micro_batching']:
+            self.assertIn(cache, response.json())
+
 
 if __name__ == '__main__':
     unittest.main()